@@ -1,8 +1,17 @@
 import json
+import gzip
+import shutil
 import subprocess
 import os
 import re
+import time
+import uuid
+import signal
+import socket
+import multiprocessing.forkserver
 import boto3
+import metrics
+import scratch
 import configparser
 from botocore.config import Config
 from botocore.exceptions import ClientError
@@ -15,37 +24,266 @@ config.read('ann_config.ini')
 
 # s3 = boto3.client('s3', region_name='us-east-1', config=Config(signature_version="s3v4"))
 s3 = boto3.client('s3', region_name=config.get('aws', 'AwsRegionName'), config=Config(signature_version="s3v4"))
+dynamo = boto3.client('dynamodb', region_name=config.get('aws', 'AwsRegionName'))
+
+# run.py processes started by this annotator: job_id -> (Popen or ForkedJob,
+# user_role, start time, lease owner)
+running_jobs = {}
+
+# Request messages of the jobs above, kept hidden on the queue until the job
+# completes: job_id -> (message, time its visibility was last extended). If
+# this instance dies the message reappears and the job is claimed again
+# once its lease expires.
+job_messages = {}
+
+# Set on SIGTERM; the poll loop stops taking new jobs
+draining = False
+
+# Context whose fork server has preloaded AnnTools and the reference data
+# (see reference.py); None starts every job as a fresh python process
+fork_context = None
+
+# Disk space reservations for the jobs above
+scratch_space = scratch.ScratchSpace(config)
+
+# Longest SQS will hide a message (12 hours)
+MAX_VISIBILITY_TIMEOUT = 43200
+
+# Buckets (in seconds) for the queue wait and job duration histograms
+LATENCY_BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600]
+
+messages_received = metrics.Counter('ann_messages_received_total', 'SQS job request messages received')
+duplicate_messages = metrics.Counter('ann_duplicate_messages_total', 'Messages dropped because the job was completed or leased elsewhere')
+jobs_started = metrics.Counter('ann_jobs_started_total', 'Annotation jobs handed to run.py')
+bytes_downloaded = metrics.Counter('ann_input_bytes_downloaded_total', 'Bytes of input files downloaded from S3')
+metrics.Gauge('ann_jobs_in_flight', 'run.py processes currently running', lambda: len(running_jobs))
+metrics.Gauge('ann_executor_slots_free', 'Job slots available on this instance',
+              lambda: max(config.getint('anntools', 'MaxConcurrentJobs') - len(running_jobs), 0))
+metrics.Gauge('ann_scratch_reserved_bytes', 'Scratch disk space reserved by running jobs',
+              scratch_space.reserved_bytes)
+jobs_deferred = metrics.Counter('ann_jobs_deferred_total', 'Jobs put back on the queue for lack of scratch space')
+queue_wait = metrics.Histogram('ann_queue_wait_seconds', 'Time from job submission to claim by an annotator', LATENCY_BUCKETS)
+job_duration = metrics.Histogram('ann_job_duration_seconds', 'Wall time of run.py processes', LATENCY_BUCKETS)
 
 # --------------------- HELPER FUNCTIONS --------------------------
 
+def run_forked_job(args):
+    # Runs in the forked process, where run (and AnnTools) is already loaded
+    import run
+    run.main(*args)
+
+class ForkedJob(object):
+    # Popen-like handle on a run.py job forked from the fork server
+    def __init__(self, args):
+        self.process = fork_context.Process(target=run_forked_job, args=(args,))
+        self.process.start()
+        self.pid = self.process.pid
+
+    def poll(self):
+        return self.process.exitcode
+
+    def send_signal(self, signum):
+        os.kill(self.pid, signum)
+
+    def wait(self, timeout=None):
+        self.process.join(timeout)
+        if self.process.exitcode is None:
+            raise subprocess.TimeoutExpired(config.get('anntools', 'DriverPath'), timeout)
+        return self.process.exitcode
+
+def start_fork_server():
+    # Loads the reference data once, up front, rather than on the first job.
+    # Jobs only share what annotating WarmupVcf loaded, so it is required.
+    if not config.get('reference', 'WarmupVcf', fallback=''):
+        raise ValueError('[reference] WarmupVcf must be set when Preload is on')
+    global fork_context
+    fork_context = multiprocessing.get_context('forkserver')
+    fork_context.set_forkserver_preload(['__main__', 'reference'])
+    multiprocessing.forkserver.ensure_running()
+
+def start_job(args):
+    if fork_context is not None:
+        return ForkedJob(args)
+    return subprocess.Popen(["python", config.get('anntools', 'DriverPath')] + args)
+
 def read_log(path):
     with open(path, 'r') as f:
         lines = f.readlines()
     return lines
-    
+
+def claim_job(job_id, owner):
+    # Take a lease on the job before any download. The conditional write only
+    # succeeds when no live lease exists, so a redelivered message costs one
+    # DynamoDB call; a lease whose holder died stops being renewed and expires.
+    # Returns 0 on success, otherwise the seconds until the job may be retried
+    # (None if the job is already completed and should be dropped).
+    now = int(time.time())
+    try:
+        dynamo.update_item(TableName=config.get('aws', 'DynamoDBTableName'),
+                           Key={'job_id': {'S': job_id}},
+                           UpdateExpression='SET lease_owner = :owner, lease_expires = :expires',
+                           ConditionExpression='job_status <> :completed AND '
+                                               '(attribute_not_exists(lease_expires) OR lease_expires < :now)',
+                           ExpressionAttributeValues={
+                               ':owner': {'S': owner},
+                               ':expires': {'N': str(now + config.getint('lease', 'LeaseSeconds'))},
+                               ':completed': {'S': 'COMPLETED'},
+                               ':now': {'N': str(now)}})
+        return 0
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+    item = dynamo.get_item(TableName=config.get('aws', 'DynamoDBTableName'),
+                           Key={'job_id': {'S': job_id}},
+                           ProjectionExpression='job_status, lease_expires').get('Item', {})
+    if item.get('job_status', {}).get('S') == 'COMPLETED':
+        return None
+    if 'lease_expires' not in item:
+        # Released since our write failed; try again straight away
+        return 1
+    return max(int(item['lease_expires']['N']) - now, 1)
+
+def release_job(job_id, owner):
+    # Drop our lease so the job can be retried right away after a failure
+    try:
+        dynamo.update_item(TableName=config.get('aws', 'DynamoDBTableName'),
+                           Key={'job_id': {'S': job_id}},
+                           UpdateExpression='REMOVE lease_owner, lease_expires',
+                           ConditionExpression='lease_owner = :owner',
+                           ExpressionAttributeValues={':owner': {'S': owner}})
+    except ClientError as e:
+        print(e)
+
+def job_completed(job_id):
+    item = dynamo.get_item(TableName=config.get('aws', 'DynamoDBTableName'),
+                           Key={'job_id': {'S': job_id}},
+                           ProjectionExpression='job_status',
+                           ConsistentRead=True).get('Item', {})
+    return item.get('job_status', {}).get('S') == 'COMPLETED'
+
+def finish_job(job_id, owner):
+    # Called once a job's run.py has exited. A completed job's request is
+    # done with; anything else (a failure, a crash, a job drained at a
+    # checkpoint) gives up its lease and puts the request straight back on
+    # the queue, to be resumed from its last checkpoint. Jobs that keep
+    # failing end up in the dead-letter queue via the redrive policy.
+    message, _ = job_messages.pop(job_id)
+    try:
+        if job_completed(job_id):
+            message.delete()
+        else:
+            release_job(job_id, owner)
+            message.change_visibility(VisibilityTimeout=0)
+            print(f'Job {job_id} did not complete; returned it to the queue')
+    except ClientError as e:
+        # The message reappears on its own once its visibility lapses
+        print(e)
+
+def extend_visibility():
+    # Heartbeat for the request messages of running jobs, in step with
+    # run.py's lease renewal; SQS caps the total at MAX_VISIBILITY_TIMEOUT
+    now = time.time()
+    for job_id, (message, extended) in list(job_messages.items()):
+        if now - extended < config.getint('lease', 'HeartbeatSeconds'):
+            continue
+        try:
+            message.change_visibility(VisibilityTimeout=config.getint('lease', 'LeaseSeconds'))
+            job_messages[job_id] = (message, now)
+        except ClientError as e:
+            print(f'Unable to extend visibility of job {job_id}: {e}')
+
+def handle_message(message):
+    messages_received.inc()
+    response = {}
+    try:
+        sqs_response = json.loads(message.body)
+        data = json.loads(sqs_response['Message'])
+        response = query_ann_jobs(data)
+        print(response)
+    except Exception as e:
+        print(e)
+        raise
+    finally:
+        if response.get('retry_after'):
+            # Another worker holds a live lease; look at the job again
+            # once that lease would have expired
+            message.change_visibility(VisibilityTimeout=response['retry_after'])
+        elif response.get('code') == 201:
+            # Deleted by finish_job once the job completes
+            job_messages[response['data']['job_id']] = (message, time.time())
+        elif response.get('code') != 500:
+            message.delete()
+        # After a 500 the message becomes visible again when its
+        # visibility timeout lapses and the job is retried
+
+def free_slots(lane):
+    # Reap finished run.py processes, then count the slots this lane may use;
+    # free-user jobs can never take the slots reserved for premium work
+    for job_id, (process, _, started, owner) in list(running_jobs.items()):
+        if process.poll() is not None:
+            job_duration.observe(time.time() - started)
+            del running_jobs[job_id]
+            scratch_space.release(job_id)
+            finish_job(job_id, owner)
+    slots = config.getint('anntools', 'MaxConcurrentJobs') - len(running_jobs)
+    if lane == 'free_user':
+        slots -= max(config.getint('anntools', 'ReservedPremiumSlots') -
+                     sum(1 for _, role, _, _ in running_jobs.values() if role == 'premium_user'), 0)
+    return max(slots, 0)
+
+def lane_order(turn):
+    # Order in which lanes are offered a turn on this pass of the poll loop
+    if config.get('anntools', 'SchedulingPolicy') == 'weighted' and \
+            turn % (config.getint('anntools', 'PremiumWeight') + 1) == 0:
+        return ['free_user', 'premium_user']
+    return ['premium_user', 'free_user']
+
 def poll_sqs_messages():
     # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html
     sqs = boto3.resource('sqs', region_name=config.get('aws', 'AwsRegionName'))
     # url = 'https://sqs.us-east-1.amazonaws.com/659248683008/gaoyunl1_job_requests'
-    url = config.get('aws', 'SQSRequestQueueUrl')
-    queue = sqs.Queue(url)
-    while True:
-        # messages = queue.receive_messages(WaitTimeSeconds=10)
-        messages = queue.receive_messages(WaitTimeSeconds=config.getint('aws', 'SQSPollingWaitTime'))
-        for message in messages:
-            try:
-                sqs_response = json.loads(message.body)
-                data = json.loads(sqs_response['Message'])
-                response = query_ann_jobs(data)
-                print(response)
-            except Exception as e:
-                print(e)
-                raise
-            finally:
-                message.delete()
+    queues = {'premium_user': sqs.Queue(config.get('aws', 'SQSPremiumQueueUrl')),
+              'free_user': sqs.Queue(config.get('aws', 'SQSRequestQueueUrl'))}
+    turn = 0
+    last_reap = 0
+    while not draining:
+        turn += 1
+        extend_visibility()
+        if time.time() - last_reap >= config.getint('scratch', 'ReapIntervalSeconds'):
+            for path in scratch_space.reap_orphans():
+                print(f'Removed orphaned job directory {path}')
+            last_reap = time.time()
+        received = 0
+        for lane in lane_order(turn):
+            slots = free_slots(lane)
+            if not slots:
+                continue
+            # Short poll so a busy lane never hides work waiting in the other
+            messages = queues[lane].receive_messages(MaxNumberOfMessages=min(slots, 10), WaitTimeSeconds=0,
+                                                     VisibilityTimeout=config.getint('lease', 'LeaseSeconds'))
+            for message in messages:
+                handle_message(message)
+            received += len(messages)
+            if messages and config.get('anntools', 'SchedulingPolicy') == 'strict':
+                break
+        if received:
+            continue
+        # Nothing waiting anywhere; long poll the highest priority lane with
+        # capacity, splitting the wait so the other lane is not starved
+        for lane in lane_order(turn):
+            if free_slots(lane):
+                wait = max(config.getint('aws', 'SQSPollingWaitTime') // len(queues), 1)
+                for message in queues[lane].receive_messages(WaitTimeSeconds=wait,
+                                                             VisibilityTimeout=config.getint('lease', 'LeaseSeconds')):
+                    handle_message(message)
+                break
+        else:
+            time.sleep(1)
         print('Done with loop')
     
 def query_ann_jobs(data):
+    owner = f'{socket.gethostname()}:{uuid.uuid4()}'
+    claimed = False
     try:
         bucket = data['s3_inputs_bucket']
         job_id = data['job_id']
@@ -55,17 +293,56 @@ def query_ann_jobs(data):
         user_name = data['user_name']
         user_email = data['user_email']
         user_role = data['user_role']
-        
+
+        retry_after = claim_job(job_id, owner)
+        if retry_after is None:
+            duplicate_messages.inc()
+            content = {"code": 200, "status": "duplicate", "data": {"job_id": job_id}}
+            return content
+        if retry_after:
+            duplicate_messages.inc()
+            content = {"code": 409, "status": "leased", "data": {"job_id": job_id}, "retry_after": retry_after}
+            return content
+        claimed = True
+        if 'submit_time' in data:
+            queue_wait.observe(time.time() - int(data['submit_time']))
+
         # job_dir_path = os.path.join(RESULTS_PATH, job_id)
-        job_dir_path = os.path.join(config.get('anntools', 'ResultPath'), job_id)
-        os.mkdir(job_dir_path)
+        # Reserve scratch space before downloading; a job that doesn't fit
+        # goes back on the queue (for good, if it can never fit here, until
+        # the queue's redrive policy moves it to the dead-letter queue)
+        # The web app's pre-flight check estimates the uncompressed size
+        input_bytes = max(s3.head_object(Bucket=bucket, Key=key)['ContentLength'],
+                          int(data.get('input_uncompressed_bytes', 0)))
+        job_dir_path = scratch_space.reserve(job_id, input_bytes)
+        if job_dir_path is None:
+            jobs_deferred.inc()
+            retry_after = config.getint('scratch', 'DeferSeconds') \
+                if scratch_space.fits_anywhere(input_bytes) else MAX_VISIBILITY_TIMEOUT
+            content = {"code": 507, "status": "deferred", "data": {"job_id": job_id},
+                       "retry_after": retry_after}
+            release_job(job_id, owner)
+            return content
 
         file_path = os.path.join(job_dir_path, file_name)
 
         s3.download_file(bucket, key, file_path)
+        bytes_downloaded.inc(os.path.getsize(file_path))
+        if data.get('input_compression', 'none') != 'none':
+            # AnnTools reads plain VCF; gzip also reads bgzip (multi-member)
+            compressed_path = file_path
+            # run.py expects a .vcf name (sample.gz -> sample.vcf)
+            file_path = re.sub(r'\.b?gz$', '', compressed_path)
+            if not file_path.endswith('.vcf'):
+                file_path += '.vcf'
+            with gzip.open(compressed_path, 'rb') as src, open(file_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(compressed_path)
 
         # subprocess.Popen(["python", ANNTOOLS_DRIVER_PATH, file_path, user])
-        subprocess.Popen(["python", config.get('anntools', 'DriverPath'), file_path, user, user_name, user_email])
+        process = start_job([file_path, user, user_name, user_email, owner])
+        running_jobs[job_id] = (process, user_role, time.time(), owner)
+        jobs_started.inc()
         
         content = {"code": 201, "data": {"job_id": job_id, "input_file": file_name}}
     except ClientError as e:
@@ -73,7 +350,33 @@ def query_ann_jobs(data):
     except Exception as e:
         content = {"code": 500, "status": "error", "message": str(e)}
     finally:
+        if claimed and content["code"] == 500:
+            release_job(job_id, owner)
+            scratch_space.release(job_id)
         return content
 
+def start_draining(signum, frame):
+    global draining
+    draining = True
+
+def drain_jobs():
+    # Ask every run.py to checkpoint at the end of its current chunk and hand
+    # its job back, then wait for them (within the interruption notice)
+    for process, _, _, _ in running_jobs.values():
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+    deadline = time.time() + config.getint('checkpoint', 'DrainSeconds')
+    for job_id, (process, _, _, owner) in running_jobs.items():
+        try:
+            process.wait(timeout=max(deadline - time.time(), 0))
+            finish_job(job_id, owner)
+        except subprocess.TimeoutExpired:
+            print(f'Job {job_id} did not drain in time; it resumes from its last checkpoint')
+
 if __name__ == '__main__':
-    poll_sqs_messages()
\ No newline at end of file
+    signal.signal(signal.SIGTERM, start_draining)
+    if config.getboolean('reference', 'Preload'):
+        start_fork_server()
+    metrics.serve(config.get('metrics', 'BindAddress'), config.getint('metrics', 'Port'))
+    poll_sqs_messages()
+    drain_jobs()
\ No newline at end of file
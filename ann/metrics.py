@@ -0,0 +1,99 @@
+# metrics.py
+#
+# Minimal Prometheus text-format metrics for the annotator
+#
+# Counters, gauges and histograms are kept in process and served by a
+# small HTTP server thread, so autoscaling can look at backlog per
+# instance rather than CPU alone.
+##
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_lock = threading.Lock()
+_metrics = []
+
+class Counter(object):
+    def __init__(self, name, help_text):
+        self.name, self.help_text, self.value = name, help_text, 0
+        _metrics.append(self)
+
+    def inc(self, amount=1):
+        with _lock:
+            self.value += amount
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help_text}',
+                f'# TYPE {self.name} counter',
+                f'{self.name} {self.value}']
+
+class Gauge(object):
+    # Value may be set directly or computed on every scrape
+    def __init__(self, name, help_text, function=None):
+        self.name, self.help_text, self.value = name, help_text, 0
+        self.function = function
+        _metrics.append(self)
+
+    def set(self, value):
+        with _lock:
+            self.value = value
+
+    def render(self):
+        value = self.function() if self.function else self.value
+        return [f'# HELP {self.name} {self.help_text}',
+                f'# TYPE {self.name} gauge',
+                f'{self.name} {value}']
+
+class Histogram(object):
+    def __init__(self, name, help_text, buckets):
+        self.name, self.help_text = name, help_text
+        self.buckets = sorted(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.total, self.count = 0.0, 0
+        _metrics.append(self)
+
+    def observe(self, value):
+        with _lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+            self.total += value
+            self.count += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}',
+                 f'# TYPE {self.name} histogram']
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {count}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.total}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+def render():
+    with _lock:
+        lines = [line for metric in _metrics for line in metric.render()]
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown out the annotator's own output
+        pass
+
+def serve(address, port):
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+### EOF
@@ -0,0 +1,80 @@
+# reference.py
+#
+# Reference data shared by every annotation job
+#
+# With [reference] Preload on, the annotator forks job processes from a
+# multiprocessing fork server that imports this module once at startup.
+# Importing it imports AnnTools and annotates WarmupVcf, so that whatever
+# AnnTools loads into memory on first use is already on the fork server's
+# heap; jobs forked afterwards share that copy-on-write instead of each
+# loading their own copy. The reference Files are also mapped read-only,
+# which only warms the page cache (shared by all processes anyway) so the
+# first jobs don't wait on disk reads.
+##
+
+import gc
+import os
+import sys
+import glob
+import mmap
+import shutil
+import tempfile
+import configparser
+import multiprocessing.spawn
+
+config = configparser.ConfigParser()
+config.read('ann_config.ini')
+
+# The fork server imports this module before it has the annotator's
+# sys.path; run.py and AnnTools live in DriverPath's directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(config.get('anntools', 'DriverPath'))))
+import run
+
+# Every job forked from here would otherwise run annotator.py again (as
+# __mp_main__) before starting, creating its AWS clients and scratch space
+# for nothing. set_forkserver_preload(['__main__']) is meant to import it
+# here once, but Python 3.11 never passes the fork server the script's
+# path, so do it ourselves; jobs then find it already loaded.
+ANNOTATOR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'annotator.py')
+if getattr(sys.modules['__main__'], '__file__', None) != ANNOTATOR_PATH:
+    multiprocessing.spawn.import_main_path(ANNOTATOR_PATH)
+
+# Kept open for the life of the fork server so the pages stay resident
+mappings = []
+
+def map_file(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        # MAP_POPULATE reads the whole file in now rather than on first touch
+        flags = mmap.MAP_SHARED | getattr(mmap, 'MAP_POPULATE', 0)
+        return mmap.mmap(f.fileno(), 0, flags=flags, prot=mmap.PROT_READ)
+
+def warm_up(vcf_path):
+    # AnnTools writes its outputs next to the input, so run on a copy
+    dir_name = tempfile.mkdtemp(prefix='gas-warmup-')
+    try:
+        warmup_path = os.path.join(dir_name, os.path.basename(vcf_path))
+        shutil.copyfile(vcf_path, warmup_path)
+        with run.Timer(verbose=False) as timer:
+            run.driver.run(warmup_path, 'vcf')
+        print(f'AnnTools warm-up took {timer.secs:.2f} seconds')
+    finally:
+        shutil.rmtree(dir_name, ignore_errors=True)
+
+def load():
+    for pattern in config.get('reference', 'Files', fallback='').split():
+        for path in sorted(glob.glob(pattern)):
+            mapping = map_file(path)
+            if mapping is not None:
+                mappings.append(mapping)
+    print(f'Mapped {len(mappings)} reference files '
+          f'({sum(len(m) for m in mappings)} bytes)')
+    warm_up(config.get('reference', 'WarmupVcf'))
+    # Keep the collector in forked jobs from writing to (and so copying)
+    # the pages holding everything loaded so far
+    gc.freeze()
+
+load()
+
+### EOF
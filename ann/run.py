@@ -16,10 +16,26 @@ import shutil
 import boto3
 import time
 import json
+import signal
+import threading
+import subprocess
 import configparser
+from decimal import Decimal
+from boto3.dynamodb.types import TypeDeserializer
 from botocore.config import Config
 from botocore.exceptions import ClientError
 
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
 """A rudimentary timer for coarse-grained profiling
 """
 config = configparser.ConfigParser()
@@ -49,72 +65,364 @@ def parse_path(path):
     return dir_name, file_name, job_id        
 
 
-def update_dynamo_to_running(job_id):
+def update_dynamo_to_running(job_id, owner=None):
     # reference: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.UpdateItem.html
+    # A job left RUNNING by an interrupted annotator may be picked up again
+    # by whoever now holds its lease; it resumes from its last checkpoint
     try:
         dynamo = boto3.client('dynamodb')
         # table = 'gaoyunl1_annotations'
         table = config.get('aws', 'DynamoDBTableName')
+        condition = "job_status = :pending_status"
+        values = {':new_value':{'S': 'RUNNING'},
+                  ':pending_status':{'S':'PENDING'},
+                  ':now':{'N': str(int(time.time()))}}
+        if owner:
+            condition += " OR (job_status = :new_value AND lease_owner = :owner)"
+            values[':owner'] = {'S': owner}
         response = dynamo.update_item(TableName = table, 
                                     Key={'job_id':{'S': job_id}},
-                                    UpdateExpression='SET job_status = :new_value',
-                                    ConditionExpression="job_status = :pending_status",
-                                    ExpressionAttributeValues={':new_value':{'S': 'RUNNING'},
-                                                               ':pending_status':{'S':'PENDING'}}
+                                    # start_time is when the job first ran (a resumed job
+                                    # keeps it), separating queue wait from run time
+                                    UpdateExpression='SET job_status = :new_value, start_time = if_not_exists(start_time, :now)',
+                                    ConditionExpression=condition,
+                                    ExpressionAttributeValues=values,
+                                    ReturnValues='ALL_OLD'
                                     )
         print(response)
-        return True
     except Exception as e:
         print(e)
         return False
+    old = response['Attributes']
+    # A resumed job was already counted as running
+    if old['job_status']['S'] == 'PENDING':
+        update_user_stats(old['user_id']['S'], {'jobs_pending': -1, 'jobs_running': 1})
+    return True
+
+def update_user_stats(user, deltas):
+    # Adjust the user's job counters (see web/user_stats.py); they are only
+    # advisory, so a failure is logged and the job carries on
+    try:
+        dynamo = boto3.client('dynamodb', region_name=config.get('aws', 'AwsRegionName'))
+        names = [name for name, amount in deltas.items() if amount]
+        if not names:
+            return
+        dynamo.update_item(TableName=config.get('aws', 'DynamoDBStatsTableName'),
+                           Key={'user_id': {'S': user}},
+                           UpdateExpression='ADD ' + ', '.join(f'{name} :d{i}' for i, name in enumerate(names)),
+                           ExpressionAttributeValues={f':d{i}': {'N': str(deltas[name])} for i, name in enumerate(names)})
+    except Exception as e:
+        print(e)
+
+
+def renew_lease(job_id, owner, stop):
+    # Heartbeat for the lease annotator.py took before downloading the input.
+    # Runs until stop is set; if this process dies the lease simply expires
+    # and another annotator may reclaim the job.
+    dynamo = boto3.client('dynamodb', region_name=config.get('aws', 'AwsRegionName'))
+    table = config.get('aws', 'DynamoDBTableName')
+    while not stop.wait(config.getint('lease', 'HeartbeatSeconds')):
+        try:
+            dynamo.update_item(TableName = table,
+                               Key={'job_id':{'S': job_id}},
+                               UpdateExpression='SET lease_expires = :expires',
+                               ConditionExpression='lease_owner = :owner',
+                               ExpressionAttributeValues={
+                                 ':expires':{'N': str(int(time.time()) + config.getint('lease', 'LeaseSeconds'))},
+                                 ':owner':{'S': owner}
+                                 })
+        except ClientError as e:
+            print(f'Lost lease on job {job_id}: {e}')
+            return
+
+def checkpoint_prefix(user, job_id):
+    return 'gaoyunl1/' + user + '/' + job_id + '/checkpoint/'
+
+def segment_paths(dir_name, segment):
+    # Annotated records and count log produced between two checkpoints
+    base = os.path.join(dir_name, 'checkpoint', f'{segment:05d}')
+    return base + '.annot.vcf', base + '.count.log'
+
+def start_segment(dir_name, segment):
+    # A killed run on this host may have left a partial copy of the segment
+    # behind; the records in it are annotated again, so start it empty
+    for path in segment_paths(dir_name, segment):
+        if os.path.exists(path):
+            os.remove(path)
+
+def load_checkpoint(job_id, user, dir_name):
+    # Download the output segments saved by an earlier, interrupted run of
+    # this job; returns (records already annotated, segments downloaded)
+    dynamo = boto3.client('dynamodb', region_name=config.get('aws', 'AwsRegionName'))
+    item = dynamo.get_item(TableName=config.get('aws', 'DynamoDBTableName'),
+                           Key={'job_id':{'S': job_id}},
+                           ProjectionExpression='checkpoint_records, checkpoint_segments')['Item']
+    if 'checkpoint_records' not in item:
+        return 0, 0
+    records, segments = int(item['checkpoint_records']['N']), int(item['checkpoint_segments']['N'])
+    s3 = boto3.client('s3', region_name=config.get('aws', 'AwsRegionName'))
+    os.makedirs(os.path.join(dir_name, 'checkpoint'), exist_ok=True)
+    for segment in range(segments):
+        for path in segment_paths(dir_name, segment):
+            s3.download_file(RESULT_BUCKET, checkpoint_prefix(user, job_id) + os.path.basename(path), path)
+    print(f'Checkpoint: Resuming job {job_id} after {records} records')
+    return records, segments
+
+def save_checkpoint(job_id, user, owner, dir_name, segment, records):
+    # Upload the segment just finished, then record how far the job got.
+    # Only the lease holder may move the checkpoint.
+    try:
+        s3 = boto3.client('s3', region_name=config.get('aws', 'AwsRegionName'))
+        for path in segment_paths(dir_name, segment):
+            s3.upload_file(path, RESULT_BUCKET, checkpoint_prefix(user, job_id) + os.path.basename(path))
+        dynamo = boto3.client('dynamodb', region_name=config.get('aws', 'AwsRegionName'))
+        update = {'UpdateExpression': 'SET checkpoint_records = :records, checkpoint_segments = :segments',
+                  'ExpressionAttributeValues': {':records':{'N': str(records)},
+                                                ':segments':{'N': str(segment + 1)}}}
+        if owner:
+            update['ConditionExpression'] = 'lease_owner = :owner'
+            update['ExpressionAttributeValues'][':owner'] = {'S': owner}
+        dynamo.update_item(TableName=config.get('aws', 'DynamoDBTableName'),
+                           Key={'job_id':{'S': job_id}}, **update)
+        print(f'Checkpoint: {records} records saved for job {job_id}')
+        return True
+    except ClientError as e:
+        print(e)
+        return False
+
+def delete_checkpoint(job_id, user):
+    try:
+        s3 = boto3.client('s3', region_name=config.get('aws', 'AwsRegionName'))
+        response = s3.list_objects_v2(Bucket=RESULT_BUCKET, Prefix=checkpoint_prefix(user, job_id))
+        objects = [{'Key': obj['Key']} for obj in response.get('Contents', [])]
+        if objects:
+            s3.delete_objects(Bucket=RESULT_BUCKET, Delete={'Objects': objects})
+    except ClientError as e:
+        print(e)
+
+def vcf_chunks(path, skip, chunk_records):
+    # Yields (header lines, record lines) for successive chunks of the input,
+    # leaving out the first skip records
+    with open(path, 'r') as f:
+        header, records, seen, chunks = [], [], 0, 0
+        for line in f:
+            if line.startswith('#'):
+                header.append(line)
+                continue
+            seen += 1
+            if seen <= skip:
+                continue
+            records.append(line)
+            if len(records) == chunk_records:
+                yield header, records
+                records, chunks = [], chunks + 1
+        # A file with no records left still gets one (header only) pass
+        if records or (not chunks and not skip):
+            yield header, records
+
+def annotate_chunk(dir_name, header, records):
+    # Runs AnnTools on one chunk; returns the paths of its outputs
+    chunk_path = os.path.join(dir_name, 'checkpoint', 'chunk.vcf')
+    with open(chunk_path, 'w') as f:
+        f.writelines(header)
+        f.writelines(records)
+    driver.run(chunk_path, 'vcf')
+    return chunk_path[:-4] + '.annot.vcf', chunk_path + '.count.log'
 
+def annotate(path, job_id, user, owner, draining):
+    # Annotate the input ChunkRecords records at a time, saving a checkpoint
+    # every CheckpointSeconds and whenever the annotator is asked to drain.
+    # Returns False if the job stopped early at a checkpoint.
+    dir_name, file_name, _ = parse_path(path)
+    os.makedirs(os.path.join(dir_name, 'checkpoint'), exist_ok=True)
+    done, segment = load_checkpoint(job_id, user, dir_name)
+    start_segment(dir_name, segment)
+    last_checkpoint = time.time()
+    finished = True
+    for header, records in vcf_chunks(path, done, config.getint('checkpoint', 'ChunkRecords')):
+        annotated, count_log = annotate_chunk(dir_name, header, records)
+        segment_vcf, segment_log = segment_paths(dir_name, segment)
+        with open(annotated, 'r') as src, open(segment_vcf, 'a') as dst:
+            # Only the very first chunk contributes the VCF header
+            dst.writelines(line for line in src if done == 0 or not line.startswith('#'))
+        with open(count_log, 'r') as src, open(segment_log, 'a') as dst:
+            shutil.copyfileobj(src, dst)
+        done += len(records)
 
-def update_dynamo_to_complete(job_id, log_file_key, result_file_key):
+        if draining.is_set() or \
+                time.time() - last_checkpoint >= config.getint('checkpoint', 'CheckpointSeconds'):
+            if save_checkpoint(job_id, user, owner, dir_name, segment, done):
+                segment += 1
+                start_segment(dir_name, segment)
+                last_checkpoint = time.time()
+            if draining.is_set():
+                finished = False
+                break
+
+    if finished:
+        # Stitch the segments together into the usual AnnTools outputs
+        with open(os.path.join(dir_name, file_name + '.annot.vcf'), 'w') as out_vcf, \
+                open(path + '.count.log', 'w') as out_log:
+            for i in range(segment + 1):
+                for segment_path, out in zip(segment_paths(dir_name, i), (out_vcf, out_log)):
+                    if os.path.exists(segment_path):
+                        with open(segment_path, 'r') as src:
+                            shutil.copyfileobj(src, out)
+    return finished
+
+
+def update_dynamo_to_complete(job_id, log_file_key, result_file_key, extra_keys=None,
+                              record_count=0, result_bytes=0):
     # reference: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.UpdateItem.html
     try:
         dynamo = boto3.client('dynamodb')
         # table = 'gaoyunl1_annotations'
         table = config.get('aws', 'DynamoDBTableName')
+        values = {
+          ':status_value':{'S':'COMPLETED'},
+          ':res_bucket_value':{'S': RESULT_BUCKET},
+          ':res_key_value': {'S': result_file_key},
+          ':log_key_value': {'S': log_file_key},
+          ':ct':{'N':str(int(time.time()))},
+          ':records':{'N': str(record_count)},
+          ':bytes':{'N': str(result_bytes)}
+          }
+        updates = 'job_status = :status_value, s3_results_bucket=:res_bucket_value, s3_key_result_file = :res_key_value, s3_key_log_file = :log_key_value, complete_time = :ct, ' \
+            'result_record_count = :records, result_bytes = :bytes'
+        # Keys of the optional derived files (indexed copy, sidecar)
+        for i, (attribute, key) in enumerate((extra_keys or {}).items()):
+            updates += f', {attribute} = :extra_key_{i}'
+            values[f':extra_key_{i}'] = {'S': key}
         response = dynamo.update_item(TableName = table, 
                                     Key={'job_id':{'S': job_id}},
-                                    UpdateExpression='SET job_status = :status_value, s3_results_bucket=:res_bucket_value, s3_key_result_file = :res_key_value, s3_key_log_file = :log_key_value, complete_time = :ct',
-                                    ExpressionAttributeValues={
-                                      ':status_value':{'S':'COMPLETED'},
-                                      ':res_bucket_value':{'S': RESULT_BUCKET},
-                                      ':res_key_value': {'S': result_file_key},
-                                      ':log_key_value': {'S': log_file_key},
-                                      ':ct':{'N':str(int(time.time()))}
-                                      },
+                                    UpdateExpression='SET ' + updates + ' REMOVE lease_owner, lease_expires, checkpoint_records, checkpoint_segments',
+                                    ExpressionAttributeValues=values,
+                                    ReturnValues='ALL_OLD'
                                     )
         print(response)
-        return response
     except Exception as e:
         print(e)
+        return None
+    old = response['Attributes']
+    # Completing a job twice (e.g. after a redelivered request) counts once
+    if old['job_status']['S'] != 'COMPLETED':
+        previous = 'jobs_running' if old['job_status']['S'] == 'RUNNING' else 'jobs_pending'
+        update_user_stats(old['user_id']['S'], {previous: -1,
+                                                'jobs_completed': 1,
+                                                'variants_annotated': record_count,
+                                                'result_bytes': result_bytes})
+    return response
 
 
+def index_results(vcf_path):
+    # Block-compress (bgzip) and tabix-index the annotated VCF next to the
+    # plain copy, so the web app can read one region with S3 range requests.
+    # Returns the paths of the .gz and .gz.tbi files, or () if not indexed.
+    try:
+        if pysam:
+            bgzip_path = pysam.tabix_index(vcf_path, preset='vcf', force=True, keep_original=True)
+            return bgzip_path, bgzip_path + '.tbi'
+        if shutil.which('bgzip') and shutil.which('tabix'):
+            subprocess.run(['bgzip', '--force', '--keep', vcf_path], check=True)
+            subprocess.run(['tabix', '--force', '--preset', 'vcf', vcf_path + '.gz'], check=True)
+            return vcf_path + '.gz', vcf_path + '.gz.tbi'
+        print('Neither pysam nor htslib is installed; results not indexed')
+    except Exception as e:
+        # tabix needs coordinate-sorted input
+        print(f'Unable to index results: {e}')
+    return ()
+
+def variant_annotation(info):
+    # (consequence, gene) of a record from its INFO column. SnpEff (ANN) and
+    # VEP (CSQ) annotations put both in their first pipe-delimited entry;
+    # otherwise look for the plain INFO keys named in the config.
+    fields = dict(item.split('=', 1) if '=' in item else (item, '') for item in info.split(';'))
+    for key in ('ANN', 'CSQ'):
+        if key in fields:
+            first = fields[key].split(',')[0].split('|')
+            if len(first) > 3:
+                return first[1] or None, first[3] or None
+    return (fields.get(config.get('sidecar', 'ConsequenceField')) or None,
+            fields.get(config.get('sidecar', 'GeneField')) or None)
+
+SIDECAR_SCHEMA = [('chrom', 'string'), ('pos', 'int64'), ('ref', 'string'), ('alt', 'string'),
+                  ('qual', 'float64'), ('filter', 'string'), ('consequence', 'string'), ('gene', 'string')]
+
+def write_sidecar(vcf_path):
+    # Columnar (Parquet) copy of the annotated variants for the web app's
+    # summary queries, written RowGroupRecords records at a time.
+    # Returns its path, or None if pyarrow is not installed.
+    if pq is None:
+        print('pyarrow is not installed; no Parquet sidecar written')
+        return None
+    sidecar_path = vcf_path[:-4] + '.parquet'
+    schema = pa.schema([(name, getattr(pa, kind)()) for name, kind in SIDECAR_SCHEMA])
+    batch_size = config.getint('sidecar', 'RowGroupRecords')
+    try:
+        with open(vcf_path, 'r') as f, pq.ParquetWriter(sidecar_path, schema, compression='zstd') as writer:
+            columns = {name: [] for name, _ in SIDECAR_SCHEMA}
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                consequence, gene = variant_annotation(fields[7]) if len(fields) > 7 else (None, None)
+                for name, value in zip(columns, (fields[0], int(fields[1]), fields[3], fields[4],
+                                                 None if fields[5] == '.' else float(fields[5]),
+                                                 fields[6], consequence, gene)):
+                    columns[name].append(value)
+                if len(columns['chrom']) == batch_size:
+                    writer.write_table(pa.table(columns, schema=schema))
+                    columns = {name: [] for name in columns}
+            if columns['chrom']:
+                writer.write_table(pa.table(columns, schema=schema))
+        return sidecar_path
+    except Exception as e:
+        print(f'Unable to write Parquet sidecar: {e}')
+        return None
+
 def upload_files(dir_name, file_name, job_id, user):
     # reference: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
+    # Returns True once the results are in S3 and the job is COMPLETED
     try:
         s3 = boto3.client('s3', region_name=config.get('aws', 'AwsRegionName'))
         keys = []
+        result_bytes = 0
         for result_file in [file_name + '.vcf.count.log', file_name + '.annot.vcf']:
             file_path = os.path.join(dir_name, result_file)
             key = 'gaoyunl1/' + user + '/' + job_id + '/' + result_file
             s3.upload_file(file_path, RESULT_BUCKET, key)  # upload file to S3
             keys.append(key)
+            result_bytes += os.path.getsize(file_path)
+        annotated_path = os.path.join(dir_name, file_name + '.annot.vcf')
+        derived = dict(zip(['s3_key_result_bgzip_file', 's3_key_result_tabix_file'],
+                           index_results(annotated_path)))
+        sidecar_path = write_sidecar(annotated_path)
+        if sidecar_path:
+            derived['s3_key_result_parquet_file'] = sidecar_path
+        extra_keys = {}
+        for attribute, file_path in derived.items():
+            key = 'gaoyunl1/' + user + '/' + job_id + '/' + os.path.basename(file_path)
+            s3.upload_file(file_path, RESULT_BUCKET, key)
+            extra_keys[attribute] = key
+            result_bytes += os.path.getsize(file_path)
         print('Checkpoint: Files upload to s3 completed')
 
-        update_dynamo_to_complete(job_id, keys[0], keys[1])
+        with open(annotated_path, 'r') as f:
+            record_count = sum(1 for line in f if not line.startswith('#'))
+        if not update_dynamo_to_complete(job_id, keys[0], keys[1], extra_keys, record_count, result_bytes):
+            return False
         print('Checkpoint: Update to dynamo completed')
 
         shutil.rmtree(dir_name)
         print('Checkpoint: Local files removed')
+        return True
     except FileNotFoundError as e:
        print(e)
     except ClientError as e:
        print(e)
     except Exception as e:
        print(e)
+    return False
 
 def publish_to_sns(data):
     # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
@@ -124,7 +432,11 @@ def publish_to_sns(data):
         topic_arn = config.get('aws', 'SNSJobResultTopic')
         message = json.dumps(data)
         subject = 'New Annotation Job Results'
-        response = sns.publish(TopicArn=topic_arn, Message=message, Subject=subject)
+        # Subscribers that only want completions (the notification email)
+        # filter on job_status; the web app's status feed takes them all
+        response = sns.publish(TopicArn=topic_arn, Message=message, Subject=subject,
+                               MessageAttributes={'job_status': {'DataType': 'String',
+                                                                 'StringValue': data['job_status']}})
         print(f'SNS response: {response}')
         return response
     except ClientError as e:
@@ -132,17 +444,139 @@ def publish_to_sns(data):
     except Exception as e:
         raise
 
+# Fields of a job item that make up a job request message
+JOB_REQUEST_FIELDS = ['user_id', 'job_id', 'input_file_name', 's3_inputs_bucket',
+                      's3_key_input_file', 'user_name', 'user_email',
+                      'user_institution', 'user_role', 'submit_time',
+                      'input_compression', 'input_records_exact',
+                      'input_record_count', 'input_uncompressed_bytes']
+
+def publish_job_request(item, job_status):
+    # Put a job back on the request topic so an annotator picks it up
+    # DynamoDB numbers deserialize as Decimal, which JSON can't encode
+    data = {k: int(item[k]) if isinstance(item[k], Decimal) else item[k]
+            for k in JOB_REQUEST_FIELDS if k in item}
+    data['job_status'] = job_status
+    sns = boto3.client('sns', region_name=config.get('aws', 'AwsRegionName'))
+    sns.publish(TopicArn=config.get('aws', 'SNSJobRequestTopic'),
+                Message=json.dumps(data),
+                Subject='New Annotation Job Request',
+                MessageAttributes={'user_role': {'DataType': 'String', 'StringValue': data['user_role']}})
+
+def set_job_status(dynamo, job_id, status, expected):
+    # Conditional status change; False if the job has moved on from expected
+    try:
+        dynamo.update_item(TableName = config.get('aws', 'DynamoDBTableName'),
+                           Key={'job_id':{'S': job_id}},
+                           UpdateExpression='SET job_status = :status',
+                           ConditionExpression='job_status = :expected',
+                           ExpressionAttributeValues={':status':{'S': status},
+                                                      ':expected':{'S': expected}})
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
+    return True
+
+def release_deferred_jobs(user, job_id):
+    # The web app holds jobs beyond a user's in-flight limit as DEFERRED.
+    # Fill whatever slots the user has free with their oldest deferred jobs.
+    # Safe to call whatever became of the job that just ran: a job still
+    # PENDING or RUNNING keeps its slot, and the conditional update makes
+    # sure a deferred job is only ever released once. job_id is the job that
+    # just ran; user_id_index may not show its new status yet.
+    try:
+        dynamo = boto3.client('dynamodb', region_name=config.get('aws', 'AwsRegionName'))
+        response = dynamo.query(TableName = config.get('aws', 'DynamoDBTableName'),
+                                IndexName='user_id_index',
+                                KeyConditionExpression='user_id = :user',
+                                ExpressionAttributeValues={':user':{'S': user}})
+        deserializer = TypeDeserializer()
+        items = sorted(({k: deserializer.deserialize(v) for k, v in item.items()} for item in response['Items']),
+                       key=lambda x: x['submit_time'])
+        current = dynamo.get_item(TableName=config.get('aws', 'DynamoDBTableName'),
+                                  Key={'job_id':{'S': job_id}},
+                                  ProjectionExpression='job_status',
+                                  ConsistentRead=True).get('Item')
+        for item in items:
+            if item['job_id'] == job_id and current:
+                item['job_status'] = current['job_status']['S']
+        if not items:
+            return
+        # The limit of the user's current plan (their latest job's role)
+        role = items[-1]['user_role']
+        limit = config.getint('admission', role, fallback=config.getint('admission', 'free_user'))
+        slots = limit - sum(1 for item in items if item['job_status'] in ('PENDING', 'RUNNING'))
+        for item in items:
+            if slots <= 0:
+                break
+            if item['job_status'] != 'DEFERRED':
+                continue
+            # One released concurrently by the web app takes a slot all the same
+            slots -= 1
+            if not set_job_status(dynamo, item['job_id'], 'PENDING', 'DEFERRED'):
+                continue
+            try:
+                publish_job_request(item, 'PENDING')
+            except Exception:
+                # Never leave a job PENDING with no request on the queue
+                set_job_status(dynamo, item['job_id'], 'DEFERRED', 'PENDING')
+                raise
+            update_user_stats(user, {'jobs_deferred': -1, 'jobs_pending': 1})
+            print(f'Released deferred job {item["job_id"]}')
+    except Exception as e:
+        print(e)
+
+def main(path, user, name, email, owner=None):
+    # Runs one job; called in a fresh process or one forked from the
+    # annotator's preloaded fork server (see reference.py)
+    dir_name, file_name, job_id = parse_path(path)
+    # SIGTERM (instance draining or spot interruption) stops the job at
+    # the end of the current chunk, after saving a checkpoint
+    draining = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: draining.set())
+    if update_dynamo_to_running(job_id, owner):
+        try:
+            # Live status for the web app's job pages
+            publish_to_sns({'job_id': job_id, 'user_id': user, 'job_status': 'RUNNING'})
+        except Exception as e:
+            print(e)
+        stop_heartbeat = threading.Event()
+        if owner:
+            threading.Thread(target=renew_lease, args=(job_id, owner, stop_heartbeat), daemon=True).start()
+        try:
+            with Timer():
+                finished = annotate(path, job_id, user, owner, draining)
+            if finished and upload_files(dir_name, file_name, job_id, user):  # upload files to S3
+                stop_heartbeat.set()
+                delete_checkpoint(job_id, user)
+                data = {'job_id': job_id, 'user_id': user, 'user_name': name, 'user_email': email,
+                        'job_status': 'COMPLETED'}
+                publish_to_sns(data)
+            elif finished:
+                # Results not uploaded or job not marked COMPLETED. The
+                # checkpoint stays, and the request message comes back (the
+                # annotator requeues a job that did not complete) for another
+                # run to resume from it.
+                stop_heartbeat.set()
+                shutil.rmtree(dir_name, ignore_errors=True)
+            else:
+                # Stopped at a checkpoint. The annotator drops our lease and puts
+                # the request message back on the queue; whoever claims it next
+                # resumes from the checkpoint. After a crash the message comes
+                # back by itself once its visibility lapses.
+                stop_heartbeat.set()
+                shutil.rmtree(dir_name, ignore_errors=True)
+        finally:
+            # Runs however the job ended, so a failure here can't leave the
+            # user's deferred jobs waiting for a completion that never comes
+            stop_heartbeat.set()
+            release_deferred_jobs(user, job_id)
+
 if __name__ == '__main__':
 # Call the AnnTools pipeline
     if len(sys.argv) > 1:
-        path, user, name, email = sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4]
-        dir_name, file_name, job_id = parse_path(path)
-        if update_dynamo_to_running(job_id):
-            with Timer():
-                driver.run(sys.argv[1], 'vcf')
-            upload_files(dir_name, file_name, job_id, user)  # upload files to S3
-            data = {'job_id': job_id, 'user_id': user, 'user_name': name, 'user_email': email}
-            publish_to_sns(data)
+        main(*sys.argv[1:6])
     else:
         print("A valid .vcf file must be provided as input to this program.")
 
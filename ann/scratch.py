@@ -0,0 +1,113 @@
+# scratch.py
+#
+# Scratch space for annotation jobs
+#
+# Every job works in its own directory under ResultPath (or, for small
+# inputs, an optional tmpfs). Space is reserved from the input's size
+# before anything is downloaded, so concurrent jobs can't fill the disk;
+# a job that doesn't fit is deferred. Directories left behind by failed or
+# killed jobs are reaped once nothing has touched them for a while.
+##
+
+import os
+import time
+import shutil
+import threading
+
+class ScratchSpace(object):
+    def __init__(self, config):
+        self.roots = [config.get('anntools', 'ResultPath')]
+        self.tmpfs = config.get('scratch', 'TmpfsPath', fallback='')
+        self.tmpfs_max_input = config.getint('scratch', 'TmpfsMaxInputBytes')
+        if self.tmpfs:
+            self.roots.append(self.tmpfs)
+        self.factor = config.getfloat('scratch', 'SpaceFactor')
+        self.min_free = config.getint('scratch', 'MinFreeBytes')
+        self.orphan_seconds = config.getint('scratch', 'OrphanSeconds')
+        # job_id -> (directory, bytes reserved)
+        self.reservations = {}
+        self.lock = threading.Lock()
+        for root in self.roots:
+            os.makedirs(root, exist_ok=True)
+
+    def reserved_bytes(self):
+        with self.lock:
+            return sum(size for _, size in self.reservations.values())
+
+    def _available(self, root):
+        # Free space less what running jobs on this root may still write
+        outstanding = sum(max(size - _usage(path), 0)
+                          for path, size in self.reservations.values()
+                          if os.path.dirname(path) == root)
+        return shutil.disk_usage(root).free - self.min_free - outstanding
+
+    def reserve(self, job_id, input_bytes):
+        # Returns the job's directory, or None if the job doesn't fit now.
+        # Input, chunk copies and annotated output take SpaceFactor times
+        # the input size between them.
+        needed = int(input_bytes * self.factor)
+        roots = self.roots[::-1] if self.tmpfs and input_bytes <= self.tmpfs_max_input \
+            else self.roots[:1]
+        with self.lock:
+            if job_id in self.reservations:
+                return self.reservations[job_id][0]
+            for root in roots:
+                if self._available(root) >= needed:
+                    path = os.path.join(root, job_id)
+                    os.makedirs(path, exist_ok=True)
+                    self.reservations[job_id] = (path, needed)
+                    return path
+        return None
+
+    def fits_anywhere(self, input_bytes):
+        # Whether the job could ever run here, given every root's total size
+        return any(shutil.disk_usage(root).total - self.min_free >= input_bytes * self.factor
+                   for root in self.roots)
+
+    def release(self, job_id):
+        # run.py removes its directory after a successful upload; anything
+        # still there belongs to a failed job
+        with self.lock:
+            path, _ = self.reservations.pop(job_id, (None, 0))
+        if path:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def reap_orphans(self):
+        # Remove job directories with no reservation that have not been
+        # written to for OrphanSeconds (a run.py may outlive an annotator
+        # restart, so recent directories are left alone)
+        cutoff = time.time() - self.orphan_seconds
+        with self.lock:
+            active = {path for path, _ in self.reservations.values()}
+        reaped = []
+        for root in self.roots:
+            for name in os.listdir(root):
+                path = os.path.join(root, name)
+                if path in active or not os.path.isdir(path):
+                    continue
+                if _last_modified(path) < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+                    reaped.append(path)
+        return reaped
+
+def _usage(path):
+    total = 0
+    for dir_path, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(dir_path, name))
+            except OSError:
+                pass
+    return total
+
+def _last_modified(path):
+    latest = os.path.getmtime(path)
+    for dir_path, _, files in os.walk(path):
+        for name in files:
+            try:
+                latest = max(latest, os.path.getmtime(os.path.join(dir_path, name)))
+            except OSError:
+                pass
+    return latest
+
+### EOF
@@ -13,10 +13,15 @@ def lambda_handler(event, context):
     # Some code about reading information from the event and context
     # variables goes here
     # Grab the user's email from the event and send the notification to them
+    response = None
     for record in event['Records']:
         payload = json.loads(record["body"])
         # logger.info(payload) # This is the payload that we get from the SQS queue for debugging
         message = json.loads(payload['Message'])
+        # The results topic also carries RUNNING updates; only completions
+        # get an email (older messages have no job_status)
+        if message.get('job_status', 'COMPLETED') != 'COMPLETED':
+            continue
         job_id = message['job_id']
         user_id = message['user_id']
         user_name = message['user_name']
@@ -0,0 +1,208 @@
+# ann_export.py
+#
+# NOTE: This file lives on the Utils instance
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Annotations table export and job latency/throughput report
+#
+# Scans the annotations table in parallel segments (one worker per
+# segment, each paging through its share of the table), streams the job
+# timing fields into a Parquet dataset with one file per segment, then
+# computes queue wait (submit -> start), run time (start -> complete) and
+# end-to-end latency percentiles, completions per hour and per-user volume
+# from it. Needs pyarrow. Run again with --skip-scan to re-analyse an
+# earlier export without touching DynamoDB.
+#
+# Example:
+#   python ann_export.py --days 7 --segments 32 --out /tmp/annotations
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import time
+import glob
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Get util configuration
+from configparser import SafeConfigParser
+config = SafeConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_config.ini'))
+
+# Only what the report needs is read from the table
+SCHEMA = pa.schema([
+  ('job_id', pa.string()),
+  ('user_id', pa.string()),
+  ('user_role', pa.string()),
+  ('job_status', pa.string()),
+  ('submit_time', pa.int64()),
+  ('start_time', pa.int64()),
+  ('complete_time', pa.int64()),
+  ('input_uncompressed_bytes', pa.int64()),
+  ('result_record_count', pa.int64()),
+  ('result_bytes', pa.int64()),
+])
+PERCENTILES = [50, 90, 95, 99]
+
+def attribute_value(value):
+  # Only string and number attributes are exported
+  if value is None:
+    return None
+  if 'S' in value:
+    return value['S']
+  if 'N' in value:
+    return int(float(value['N']))
+  return None
+
+"""Scan one segment of the table into its own Parquet file
+Rows are written a page (up to 1 MB of items) at a time, so memory stays
+flat however large the segment is. Returns the number of items written.
+"""
+def export_segment(dynamo, args, segment, since):
+  names = {f'#f{i}': field.name for i, field in enumerate(SCHEMA)}
+  scan = {
+    'TableName': config['export']['DynamoDBTableName'],
+    'Segment': segment,
+    'TotalSegments': args.segments,
+    'ProjectionExpression': ', '.join(names),
+    'ExpressionAttributeNames': names,
+    'FilterExpression': f"#f{SCHEMA.get_field_index('submit_time')} >= :since",
+    'ExpressionAttributeValues': {':since': {'N': str(since)}},
+  }
+  path = os.path.join(args.out, f'segment-{segment:04d}.parquet')
+  count = 0
+  with pq.ParquetWriter(path, SCHEMA, compression='zstd') as writer:
+    while True:
+      response = dynamo.scan(**scan)
+      if response['Items']:
+        columns = {field.name: [attribute_value(item.get(field.name))
+          for item in response['Items']] for field in SCHEMA}
+        writer.write_table(pa.Table.from_pydict(columns, schema=SCHEMA))
+        count += len(response['Items'])
+      if 'LastEvaluatedKey' not in response:
+        return count
+      scan['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def export(args, since):
+  # Replace an earlier export's segment files, and nothing else in --out
+  os.makedirs(args.out, exist_ok=True)
+  for path in glob.glob(os.path.join(args.out, 'segment-*.parquet')):
+    os.remove(path)
+  # One connection per segment worker (botocore keeps 10 by default)
+  dynamo = boto3.client('dynamodb', region_name=config['aws']['AwsRegionName'],
+    endpoint_url=args.endpoint_url, config=Config(max_pool_connections=args.segments))
+  with ThreadPoolExecutor(max_workers=args.segments) as pool:
+    counts = pool.map(lambda segment: export_segment(dynamo, args, segment, since),
+      range(args.segments))
+    return sum(counts)
+
+def percentiles(values):
+  values = values.drop_null()
+  if not len(values):
+    return dict.fromkeys([f'p{p}' for p in PERCENTILES] + ['max', 'count'])
+  quantiles = pc.quantile(values, q=[p / 100.0 for p in PERCENTILES],
+    interpolation='nearest').to_pylist()
+  report = {f'p{p}': q for p, q in zip(PERCENTILES, quantiles)}
+  report['max'] = pc.max(values).as_py()
+  report['count'] = len(values)
+  return report
+
+"""Latency percentiles, hourly throughput and per-user volume
+"""
+def analyze(args):
+  table = ds.dataset(sorted(glob.glob(os.path.join(args.out, 'segment-*.parquet'))),
+    format='parquet', schema=SCHEMA).to_table()
+  completed = table.filter(pc.equal(table['job_status'], 'COMPLETED'))
+
+  latency = {
+    'queue_wait': percentiles(pc.subtract(completed['start_time'], completed['submit_time'])),
+    'run_time': percentiles(pc.subtract(completed['complete_time'], completed['start_time'])),
+    'end_to_end': percentiles(pc.subtract(completed['complete_time'], completed['submit_time'])),
+  }
+
+  hours = pc.divide(completed['complete_time'], 3600)
+  hourly = pa.table({'hour': hours}).group_by('hour').aggregate([('hour', 'count')]) \
+    .sort_by('hour')
+  throughput = [{'hour': time.strftime('%Y-%m-%d %H:00', time.gmtime(hour * 3600)),
+    'completed': n} for hour, n in zip(hourly['hour'].to_pylist(), hourly['hour_count'].to_pylist())]
+
+  users = table.group_by('user_id').aggregate([
+    ('job_id', 'count'),
+    ('result_record_count', 'sum'),
+    ('result_bytes', 'sum'),
+    ('input_uncompressed_bytes', 'sum')]) \
+    .sort_by([('job_id_count', 'descending')])
+  per_user = [{'user_id': row['user_id'], 'jobs': row['job_id_count'],
+    'variants': row['result_record_count_sum'] or 0,
+    'result_bytes': row['result_bytes_sum'] or 0,
+    'input_bytes': row['input_uncompressed_bytes_sum'] or 0}
+    for row in users.slice(0, args.top_users).to_pylist()]
+
+  statuses = table.group_by('job_status').aggregate([('job_id', 'count')])
+  return {
+    'jobs': table.num_rows,
+    'by_status': dict(zip(statuses['job_status'].to_pylist(), statuses['job_id_count'].to_pylist())),
+    'latency_seconds': latency,
+    'throughput_per_hour': throughput,
+    'users': users.num_rows,
+    'top_users': per_user,
+  }
+
+def print_report(report):
+  print(f"Jobs: {report['jobs']} ({', '.join(f'{n} {s}' for s, n in sorted(report['by_status'].items()))})")
+  print(f"{'phase':<12} " + ' '.join(f"{'p' + str(p):>9}" for p in PERCENTILES) + f" {'max':>9}")
+  for name, stats in report['latency_seconds'].items():
+    cells = ['{:>9.0f}'.format(stats[k]) if stats[k] is not None else '{:>9}'.format('-')
+      for k in [f'p{p}' for p in PERCENTILES] + ['max']]
+    print(f"{name:<12} " + ' '.join(cells))
+  if report['throughput_per_hour']:
+    peak = max(report['throughput_per_hour'], key=lambda h: h['completed'])
+    total = sum(h['completed'] for h in report['throughput_per_hour'])
+    print(f"Throughput: {total / len(report['throughput_per_hour']):.1f} jobs/hour "
+      f"over {len(report['throughput_per_hour'])} active hours, peak {peak['completed']} at {peak['hour']}")
+  print(f"Users: {report['users']}; top by jobs:")
+  for user in report['top_users']:
+    print(f"  {user['user_id']}  {user['jobs']:>7} jobs  {user['variants']:>12} variants  "
+      f"{user['result_bytes'] / (1024 * 1024):>10.1f} MB results")
+
+def main():
+  parser = argparse.ArgumentParser(description='Annotations table export and job latency report')
+  parser.add_argument('--days', type=float, default=7, help='only jobs submitted in the last DAYS days')
+  parser.add_argument('--segments', type=int, default=config.getint('export', 'ScanSegments'),
+    help='parallel scan segments (one worker each)')
+  parser.add_argument('--out', default='/tmp/annotations_export',
+    help='directory for the Parquet dataset (its segment files are replaced on each export)')
+  parser.add_argument('--skip-scan', action='store_true', help='analyse an existing export in --out')
+  parser.add_argument('--top-users', type=int, default=20, help='users listed in the per-user table')
+  parser.add_argument('--endpoint-url', default=None, help='AWS endpoint for local stand-ins')
+  parser.add_argument('--json', metavar='PATH', default=None,
+    help='also write the report as JSON')
+  args = parser.parse_args()
+
+  if not args.skip_scan:
+    started = time.time()
+    count = export(args, int(time.time() - args.days * 86400))
+    print(f"Exported {count} jobs in {time.time() - started:.1f}s "
+      f"({args.segments} segments) to {args.out}")
+
+  report = analyze(args)
+  print_report(report)
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+  main()
+
+### EOF
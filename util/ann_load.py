@@ -0,0 +1,247 @@
+# ann_load.py
+#
+# NOTE: This file lives on the Utils instance
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Annotator load generator and end-to-end throughput benchmark
+#
+# Submits synthetic VCF jobs the same way the web app does (S3 upload,
+# DynamoDB item, SNS job request) and follows every job through the
+# annotator (query_ann_jobs -> run.py -> S3 upload -> DynamoDB/SNS) by
+# watching its DynamoDB item. Point it at local AWS stand-ins with
+# --endpoint-url; with --spawn-annotator the annotator is started against
+# the same endpoint (boto3 honours the AWS_ENDPOINT_URL variable).
+#
+# Example:
+#   python ann_load.py --jobs 50 --records 20000 --concurrency 8 \
+#     --endpoint-url http://localhost:4566 --spawn-annotator ../ann
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import resource
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+# Get util configuration
+from configparser import SafeConfigParser
+config = SafeConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_config.ini'))
+
+CHROMOSOMES = [str(c) for c in range(1, 23)] + ['X', 'Y']
+BASES = 'ACGT'
+LOAD_USER_ID = '00000000-0000-0000-0000-00000000a11d'
+
+"""Write a synthetic VCF with the given number of records
+"""
+def make_vcf(path, records, seed=None):
+  rng = random.Random(seed)
+  with open(path, 'w') as f:
+    f.write('##fileformat=VCFv4.1\n')
+    f.write('##source=ann_load.py\n')
+    f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+    pos = 0
+    for i in range(records):
+      pos += rng.randint(1, 5000)
+      ref = rng.choice(BASES)
+      alt = rng.choice(BASES.replace(ref, ''))
+      chrom = CHROMOSOMES[i * len(CHROMOSOMES) // records]
+      f.write(f'{chrom}\t{pos}\t.\t{ref}\t{alt}\t50\tPASS\t.\n')
+  return os.path.getsize(path)
+
+"""Percentile by nearest rank; values need not be sorted
+"""
+def percentile(values, pct):
+  if not values:
+    return None
+  ordered = sorted(values)
+  rank = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+  return ordered[min(rank, len(ordered) - 1)]
+
+def summarize(values):
+  return {
+    'count': len(values),
+    'p50': percentile(values, 50),
+    'p95': percentile(values, 95),
+    'p99': percentile(values, 99),
+    'max': max(values) if values else None,
+  }
+
+class LoadRun(object):
+  def __init__(self, args):
+    self.args = args
+    region = config['aws']['AwsRegionName']
+    self.s3 = boto3.client('s3', region_name=region, endpoint_url=args.endpoint_url)
+    self.sns = boto3.client('sns', region_name=region, endpoint_url=args.endpoint_url)
+    self.dynamo = boto3.resource('dynamodb', region_name=region, endpoint_url=args.endpoint_url)
+    self.table = self.dynamo.Table(config['load']['DynamoDBTableName'])
+    self.jobs = {}
+    self.load_samples = []
+
+  """Submit one job exactly as views.create_annotation_job_request does
+  """
+  def submit(self, index):
+    args = self.args
+    job_id = str(uuid.uuid4())
+    file_name = f'load_{index:05d}.vcf'
+    local_path = os.path.join(args.work_dir, f'{job_id}~{file_name}')
+    size = make_vcf(local_path, args.records, seed=index)
+
+    key = config['load']['S3KeyPrefix'] + LOAD_USER_ID + '/' + job_id + '~' + file_name
+    bucket = config['load']['S3InputsBucket']
+    started = time.time()
+    self.s3.upload_file(local_path, bucket, key)
+    uploaded = time.time()
+    os.remove(local_path)
+
+    data = {'user_id': LOAD_USER_ID,
+            'job_id': job_id,
+            'input_file_name': file_name,
+            's3_inputs_bucket': bucket,
+            's3_key_input_file': key,
+            'user_name': 'ann_load',
+            'user_email': 'ann_load@localhost',
+            'user_institution': 'ann_load',
+            'user_role': args.role}
+    item = dict(data, submit_time=int(uploaded), job_status='PENDING')
+    self.table.put_item(Item=item)
+    self.sns.publish(TopicArn=config['load']['SNSJobRequestTopic'],
+      Message=json.dumps(data), Subject='New Annotation Job Request',
+      # The request queues' SNS filter policies route on user_role
+      MessageAttributes={'user_role': {'DataType': 'String', 'StringValue': args.role}})
+    submitted = time.time()
+
+    self.jobs[job_id] = {'bytes_in': size, 'started': started,
+      'upload': uploaded - started, 'submitted': submitted}
+    return job_id
+
+  """Poll DynamoDB until every job completes (or the timeout passes),
+  recording when each job was first seen RUNNING and COMPLETED
+  """
+  def watch(self):
+    interval = config.getfloat('load', 'StatusPollInterval')
+    deadline = time.time() + self.args.timeout
+    outstanding = set(self.jobs)
+    while outstanding and time.time() < deadline:
+      self.load_samples.append(os.getloadavg()[0])
+      pending = list(outstanding)
+      # BatchGetItem takes at most 100 keys per call
+      for i in range(0, len(pending), 100):
+        keys = [{'job_id': job_id} for job_id in pending[i:i + 100]]
+        response = self.dynamo.batch_get_item(RequestItems={
+          self.table.name: {'Keys': keys,
+            'ProjectionExpression': 'job_id, job_status'}})
+        now = time.time()
+        for item in response['Responses'].get(self.table.name, []):
+          job = self.jobs[item['job_id']]
+          if item['job_status'] in ('RUNNING', 'COMPLETED'):
+            job.setdefault('running', now)
+          if item['job_status'] == 'COMPLETED':
+            job['completed'] = now
+            outstanding.discard(item['job_id'])
+      time.sleep(interval)
+    return outstanding
+
+  def report(self, wall, timed_out, annotator_usage):
+    done = [job for job in self.jobs.values() if 'completed' in job]
+    phases = {
+      'upload': [job['upload'] for job in self.jobs.values()],
+      'queue_wait': [job['running'] - job['submitted'] for job in done],
+      'run': [job['completed'] - job['running'] for job in done],
+      'end_to_end': [job['completed'] - job['started'] for job in done],
+    }
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+      'jobs': len(self.jobs),
+      'completed': len(done),
+      'timed_out': len(timed_out),
+      'records_per_job': self.args.records,
+      'bytes_in': sum(job['bytes_in'] for job in self.jobs.values()),
+      'wall_seconds': wall,
+      'jobs_per_second': len(done) / wall if wall else None,
+      'latency_seconds': {name: summarize(values) for name, values in phases.items()},
+      'resources': {
+        'loadavg_mean': sum(self.load_samples) / len(self.load_samples) if self.load_samples else None,
+        'loadavg_max': max(self.load_samples) if self.load_samples else None,
+        'generator_cpu_seconds': own.ru_utime + own.ru_stime,
+        'annotator': annotator_usage,
+      },
+    }
+
+"""Start annotator.py against the same endpoint as the load generator
+"""
+def spawn_annotator(ann_dir, endpoint_url):
+  env = dict(os.environ)
+  if endpoint_url:
+    env['AWS_ENDPOINT_URL'] = endpoint_url
+  return subprocess.Popen([sys.executable, 'annotator.py'], cwd=ann_dir, env=env)
+
+def stop_annotator(process):
+  process.terminate()
+  process.wait()
+  # Only includes run.py children the annotator itself has reaped
+  usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return {'cpu_seconds': usage.ru_utime + usage.ru_stime,
+    'max_rss_kb': usage.ru_maxrss}
+
+def print_report(report):
+  print(f"Jobs: {report['completed']}/{report['jobs']} completed "
+    f"({report['timed_out']} timed out), {report['records_per_job']} records each")
+  print(f"Wall time: {report['wall_seconds']:.2f}s  "
+    f"Throughput: {report['jobs_per_second'] or 0:.3f} jobs/sec")
+  print(f"{'phase':<12} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+  for name, stats in report['latency_seconds'].items():
+    cells = ['{:>9.3f}'.format(stats[k]) if stats[k] is not None else '{:>9}'.format('-')
+      for k in ('p50', 'p95', 'p99', 'max')]
+    print(f"{name:<12} " + ' '.join(cells))
+  print(f"Resources: {json.dumps(report['resources'])}")
+
+def main():
+  parser = argparse.ArgumentParser(description='Annotator load generator and throughput benchmark')
+  parser.add_argument('--jobs', type=int, default=10, help='number of jobs to submit')
+  parser.add_argument('--records', type=int, default=1000, help='variant records per synthetic VCF')
+  parser.add_argument('--concurrency', type=int, default=4, help='parallel job submitters')
+  parser.add_argument('--role', default='free_user', help='user_role attached to each job')
+  parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for completion')
+  parser.add_argument('--endpoint-url', default=None, help='AWS endpoint for local stand-ins')
+  parser.add_argument('--spawn-annotator', metavar='ANN_DIR', default=None,
+    help='start annotator.py from ANN_DIR for the duration of the run')
+  parser.add_argument('--work-dir', default='/tmp', help='where synthetic VCFs are written')
+  parser.add_argument('--json', metavar='PATH', default=None,
+    help='also write the report as JSON (for comparing runs)')
+  args = parser.parse_args()
+
+  run = LoadRun(args)
+  annotator = spawn_annotator(args.spawn_annotator, args.endpoint_url) \
+    if args.spawn_annotator else None
+
+  started = time.time()
+  try:
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+      list(pool.map(run.submit, range(args.jobs)))
+    timed_out = run.watch()
+  finally:
+    annotator_usage = stop_annotator(annotator) if annotator else None
+  wall = time.time() - started
+
+  report = run.report(wall, timed_out, annotator_usage)
+  print_report(report)
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+  main()
+
+### EOF
@@ -77,4 +77,20 @@ def get_user_profile(id=None, db_name=None):
   # Return user profile record as a dict
   return profile
 
+
+"""Adjust a user's job counters in the stats table
+deltas maps counter names (see web/user_stats.py) to amounts to add,
+e.g. {'archived_jobs': 1} when a job's results are archived.
+"""
+def update_user_stats(user_id, deltas, endpoint_url=None):
+  dynamo = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'],
+    endpoint_url=endpoint_url)
+  table = dynamo.Table(config['gas']['DynamoDBStatsTableName'])
+  names = [name for name, amount in deltas.items() if amount]
+  if not names:
+    return
+  table.update_item(Key={'user_id': user_id},
+    UpdateExpression='ADD ' + ', '.join(f'{name} :d{i}' for i, name in enumerate(names)),
+    ExpressionAttributeValues={f':d{i}': deltas[name] for i, name in enumerate(names)})
+
 ### EOF
\ No newline at end of file
@@ -9,6 +9,12 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import sys
+import json
+import time
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
 
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
@@ -17,8 +23,168 @@ import helpers
 # Get configuration
 from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
-config.read('notify_config.ini')
+config.read('restore_config.ini')
 
-# Add utility code here
+REGION = config.get('aws', 'AwsRegionName')
+ENDPOINT_URL = config.get('aws', 'EndpointUrl', fallback='') or None
 
-### EOF
\ No newline at end of file
+"""Find the user's jobs whose results still live only in Glacier
+Jobs that were never archived, or whose retrieval is already under way,
+are skipped so a repeated restore request is harmless. Jobs claimed by a
+run that never got as far as recording its retrieval are included.
+"""
+def get_archived_jobs(table, user_id):
+  query = {'IndexName': 'user_id_index',
+    'KeyConditionExpression': Key('user_id').eq(user_id)}
+  jobs = []
+  while True:
+    response = table.query(**query)
+    jobs += [item for item in response['Items'] if 'results_file_archive_id' in item
+      and item.get('restore_status', 'INITIATING') == 'INITIATING']
+    if 'LastEvaluatedKey' not in response:
+      return jobs
+    query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+"""Claim a job for this run before starting its retrieval
+Returns the job's attributes from before the claim, or None if another
+run holds it or has already recorded its retrieval. A claim older than
+ClaimSeconds belongs to a run that died, and may be taken over.
+"""
+def claim_job(table, job_id):
+  now = int(time.time())
+  try:
+    response = table.update_item(Key={'job_id': job_id},
+      UpdateExpression='SET restore_status = :initiating, restore_claim_time = :now',
+      ConditionExpression='attribute_not_exists(restore_status) OR '
+        '(restore_status = :initiating AND restore_claim_time < :stale)',
+      ExpressionAttributeValues={
+        ':initiating': 'INITIATING',
+        ':now': now,
+        ':stale': now - config.getint('restore', 'ClaimSeconds')},
+      ReturnValues='ALL_OLD')
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+      raise
+    return None
+  return response.get('Attributes', {})
+
+"""Retrieval already under way for an archive, if any
+A run that died after initiate_job but before recording the retrieval
+leaves one behind; picking it up avoids paying for a second.
+"""
+def find_retrieval(glacier, archive_id):
+  params = {'vaultName': config.get('aws', 'GlacierVaultName'), 'statuscode': 'InProgress'}
+  while True:
+    response = glacier.list_jobs(**params)
+    for job in response['JobList']:
+      if job.get('ArchiveId') == archive_id and job.get('Action') == 'ArchiveRetrieval':
+        return job['JobId']
+    if not response.get('Marker'):
+      return None
+    params['marker'] = response['Marker']
+
+"""Initiate a Glacier retrieval for one archived job
+Expedited retrievals are tried first; Glacier refuses them when it has no
+capacity, in which case we fall back to a Standard retrieval. The job is
+claimed in DynamoDB first, so a retried run never starts a retrieval that
+is already recorded; returns None for a job some other run has in hand.
+"""
+def initiate_retrieval(glacier, table, job):
+  previous = claim_job(table, job['job_id'])
+  if previous is None:
+    return None
+  retrieval_id = None
+  if previous.get('restore_status') == 'INITIATING':
+    retrieval_id = find_retrieval(glacier, job['results_file_archive_id'])
+  if retrieval_id is None:
+    try:
+      retrieval_id = start_retrieval(glacier, job)
+    except Exception:
+      # Nothing started; let the redelivered request try again straight away
+      table.update_item(Key={'job_id': job['job_id']},
+        UpdateExpression='REMOVE restore_status, restore_claim_time',
+        ConditionExpression='restore_status = :initiating',
+        ExpressionAttributeValues={':initiating': 'INITIATING'})
+      raise
+
+  # Record the retrieval so the web app can report progress and thaw.py
+  # can match its completion notification
+  table.update_item(Key={'job_id': job['job_id']},
+    UpdateExpression='SET restore_status = :restoring, restore_job_id = :rj '
+      'REMOVE restore_claim_time',
+    ConditionExpression='restore_status = :initiating',
+    ExpressionAttributeValues={
+      ':restoring': 'RESTORING',
+      ':initiating': 'INITIATING',
+      ':rj': retrieval_id})
+  return retrieval_id
+
+def start_retrieval(glacier, job):
+  params = {
+    'Type': 'archive-retrieval',
+    'ArchiveId': job['results_file_archive_id'],
+    'SNSTopic': config.get('aws', 'SNSThawTopic'),
+    'Description': job['job_id'],
+  }
+  try:
+    response = glacier.initiate_job(
+      vaultName=config.get('aws', 'GlacierVaultName'),
+      jobParameters=dict(params, Tier='Expedited'))
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'InsufficientCapacityException':
+      raise
+    response = glacier.initiate_job(
+      vaultName=config.get('aws', 'GlacierVaultName'),
+      jobParameters=dict(params, Tier='Standard'))
+  return response['jobId']
+
+"""Fan a single per-user restore request out into Glacier retrievals
+"""
+def handle_restore_request(glacier, table, data):
+  jobs = get_archived_jobs(table, data['user_id'])
+  if not jobs:
+    print(f"No archived results to restore for user {data['user_id']}")
+    return []
+
+  with ThreadPoolExecutor(max_workers=config.getint('restore', 'MaxWorkers')) as pool:
+    futures = [pool.submit(initiate_retrieval, glacier, table, job) for job in jobs]
+  # Surface the first failure so the message is redelivered; retrievals
+  # already recorded are skipped on the next attempt
+  retrieval_ids = [retrieval_id for retrieval_id in (future.result() for future in futures)
+    if retrieval_id]
+  # A job claimed by a run that has not recorded its retrieval yet (or
+  # died before it could) is taken over once the claim goes stale, so keep
+  # the request until then
+  if len(retrieval_ids) < len(jobs) and any(job.get('restore_status') == 'INITIATING'
+      for job in get_archived_jobs(table, data['user_id'])):
+    raise RuntimeError(f"Retrievals for user {data['user_id']} still being initiated")
+  print(f"Initiated {len(retrieval_ids)} retrievals for user {data['user_id']}")
+  return retrieval_ids
+
+def poll_restore_requests():
+  # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html
+  sqs = boto3.resource('sqs', region_name=REGION, endpoint_url=ENDPOINT_URL)
+  queue = sqs.Queue(config.get('aws', 'SQSRestoreQueueUrl'))
+  glacier = boto3.client('glacier', region_name=REGION, endpoint_url=ENDPOINT_URL)
+  dynamo = boto3.resource('dynamodb', region_name=REGION, endpoint_url=ENDPOINT_URL)
+  table = dynamo.Table(config.get('aws', 'DynamoDBTableName'))
+
+  while True:
+    messages = queue.receive_messages(
+      WaitTimeSeconds=config.getint('aws', 'SQSPollingWaitTime'))
+    for message in messages:
+      try:
+        sns_message = json.loads(message.body)
+        data = json.loads(sns_message['Message'])
+        handle_restore_request(glacier, table, data)
+      except Exception as e:
+        # Leave the message on the queue; it becomes visible again
+        # after the visibility timeout and is retried
+        print(f"Unable to process restore request: {e}")
+        continue
+      message.delete()
+
+if __name__ == '__main__':
+  poll_restore_requests()
+
+### EOF
@@ -9,6 +9,12 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import sys
+import json
+import time
+import boto3
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from botocore.exceptions import ClientError
 
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
@@ -17,8 +23,163 @@ import helpers
 # Get configuration
 from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
-config.read('notify_config.ini')
+config.read('thaw_config.ini')
 
-# Add utility code here
+REGION = config.get('aws', 'AwsRegionName')
+ENDPOINT_URL = config.get('aws', 'EndpointUrl', fallback='') or None
 
-### EOF
\ No newline at end of file
+"""Archives being thawed by this process
+Glacier (and SNS) may deliver the same completion more than once; a
+duplicate that arrives while the first copy is still being thawed is
+dropped rather than downloading the archive twice.
+"""
+class ArchiveClaims(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.archive_ids = set()
+
+  def claim(self, archive_id):
+    with self.lock:
+      if archive_id in self.archive_ids:
+        return False
+      self.archive_ids.add(archive_id)
+      return True
+
+  def release(self, archive_id):
+    with self.lock:
+      self.archive_ids.discard(archive_id)
+
+"""Mark a job's results as back in S3
+Conditional on the retrieval still being the one restore.py recorded, so
+a duplicate or stale notification never overwrites a newer state.
+Returns False if another thaw got there first.
+"""
+def mark_restored(table, job_id, retrieval_id):
+  try:
+    table.update_item(Key={'job_id': job_id},
+      UpdateExpression='SET restore_status = :restored, restore_time = :t '
+        'REMOVE results_file_archive_id, restore_job_id',
+      ConditionExpression='restore_status = :restoring AND restore_job_id = :rj',
+      ExpressionAttributeValues={
+        ':restored': 'RESTORED',
+        ':restoring': 'RESTORING',
+        ':rj': retrieval_id,
+        ':t': int(time.time())})
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+      raise
+    return False
+  return True
+
+"""Forget a failed retrieval so the user's next restore request retries it
+"""
+def reset_restore(table, job_id, retrieval_id):
+  try:
+    table.update_item(Key={'job_id': job_id},
+      UpdateExpression='REMOVE restore_status, restore_job_id',
+      ConditionExpression='restore_job_id = :rj',
+      ExpressionAttributeValues={':rj': retrieval_id})
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+      raise
+
+"""Copy one completed Glacier retrieval back to S3
+The notification's JobDescription is the GAS job id (set by restore.py).
+The archive is streamed straight from Glacier into the results bucket
+and deleted from the vault once the job record points back at S3.
+"""
+def thaw_archive(glacier, s3, table, notification):
+  job_id = notification['JobDescription']
+  retrieval_id = notification['JobId']
+  job = table.get_item(Key={'job_id': job_id}).get('Item')
+  if not job or job.get('restore_job_id') != retrieval_id:
+    print(f"Ignoring stale retrieval {retrieval_id} for job {job_id}")
+    return
+
+  if notification['StatusCode'] != 'Succeeded':
+    reset_restore(table, job_id, retrieval_id)
+    print(f"Retrieval for job {job_id} failed: {notification.get('StatusMessage')}")
+    return
+
+  vault = config.get('aws', 'GlacierVaultName')
+  response = glacier.get_job_output(vaultName=vault, jobId=retrieval_id)
+  s3.upload_fileobj(response['body'], job['s3_results_bucket'], job['s3_key_result_file'])
+  if mark_restored(table, job_id, retrieval_id):
+    glacier.delete_archive(vaultName=vault, archiveId=notification['ArchiveId'])
+    try:
+      # archived_jobs counts jobs ever archived, so it stays as it is
+      helpers.update_user_stats(job['user_id'], {'restored_jobs': 1},
+        endpoint_url=ENDPOINT_URL)
+    except ClientError as e:
+      print(f"Unable to update job stats for user {job['user_id']}: {e}")
+    print(f"Thawed results for job {job_id}")
+
+"""Handle one queued notification
+"""
+def handle_message(glacier, s3, table, claims, message):
+  sns_message = json.loads(message.body)
+  notification = json.loads(sns_message['Message'])
+  archive_id = notification['ArchiveId']
+  if not claims.claim(archive_id):
+    print(f"Archive {archive_id} is already being thawed")
+    return
+  try:
+    thaw_archive(glacier, s3, table, notification)
+  finally:
+    claims.release(archive_id)
+
+def poll_thaw_notifications():
+  # Reference: https://docs.aws.amazon.com/amazonglacier/latest/dev/configuring-notifications.html
+  sqs = boto3.resource('sqs', region_name=REGION, endpoint_url=ENDPOINT_URL)
+  queue = sqs.Queue(config.get('aws', 'SQSThawQueueUrl'))
+  glacier = boto3.client('glacier', region_name=REGION, endpoint_url=ENDPOINT_URL)
+  s3 = boto3.client('s3', region_name=REGION, endpoint_url=ENDPOINT_URL)
+  dynamo = boto3.resource('dynamodb', region_name=REGION, endpoint_url=ENDPOINT_URL)
+  table = dynamo.Table(config.get('aws', 'DynamoDBTableName'))
+
+  max_workers = config.getint('thaw', 'MaxWorkers')
+  visibility = config.getint('thaw', 'VisibilityTimeout')
+  claims = ArchiveClaims()
+  # future -> (message, time its visibility was last extended)
+  in_flight = {}
+  with ThreadPoolExecutor(max_workers=max_workers) as pool:
+    while True:
+      for future in [f for f in in_flight if f.done()]:
+        message, _ = in_flight.pop(future)
+        try:
+          future.result()
+          message.delete()
+        except Exception as e:
+          # Leave the message on the queue; it becomes visible again
+          # after the visibility timeout and is retried
+          print(f"Unable to thaw archive: {e}")
+
+      # Large archives can take longer to copy than the queue's visibility
+      # timeout; keep their messages hidden until they are done
+      now = time.time()
+      for future, (message, extended) in in_flight.items():
+        if now - extended >= visibility / 2:
+          try:
+            message.change_visibility(VisibilityTimeout=visibility)
+            in_flight[future] = (message, now)
+          except ClientError as e:
+            print(f"Unable to extend visibility of {message.message_id}: {e}")
+
+      if len(in_flight) >= max_workers:
+        wait(in_flight, timeout=visibility / 4, return_when=FIRST_COMPLETED)
+        continue
+
+      messages = queue.receive_messages(
+        MaxNumberOfMessages=min(max_workers - len(in_flight), 10),
+        VisibilityTimeout=visibility,
+        # Return promptly while thaws are running so finished ones are
+        # acknowledged without waiting out a long poll
+        WaitTimeSeconds=config.getint('aws', 'SQSPollingWaitTime') if not in_flight else 1)
+      for message in messages:
+        future = pool.submit(handle_message, glacier, s3, table, claims, message)
+        in_flight[future] = (message, time.time())
+
+if __name__ == '__main__':
+  poll_thaw_notifications()
+
+### EOF
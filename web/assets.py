@@ -0,0 +1,100 @@
+# assets.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Serve the fingerprinted static assets produced by build_static.py
+#
+# Templates call asset_url('css/style.css') instead of url_for('static').
+# When static/dist/manifest.json exists the URL points at the hashed copy
+# under /assets, served with far-future immutable caching and the best
+# precompressed variant the browser accepts; otherwise it falls back to
+# the plain /static file so development works without a build. Every
+# hashed file listed in files.json is served too: those kept from earlier
+# builds for pages rendered before the last restart, and (re-read when a
+# new build is swapped in) those of a build newer than this worker.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import mimetypes
+
+from flask import abort, request, send_from_directory, url_for
+from markupsafe import Markup
+
+# Precompressed variants, in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+class Assets(object):
+  def __init__(self, app):
+    self.dist_dir = os.path.join(app.static_folder, 'dist')
+    self.manifest = {}
+    manifest_path = os.path.join(self.dist_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+      with open(manifest_path) as f:
+        self.manifest = json.load(f)
+    else:
+      app.logger.info("No static asset manifest; serving unversioned /static files")
+    self.files = set(self.manifest.values())
+    self.files_mtime = None
+    self.refresh_files()
+    self.max_age = app.config['GAS_ASSET_MAX_AGE']
+
+  def url(self, logical_path):
+    if logical_path in self.manifest:
+      return url_for('asset', filename=self.manifest[logical_path])
+    return url_for('static', filename=logical_path)
+
+  """CSS background-image declarations for an image, preferring the WebP
+  variant where the build produced one and the browser supports it
+  """
+  def background(self, logical_path):
+    css = f"background-image: url({self.url(logical_path)});"
+    webp_path = os.path.splitext(logical_path)[0] + '.webp'
+    if webp_path in self.manifest:
+      css += (f" background-image: image-set(url({self.url(webp_path)}) type('image/webp'),"
+        f" url({self.url(logical_path)}) type('{mimetypes.guess_type(logical_path)[0]}'));")
+    return Markup(css)
+
+  def refresh_files(self):
+    path = os.path.join(self.dist_dir, 'files.json')
+    try:
+      mtime = os.stat(path).st_mtime
+    except OSError:
+      return
+    if mtime != self.files_mtime:
+      with open(path) as f:
+        self.files.update(json.load(f))
+      self.files_mtime = mtime
+
+  def send(self, filename):
+    # Only files named in a manifest are served; they never change
+    if filename not in self.files:
+      self.refresh_files()
+    if filename not in self.files:
+      return abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = None
+    for encoding, suffix in ENCODINGS:
+      if request.accept_encodings[encoding] and \
+        os.path.exists(os.path.join(self.dist_dir, filename + suffix)):
+        response = send_from_directory(self.dist_dir, filename + suffix,
+          mimetype=mimetype)
+        response.headers['Content-Encoding'] = encoding
+        break
+    if response is None:
+      response = send_from_directory(self.dist_dir, filename, mimetype=mimetype)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = f'public, max-age={self.max_age}, immutable'
+    return response
+
+def init_app(app):
+  assets = Assets(app)
+  app.jinja_env.globals['asset_url'] = assets.url
+  app.jinja_env.globals['asset_background'] = assets.background
+  app.add_url_rule('/assets/<path:filename>', 'asset', assets.send)
+  return assets
+
+### EOF
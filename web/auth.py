@@ -19,7 +19,9 @@ from flask import (flash, redirect, render_template, url_for,
 
 from globus_sdk import RefreshTokenAuthorizer, ConfidentialAppAuthClient
 
-from gas import app, db
+from flask import current_app as app
+
+from gas import bp, db
 from decorators import authenticated
 from helpers import (load_portal_client, get_portal_tokens,
   get_safe_redirect)
@@ -70,7 +72,7 @@ def update_profile(identity_id=None, name=None,
 
 """Logout from Globus Auth
 """
-@app.route('/logout', methods=['GET'])
+@bp.route('/logout', methods=['GET'])
 @authenticated
 def logout():
   client = load_portal_client()
@@ -90,7 +92,7 @@ def logout():
   app.logger.info(f"{session['name']} ({session['primary_identity']}) logged out")
   session.clear()
 
-  redirect_uri = url_for('home', _external=True)
+  redirect_uri = url_for('gas.home', _external=True)
 
   logout_url = []
   logout_url.append(app.config['GLOBUS_AUTH_LOGOUT_URI'])
@@ -103,7 +105,7 @@ def logout():
 
 """User profile information; assocated with a Globus Auth identity
 """
-@app.route('/profile', methods=['GET', 'POST'])
+@bp.route('/profile', methods=['GET', 'POST'])
 @authenticated
 def profile():
   identity_id = session.get('primary_identity')
@@ -138,30 +140,30 @@ def profile():
     create_profile(identity_id=identity_id,
       name=session['name'],
       email=session['email'])
-    #session['next'] = url_for('annotate')
+    #session['next'] = url_for('gas.annotate')
 
   if 'next' in session:
     redirect_to = session['next']
     session.pop('next')
   else:
-    redirect_to = url_for('profile')
+    redirect_to = url_for('gas.profile')
 
   return redirect(redirect_to)
 
 
 """Handle interaction with Globus Auth
 """
-@app.route('/authcallback', methods=['GET'])
+@bp.route('/authcallback', methods=['GET'])
 def authcallback():
   # If we're coming back from Globus Auth in an error state, the error
   # will be in the "error" query string parameter
   if 'error' in request.args:
     flash("GAS login failed: " +
       request.args.get('error_description', request.args['error']))
-    return redirect(url_for('home'))
+    return redirect(url_for('gas.home'))
 
   # Set up our Globus Auth/OAuth2 state
-  redirect_uri = url_for('authcallback', _external=True)
+  redirect_uri = url_for('gas.authcallback', _external=True)
 
   client = load_portal_client()
   client.oauth2_start_flow(redirect_uri, refresh_tokens=True)
@@ -208,11 +210,11 @@ def authcallback():
         redirect_to = session['next']
         session.pop('next')
       else:
-        redirect_to = url_for('annotations_list')
+        redirect_to = url_for('gas.annotations_list')
 
       return redirect(redirect_to)
 
     else:
-      return redirect(url_for('profile', next=url_for('annotate')))
+      return redirect(url_for('gas.profile', next=url_for('gas.annotate')))
 
 ### EOF
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# bench_templates.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Template benchmark: measures what a cold worker pays to compile the GAS
+# templates with and without the bytecode cache, and the per-page render
+# time with and without fragment caching. Uses the load_gas app, so no AWS
+# or database access is needed.
+#
+# Example:
+#   python bench_templates.py --iterations 2000
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import time
+import uuid
+import shutil
+import argparse
+import tempfile
+import statistics
+
+from flask import render_template, session
+from jinja2 import Environment, FileSystemBytecodeCache
+
+import load_gas
+
+app = load_gas.create_app()
+
+def sample_pages():
+  job_id = str(uuid.uuid4())
+  annotation = {'job_id': job_id, 'submit_time': '2020-05-01 @ 12:00:00',
+    'input_file_name': 'test.vcf', 'input_file_url': 'https://example.com/test.vcf',
+    'job_status': 'COMPLETED', 'complete_time': '2020-05-01 @ 12:05:00',
+    'result_file_url': 'https://example.com/test.annot.vcf'}
+  return [
+    ('home.html', {}),
+    ('annotate.html', {'s3_post': {'url': 'https://example.com/',
+      'fields': {'key': 'x', 'policy': 'y', 'x-amz-signature': 'z'}}}),
+    ('annotations.html', {'annotations': [dict(annotation, job_id=str(uuid.uuid4()))
+      for i in range(20)]}),
+    ('annotation_details.html', {'annotation': annotation}),
+  ]
+
+"""Seconds to load and compile every page template in a fresh environment
+(as a new gunicorn worker would), optionally through a bytecode cache
+"""
+def cold_compile(bytecode_cache=None):
+  env = Environment(loader=app.jinja_env.loader, bytecode_cache=bytecode_cache,
+    autoescape=True)
+  env.globals.update(app.jinja_env.globals)
+  started = time.perf_counter()
+  for name in env.list_templates():
+    env.get_template(name)
+  return time.perf_counter() - started
+
+def render_times(pages, iterations):
+  times = {}
+  with app.test_request_context('/'):
+    session.update({'is_authenticated': True, 'name': 'Load Test', 'role': 'free_user'})
+    for name, context in pages:
+      render_template(name, **context)
+      samples = []
+      for i in range(iterations):
+        started = time.perf_counter()
+        render_template(name, **context)
+        samples.append(time.perf_counter() - started)
+      times[name] = statistics.median(samples)
+  return times
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark GAS template caching")
+  parser.add_argument('--iterations', type=int, default=1000)
+  parser.add_argument('--compile-rounds', type=int, default=20)
+  args = parser.parse_args()
+
+  cache_dir = tempfile.mkdtemp(prefix='gas-jinja-')
+  try:
+    cache = FileSystemBytecodeCache(cache_dir)
+    cold_compile(cache)
+    no_cache = min(cold_compile() for i in range(args.compile_rounds))
+    with_cache = min(cold_compile(cache) for i in range(args.compile_rounds))
+  finally:
+    shutil.rmtree(cache_dir, ignore_errors=True)
+  print(f"Cold template load: {no_cache * 1000:.1f} ms compiling, "
+    f"{with_cache * 1000:.1f} ms from bytecode cache ({no_cache / with_cache:.1f}x)")
+
+  pages = sample_pages()
+  fragments = app.extensions['gas_fragments']
+  fragments.enabled = False
+  uncached = render_times(pages, args.iterations)
+  fragments.enabled = True
+  fragments.invalidate()
+  cached = render_times(pages, args.iterations)
+
+  print(f"\n{'page':<26}{'no fragments':>14}{'fragments':>12}{'speedup':>9}")
+  for name, context in pages:
+    print(f"{name:<26}{uncached[name] * 1e6:>11.0f} us{cached[name] * 1e6:>9.0f} us"
+      f"{uncached[name] / cached[name]:>8.1f}x")
+
+if __name__ == '__main__':
+  main()
+
+### EOF
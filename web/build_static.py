@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+# build_static.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Builds fingerprinted, precompressed static assets for the GAS
+#
+# Copies every file in static/ to static/dist/ under a content-hashed name
+# (css/style.css -> css/style.<hash>.css), rewrites url() references in
+# CSS to the hashed names, writes .gz (and .br, if the brotli package is
+# installed) variants of text assets, and, if Pillow is installed, emits
+# resized/recompressed JPEG and WebP versions of the images. The mapping
+# from logical to hashed paths goes to static/dist/manifest.json, which
+# assets.py reads at startup.
+#
+# Each build is written to a fresh static/.dist-* directory and swapped in
+# by atomically replacing the static/dist symlink, so a rolling restart
+# never sees a half-built tree. The hashed files of the last KEEP_BUILDS
+# builds are carried forward (listed in static/dist/files.json), so pages
+# rendered by workers still on an older build keep loading their assets.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import re
+import gzip
+import json
+import shutil
+import hashlib
+import tempfile
+import posixpath
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+STATIC_DIR = os.path.join(basedir, 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+BUILD_PREFIX = '.dist-'
+# Builds whose hashed files stay servable, counting the new one
+KEEP_BUILDS = 3
+
+# Only text formats benefit from compression; fonts/images are already packed
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ico', '.json', '.txt')
+OPTIMIZABLE_IMAGES = ('.jpg', '.jpeg', '.png')
+# Widest image we ever need to serve (backgrounds span the viewport)
+MAX_IMAGE_WIDTH = 1920
+CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+def fingerprint(logical_path, data):
+  digest = hashlib.sha256(data).hexdigest()[:12]
+  root, ext = posixpath.splitext(logical_path)
+  return f'{root}.{digest}{ext}'
+
+def write(build_dir, logical_path, data, manifest):
+  hashed = fingerprint(logical_path, data)
+  target = os.path.join(build_dir, hashed)
+  os.makedirs(os.path.dirname(target), exist_ok=True)
+  with open(target, 'wb') as f:
+    f.write(data)
+  if logical_path.endswith(COMPRESSIBLE):
+    with open(target + '.gz', 'wb') as f:
+      f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli:
+      with open(target + '.br', 'wb') as f:
+        f.write(brotli.compress(data, quality=11))
+  manifest[logical_path] = hashed
+
+"""Re-encode an image no wider than MAX_IMAGE_WIDTH; returns
+{logical_path: bytes} for the optimized original format and WebP
+"""
+def optimize_image(logical_path, data):
+  image = Image.open(io.BytesIO(data))
+  if image.width > MAX_IMAGE_WIDTH:
+    height = round(image.height * MAX_IMAGE_WIDTH / image.width)
+    image = image.resize((MAX_IMAGE_WIDTH, height), Image.LANCZOS)
+
+  variants = {}
+  root, ext = posixpath.splitext(logical_path)
+  out = io.BytesIO()
+  if ext in ('.jpg', '.jpeg'):
+    image.convert('RGB').save(out, 'JPEG', quality=82, optimize=True, progressive=True)
+  else:
+    image.save(out, 'PNG', optimize=True)
+  # Never replace an original with something larger
+  variants[logical_path] = min(out.getvalue(), data, key=len)
+
+  out = io.BytesIO()
+  image.save(out, 'WEBP', quality=80, method=6)
+  variants[root + '.webp'] = out.getvalue()
+  return variants
+
+"""Point url() references at hashed files; leaves anything not in the
+manifest (external URLs, data: URIs, missing files) alone
+"""
+def rewrite_css(logical_path, css, manifest):
+  def replace(match):
+    quote = match.group(1)
+    path, suffix = re.match(r'([^?#]*)(.*)', match.group(2)).groups()
+    resolved = posixpath.normpath(posixpath.join(posixpath.dirname(logical_path), path))
+    if resolved not in manifest:
+      return match.group(0)
+    relative = posixpath.relpath(manifest[resolved], posixpath.dirname(logical_path))
+    return f'url({quote}{relative}{suffix}{quote})'
+  return CSS_URL.sub(replace, css)
+
+"""Copy the hashed files (and their compressed variants) of earlier builds
+into the new one; returns the file lists of the builds kept, newest first
+"""
+def carry_forward(build_dir, files):
+  builds = [sorted(files)]
+  builds_path = os.path.join(DIST_DIR, 'builds.json')
+  manifest_path = os.path.join(DIST_DIR, 'manifest.json')
+  if os.path.exists(builds_path):
+    with open(builds_path) as f:
+      previous = json.load(f)
+  elif os.path.exists(manifest_path):
+    # A build from before builds.json was kept
+    with open(manifest_path) as f:
+      previous = [sorted(json.load(f).values())]
+  else:
+    return builds
+  for hashed_files in previous[:KEEP_BUILDS - 1]:
+    for hashed in hashed_files:
+      for suffix in ('', '.gz', '.br'):
+        source = os.path.join(DIST_DIR, hashed + suffix)
+        target = os.path.join(build_dir, hashed + suffix)
+        if os.path.exists(source) and not os.path.exists(target):
+          os.makedirs(os.path.dirname(target), exist_ok=True)
+          shutil.copy2(source, target)
+    builds.append(hashed_files)
+  return builds
+
+"""Point static/dist at build_dir in one step, then drop build directories
+no longer referenced (the one just replaced stays, for requests under way)
+"""
+def swap_in(build_dir):
+  if os.path.isdir(DIST_DIR) and not os.path.islink(DIST_DIR):
+    # Left by a build from before dist became a symlink
+    os.rename(DIST_DIR, tempfile.mkdtemp(prefix=BUILD_PREFIX, dir=STATIC_DIR) + '/old')
+  previous = os.path.realpath(DIST_DIR) if os.path.islink(DIST_DIR) else None
+  link = os.path.join(STATIC_DIR, BUILD_PREFIX + 'link')
+  if os.path.lexists(link):
+    os.remove(link)
+  os.symlink(os.path.basename(build_dir), link)
+  os.replace(link, DIST_DIR)
+  for name in os.listdir(STATIC_DIR):
+    path = os.path.join(STATIC_DIR, name)
+    if name.startswith(BUILD_PREFIX) and os.path.isdir(path) and not os.path.islink(path) \
+        and path not in (build_dir, previous):
+      shutil.rmtree(path, ignore_errors=True)
+
+def build():
+  build_dir = tempfile.mkdtemp(prefix=BUILD_PREFIX, dir=STATIC_DIR)
+  os.chmod(build_dir, 0o755)
+  manifest = {}
+  sources = []
+  for root, dirs, files in os.walk(STATIC_DIR):
+    dirs[:] = [d for d in dirs if root != STATIC_DIR or
+      (d != 'dist' and not d.startswith(BUILD_PREFIX))]
+    for name in files:
+      path = os.path.join(root, name)
+      sources.append(os.path.relpath(path, STATIC_DIR).replace(os.sep, '/'))
+
+  # CSS goes last so every file it references already has a hashed name
+  for logical_path in sorted(sources, key=lambda p: (p.endswith('.css'), p)):
+    with open(os.path.join(STATIC_DIR, logical_path), 'rb') as f:
+      data = f.read()
+    if logical_path.endswith('.css'):
+      css = rewrite_css(logical_path, data.decode('utf-8'), manifest)
+      write(build_dir, logical_path, css.encode('utf-8'), manifest)
+    elif Image and logical_path.lower().endswith(OPTIMIZABLE_IMAGES):
+      for variant_path, variant in optimize_image(logical_path, data).items():
+        write(build_dir, variant_path, variant, manifest)
+    else:
+      write(build_dir, logical_path, data, manifest)
+
+  builds = carry_forward(build_dir, manifest.values())
+  with open(os.path.join(build_dir, 'manifest.json'), 'w') as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+  with open(os.path.join(build_dir, 'builds.json'), 'w') as f:
+    json.dump(builds, f, indent=2)
+  with open(os.path.join(build_dir, 'files.json'), 'w') as f:
+    json.dump(sorted(set().union(*builds)), f, indent=2)
+  swap_in(build_dir)
+  return manifest
+
+if __name__ == '__main__':
+  manifest = build()
+  print(f"Built {len(manifest)} assets into {DIST_DIR}"
+    f"{'' if brotli else ' (brotli not installed; gzip only)'}"
+    f"{'' if Image else ' (Pillow not installed; images copied as-is)'}")
+
+### EOF
@@ -12,6 +12,7 @@ import os
 import json
 import boto3
 import base64
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -23,10 +24,25 @@ class Config(object):
     if ('GAS_LOG_FILE_PATH' in os.environ) else "/log")
   GAS_LOG_FILE_NAME = os.environ['GAS_LOG_FILE_NAME'] \
     if ('GAS_LOG_FILE_NAME' in os.environ) else "gas.log"
+  # 'json' writes one JSON object per line (with request ID); 'text' is
+  # the classic single-line format
+  GAS_LOG_FORMAT = os.environ['GAS_LOG_FORMAT'] \
+    if ('GAS_LOG_FORMAT' in os.environ) else "text"
+  GAS_LOG_FILE_MAX_BYTES = 50 * 1024 * 1024
+  GAS_LOG_FILE_BACKUP_COUNT = 10
+  # Fraction of requests whose DEBUG records are kept
+  GAS_LOG_DEBUG_SAMPLE_RATE = float(os.environ['GAS_LOG_DEBUG_SAMPLE_RATE']) \
+    if ('GAS_LOG_DEBUG_SAMPLE_RATE' in os.environ) else 1.0
 
   WSGI_SERVER = 'werkzeug'
   CSRF_ENABLED = True
 
+  # Add a Server-Timing header (aws/db/render/total) to every response
+  GAS_SERVER_TIMING = (os.environ['GAS_SERVER_TIMING'] == 'true') \
+    if ('GAS_SERVER_TIMING' in os.environ) else False
+  # Addresses allowed to scrape /metrics
+  GAS_METRICS_ALLOWED_IPS = ['127.0.0.1']
+
   GAS_HOST_IP = os.environ['GAS_HOST_IP']
   GAS_HOST_PORT = int(os.environ['GAS_HOST_PORT'])
   GAS_APP_HOST = os.environ['GAS_APP_HOST']
@@ -37,44 +53,11 @@ class Config(object):
   AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] \
     if ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
-  # Get various credentials from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-
-  # Get Flask application secret
-  try:
-    asm_response = asm.get_secret_value(SecretId='gas/web_server')
-    flask_secret = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    print(f"Unable to retrieve Flask secret from ASM: {e}")
-    raise e
-  SECRET_KEY = flask_secret['flask_secret_key']
-
-  # Get RDS secret and construct database URI
-  try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    print(f"Unable to retrieve accounts database credentials from ASM: {e}")
-    raise e
-
+  # SECRET_KEY, SQLALCHEMY_DATABASE_URI and the Globus Auth client
+  # credentials come from AWS Secrets Manager; see load_secrets()
   SQLALCHEMY_DATABASE_TABLE = os.environ['ACCOUNTS_DATABASE_TABLE']
-  SQLALCHEMY_DATABASE_URI = "postgresql://" + \
-    rds_secret['username'] + ':' + rds_secret['password'] + \
-    '@' + rds_secret['host'] + ':' + str(rds_secret['port']) + \
-    '/' + SQLALCHEMY_DATABASE_TABLE
   SQLALCHEMY_TRACK_MODIFICATIONS = True
 
-  # Get the Globus Auth client ID and secret
-  try:
-    asm_response = asm.get_secret_value(SecretId='globus/auth_client')
-    globus_auth = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    print(f"Unable to retrieve Globus Auth credentials from ASM: {e}")
-    raise e
-
-  # Set the Globus Auth client ID and secret
-  GAS_CLIENT_ID = globus_auth['gas_client_id']
-  GAS_CLIENT_SECRET = globus_auth['gas_client_secret']
   GLOBUS_AUTH_LOGOUT_URI = "https://auth.globus.org/v2/web/logout"
 
   # Set validity of pre-signed POST requests (in seconds)
@@ -94,10 +77,19 @@ class Config(object):
   AWS_SNS_JOB_REQUEST_TOPIC = \
     "arn:aws:sns:us-east-1:659248683008:gaoyunl1_job_requests"
   AWS_SNS_JOB_COMPLETE_TOPIC = \
-    "some-arn-job-results:gaoyunl1_job_results"
+    "arn:aws:sns:us-east-1:659248683008:gaoyunl1_job_results"
+  AWS_SNS_JOB_RESTORE_TOPIC = \
+    "arn:aws:sns:us-east-1:659248683008:gaoyunl1_job_restore"
+
+  # Optional endpoint override so SNS/SQS can point at a local stand-in
+  # (e.g. localstack) when testing
+  AWS_ENDPOINT_URL = os.environ['AWS_ENDPOINT_URL'] \
+    if ('AWS_ENDPOINT_URL' in os.environ) else None
 
   # Change the table name to your own
   AWS_DYNAMODB_ANNOTATIONS_TABLE = "gaoyunl1_annotations"
+  # Per-user job counters (partition key user_id); see user_stats.py
+  AWS_DYNAMODB_USER_STATS_TABLE = "gaoyunl1_user_stats"
 
   # Change the email address to your username
   MAIL_DEFAULT_SENDER = "gaoyunl1@mpcs-cc.com"
@@ -105,6 +97,105 @@ class Config(object):
   # Time before free user results are archived (in seconds)
   FREE_USER_DATA_RETENTION = 300
 
+  # Maximum number of PENDING/RUNNING jobs per user, by profile role;
+  # further submissions are held as DEFERRED until earlier jobs complete
+  GAS_MAX_INFLIGHT_JOBS = {'free_user': 3, 'premium_user': 10}
+
+  # Compiled template cache shared by all workers, and the in-process
+  # cache of rendered nav/header/footer fragments
+  GAS_TEMPLATE_CACHE_DIR = basedir + "/cache/jinja"
+  GAS_TEMPLATE_FRAGMENT_CACHE = True
+  GAS_TEMPLATE_FRAGMENT_CACHE_SIZE = 1000
+
+  # Cache lifetime (in seconds) for fingerprinted assets under /assets
+  GAS_ASSET_MAX_AGE = 31536000
+
+  # How long (in seconds) browsers may reuse a completed job's detail page
+  GAS_COMPLETED_JOB_MAX_AGE = 3600
+
+  # Most compressed result data one region query may read from S3
+  GAS_REGION_MAX_BYTES = 64 * 1024 * 1024
+
+  # Number of genes listed in a job's variant summary
+  GAS_SUMMARY_TOP_GENES = 50
+
+  # Uploads are checked before dispatch by reading this many bytes and
+  # validating up to this many records
+  GAS_PREFLIGHT_BYTES = 256 * 1024
+  GAS_PREFLIGHT_RECORDS = 100
+
+  # Most jobs one batch submission may contain, and how many uploads of a
+  # batch are pre-flight checked at once
+  GAS_BATCH_MAX_JOBS = 500
+  GAS_BATCH_CHECK_WORKERS = 16
+
+  # Files larger than GAS_MULTIPART_THRESHOLD are uploaded by the browser
+  # in parallel parts (of at least GAS_MULTIPART_PART_SIZE), with part URLs
+  # valid for GAS_MULTIPART_URL_EXPIRATION seconds
+  GAS_MULTIPART_THRESHOLD = 100 * 1024 * 1024
+  GAS_MULTIPART_PART_SIZE = 16 * 1024 * 1024
+  GAS_MULTIPART_URL_EXPIRATION = 3600
+  GAS_MULTIPART_CONCURRENCY = 4
+
+  # Job status event streams (seconds, except retry in milliseconds):
+  # how often each worker re-reads watched jobs from DynamoDB when it has
+  # a status feed and when it does not, keepalive interval, how long one
+  # stream stays open, and browser reconnect delay
+  GAS_JOB_EVENTS_RECONCILE_INTERVAL = 60
+  GAS_JOB_EVENTS_POLL_INTERVAL = 5
+  GAS_JOB_EVENTS_HEARTBEAT = 15
+  GAS_JOB_EVENTS_MAX_DURATION = 300
+  GAS_JOB_EVENTS_RETRY = 5000
+  # Streams open at once per worker; each holds a gthread thread, so keep
+  # this well below the worker's thread count (gunicorn.conf.py)
+  GAS_JOB_EVENTS_MAX_STREAMS = 16
+  # Name prefix of the per-worker SQS queues that receive job status
+  # changes from the job request and results topics (see job_events.py);
+  # empty to poll DynamoDB instead. The instance role needs to create,
+  # delete and read SQS queues and to subscribe to and unsubscribe from
+  # both topics.
+  GAS_JOB_EVENTS_QUEUE_PREFIX = os.environ['GAS_JOB_EVENTS_QUEUE_PREFIX'] \
+    if ('GAS_JOB_EVENTS_QUEUE_PREFIX' in os.environ) else "gaoyunl1_job_events_"
+
+  # Interval (in milliseconds) between restore progress polls on the
+  # subscription confirmation page
+  GAS_RESTORE_PROGRESS_INTERVAL = 5000
+
+"""Fill in the settings held in AWS Secrets Manager
+Called by create_app() rather than when this module is imported, so the
+lookups happen once per app (in the gunicorn master under --preload) and
+run concurrently instead of one after another.
+"""
+def load_secrets(config):
+  secret_ids = {'flask': 'gas/web_server', 'globus': 'globus/auth_client'}
+  # Allow a local accounts database to be substituted (e.g. for load tests)
+  if ('GAS_DATABASE_URI' not in os.environ):
+    secret_ids['rds'] = 'rds/accounts_database'
+
+  asm = boto3.client('secretsmanager', region_name=config['AWS_REGION_NAME'])
+  def get_secret(name):
+    try:
+      asm_response = asm.get_secret_value(SecretId=secret_ids[name])
+    except ClientError as e:
+      print(f"Unable to retrieve {secret_ids[name]} from ASM: {e}")
+      raise e
+    return json.loads(asm_response['SecretString'])
+  with ThreadPoolExecutor(max_workers=len(secret_ids)) as pool:
+    secrets = dict(zip(secret_ids, pool.map(get_secret, secret_ids)))
+
+  config['SECRET_KEY'] = secrets['flask']['flask_secret_key']
+  if 'rds' in secrets:
+    rds_secret = secrets['rds']
+    config['SQLALCHEMY_DATABASE_URI'] = "postgresql://" + \
+      rds_secret['username'] + ':' + rds_secret['password'] + \
+      '@' + rds_secret['host'] + ':' + str(rds_secret['port']) + \
+      '/' + config['SQLALCHEMY_DATABASE_TABLE']
+  else:
+    config['SQLALCHEMY_DATABASE_URI'] = os.environ['GAS_DATABASE_URI']
+  # Set the Globus Auth client ID and secret
+  config['GAS_CLIENT_ID'] = secrets['globus']['gas_client_id']
+  config['GAS_CLIENT_SECRET'] = secrets['globus']['gas_client_secret']
+
 class DevelopmentConfig(Config):
   DEBUG = True
   GAS_LOG_LEVEL = 'DEBUG'
@@ -112,6 +203,7 @@ class DevelopmentConfig(Config):
 class ProductionConfig(Config):
   DEBUG = False
   GAS_LOG_LEVEL = 'INFO'
+  GAS_LOG_FORMAT = 'json'
   WSGI_SERVER = 'gunicorn.error'
 
 class StagingConfig(Config):
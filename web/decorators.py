@@ -20,13 +20,13 @@ def authenticated(fn):
   @wraps(fn)
   def decorated_function(*args, **kwargs):
     if not session.get('is_authenticated'):
-      return redirect(url_for('login', next=request.url))
+      return redirect(url_for('gas.login', next=request.url))
 
     if request.path == '/logout':
       return fn(*args, **kwargs)
 
     if (not session.get('name') or not session.get('email')):
-      return redirect(url_for('profile', next=request.url))
+      return redirect(url_for('gas.profile', next=request.url))
 
     return fn(*args, **kwargs)
 
@@ -42,10 +42,10 @@ def is_premium(fn):
     profile = db.session.query(Profile).filter_by(identity_id=session.get('primary_identity')).first()
     if not profile:
       # Force login
-      return redirect(url_for('login', next=request.url))
+      return redirect(url_for('gas.login', next=request.url))
     elif (profile.role != "premium_user"):
       # Redirect free user to subscribe
-      return redirect(url_for('subscribe', next=request.url))
+      return redirect(url_for('gas.subscribe', next=request.url))
 
     return fn(*args, **kwargs)
 
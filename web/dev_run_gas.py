@@ -10,9 +10,10 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
-from gas import app
+from gas import create_app
 
 if __name__ == '__main__':
+  app = create_app()
   app.run(
     host=app.config['GAS_APP_HOST'],
     port=app.config['GAS_HOST_PORT'],
@@ -5,6 +5,7 @@
 #
 # Configure GAS runtime environment
 # Setup loggers, create DB connection, import all GAS packages
+# (create_app() is the app factory; gunicorn serves 'gas:create_app()')
 #
 # ************************************************************************
 #
@@ -17,60 +18,70 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import json
 import os
 
-from flask import Flask
+from flask import Blueprint, Flask
 from flask_sqlalchemy import SQLAlchemy
-
-app = Flask(__name__)
-app.config.from_object(os.environ['GAS_SETTINGS'])
-app.url_map.strict_slashes = False
-
-# Configure logging
-import logging
-from logging.handlers import RotatingFileHandler
-
-# Set up a rotating file handler to write log messages to a file
-if not os.path.exists(app.config['GAS_LOG_FILE_PATH']):
-  os.makedirs(app.config['GAS_LOG_FILE_PATH'])
-log_file = app.config['GAS_LOG_FILE_PATH'] + "/" + app.config['GAS_LOG_FILE_NAME']
-log_file_handler = RotatingFileHandler(log_file, maxBytes=500000, backupCount=9)
-
-# Set up a stream handler to write log messages to the console
-log_stream_handler = logging.StreamHandler()
-
-# Set the appropriate log level and format for log lines
-if (app.config['GAS_LOG_LEVEL'] == 'INFO'):
-  log_format = '%(asctime)s %(levelname)s: %(message)s '
-  log_file_handler.setLevel(logging.INFO)
-  log_stream_handler.setLevel(logging.INFO)
-elif (app.config['GAS_LOG_LEVEL'] == 'DEBUG'):
-  log_format = '%(asctime)s %(levelname)s: %(message)s ''[in %(pathname)s:%(lineno)d]'
-  log_file_handler.setLevel(logging.DEBUG)
-  log_stream_handler.setLevel(logging.DEBUG)
-
-log_file_handler.setFormatter(logging.Formatter(log_format))
-log_stream_handler.setFormatter(logging.Formatter(log_format))
-
-# Create the WSGI server (werkzeug, gunicorn, etc.) logger
-logger = logging.getLogger(app.config['WSGI_SERVER'])
-
-# Add the log handlers to the server logger
-logger.addHandler(log_file_handler)
-logger.addHandler(log_stream_handler)
-
-# Tell the Flask app's logger to use our log handlers also
-app.logger.addHandler(log_file_handler)
-app.logger.addHandler(log_stream_handler)
-
-# Tell the Flask app logger to write to the WSGI server logger
-app.logger.handlers = logger.handlers
-
-# Set the app log level to the same as the WSGI server's log level
-app.logger.setLevel(logger.level)
-
-# Add database handle to the Flask app
-db = SQLAlchemy(app)
-
-import views
-import auth
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool
+
+import config
+
+# Database handle; bound to the app in create_app()
+db = SQLAlchemy()
+
+# The GAS routes (views.py, auth.py) are registered on this blueprint as
+# those modules are imported; create_app() attaches it to each app
+bp = Blueprint('gas', __name__)
+
+# Pooled connections record the process that opened them. One checked out
+# in a different process was inherited across a fork (e.g. from the
+# gunicorn master with --preload) and shares its socket with the parent,
+# so it is discarded and a fresh connection opened instead.
+@event.listens_for(Pool, 'connect')
+def _record_connection_pid(dbapi_connection, connection_record):
+  connection_record.info['pid'] = os.getpid()
+
+@event.listens_for(Pool, 'checkout')
+def _check_connection_pid(dbapi_connection, connection_record, connection_proxy):
+  if connection_record.info['pid'] != os.getpid():
+    connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+    raise exc.DisconnectionError(
+      f"Connection belongs to process {connection_record.info['pid']}")
+
+"""Build the GAS app
+Safe to run once in the gunicorn master (--preload) and share with every
+worker: AWS clients are created per call, the job status poller starts
+on first use, the log listener thread is restarted after fork, and
+database connections never cross a fork (above). Each call returns a new,
+independent app; the routes come from the shared blueprint.
+"""
+def create_app():
+  app = Flask(__name__)
+  app.config.from_object(os.environ['GAS_SETTINGS'])
+  config.load_secrets(app.config)
+  app.url_map.strict_slashes = False
+
+  # Configure logging; handlers run on a background thread, fed by a queue
+  import gas_logging
+  gas_logging.init_app(app)
+
+  # Add database handle to the Flask app
+  db.init_app(app)
+
+  # Time routes and the AWS/DB/template work done within them
+  import instrumentation
+  instrumentation.init_app(app)
+
+  # Fingerprinted static assets built by build_static.py
+  import assets
+  assets.init_app(app)
+
+  # Shared template bytecode cache and fragment caching
+  import templating
+  templating.init_app(app)
+
+  import views
+  import auth
+  app.register_blueprint(bp)
+  return app
 
 ### EOF
\ No newline at end of file
@@ -0,0 +1,156 @@
+# gas_logging.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Non-blocking logging for the GAS web app
+#
+# Request threads only put log records on an in-memory queue; a listener
+# thread in each worker writes them to the rotating log file and console.
+# The file is flushed once per batch (whenever the queue runs dry) rather
+# than after every line. Lines can be written as JSON objects tagged with
+# the request ID, and DEBUG output can be sampled per request so turning
+# it on in production doesn't flood the log.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import re
+import json
+import uuid
+import queue
+import atexit
+import random
+import logging
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from flask import g, has_request_context, request
+
+# IDs passed in by a load balancer or client are kept only if they look sane
+REQUEST_ID = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+"""Rotating file handler that leaves flushing to the queue listener, so a
+burst of records reaches the disk in one write
+"""
+class BatchedRotatingFileHandler(RotatingFileHandler):
+  def flush(self):
+    pass
+
+  def flush_batch(self):
+    RotatingFileHandler.flush(self)
+
+class BatchingQueueListener(QueueListener):
+  def dequeue(self, block):
+    # Everything queued so far has been handled; write it out before
+    # waiting for more
+    if self.queue.empty():
+      self.flush()
+    return self.queue.get(block)
+
+  def flush(self):
+    for handler in self.handlers:
+      getattr(handler, 'flush_batch', handler.flush)()
+
+  def stop(self):
+    if self._thread:
+      QueueListener.stop(self)
+      self.flush()
+
+"""Tags records with the current request's ID and drops DEBUG records
+from requests that weren't sampled
+"""
+class RequestFilter(logging.Filter):
+  def __init__(self, debug_sample_rate):
+    logging.Filter.__init__(self)
+    self.debug_sample_rate = debug_sample_rate
+
+  def filter(self, record):
+    if has_request_context():
+      record.request_id = g.get('request_id', '-')
+      sampled = g.get('log_sampled', True)
+    else:
+      record.request_id = '-'
+      sampled = random.random() < self.debug_sample_rate
+    return record.levelno > logging.DEBUG or sampled
+
+class JsonFormatter(logging.Formatter):
+  def __init__(self, include_location=False):
+    logging.Formatter.__init__(self)
+    self.include_location = include_location
+
+  def format(self, record):
+    entry = {
+      'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+      'level': record.levelname,
+      'logger': record.name,
+      'request_id': getattr(record, 'request_id', '-'),
+      'message': record.getMessage()
+    }
+    if self.include_location:
+      entry['location'] = f'{record.pathname}:{record.lineno}'
+    return json.dumps(entry)
+
+"""Set up queue-based logging for the app and the WSGI server logger;
+returns the listener thread that does the actual writing
+"""
+def init_app(app):
+  level = getattr(logging, app.config['GAS_LOG_LEVEL'])
+  debug = (level == logging.DEBUG)
+
+  os.makedirs(app.config['GAS_LOG_FILE_PATH'], exist_ok=True)
+  log_file = app.config['GAS_LOG_FILE_PATH'] + "/" + app.config['GAS_LOG_FILE_NAME']
+  log_file_handler = BatchedRotatingFileHandler(log_file,
+    maxBytes=app.config['GAS_LOG_FILE_MAX_BYTES'],
+    backupCount=app.config['GAS_LOG_FILE_BACKUP_COUNT'])
+  log_stream_handler = logging.StreamHandler()
+
+  if app.config['GAS_LOG_FORMAT'] == 'json':
+    formatter = JsonFormatter(include_location=debug)
+  else:
+    formatter = logging.Formatter('%(asctime)s %(levelname)s [%(request_id)s]: %(message)s '
+      + ('[in %(pathname)s:%(lineno)d]' if debug else ''))
+  for handler in (log_file_handler, log_stream_handler):
+    handler.setLevel(level)
+    handler.setFormatter(formatter)
+
+  log_queue = queue.SimpleQueue()
+  queue_handler = QueueHandler(log_queue)
+  queue_handler.setLevel(level)
+  queue_handler.addFilter(RequestFilter(app.config['GAS_LOG_DEBUG_SAMPLE_RATE']))
+
+  listener = BatchingQueueListener(log_queue, log_file_handler, log_stream_handler,
+    respect_handler_level=True)
+  listener.start()
+  atexit.register(listener.stop)
+
+  # A forked child (gunicorn --preload) gets neither the listener thread
+  # nor a usable queue lock; give it its own
+  def restart_in_child():
+    listener.queue = queue_handler.queue = queue.SimpleQueue()
+    listener._thread = None
+    listener.start()
+  os.register_at_fork(after_in_child=restart_in_child)
+
+  # Both the WSGI server's logger and the app's log through the queue
+  logger = logging.getLogger(app.config['WSGI_SERVER'])
+  logger.addHandler(queue_handler)
+  app.logger.handlers = [queue_handler]
+  app.logger.setLevel(logger.level or level)
+
+  @app.before_request
+  def assign_request_id():
+    request_id = request.headers.get('X-Request-ID', '')
+    g.request_id = request_id if REQUEST_ID.match(request_id) else uuid.uuid4().hex
+    g.log_sampled = random.random() < app.config['GAS_LOG_DEBUG_SAMPLE_RATE']
+
+  @app.after_request
+  def return_request_id(response):
+    if 'request_id' in g:
+      response.headers['X-Request-ID'] = g.request_id
+    return response
+
+  return listener
+
+### EOF
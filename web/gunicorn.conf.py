@@ -0,0 +1,24 @@
+# gunicorn.conf.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Gunicorn settings shared by run_gas.sh and load_test.py, so load tests
+# measure the worker model that is deployed
+#
+# Workers are threaded (gthread): each open job status event stream holds
+# a thread, so GUNICORN_THREADS must stay well above
+# GAS_JOB_EVENTS_MAX_STREAMS. The app is built once in the master and
+# shared with every worker (see gas.create_app()). The worker count and
+# bind address are given on the command line.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+preload_app = True
+
+### EOF
@@ -21,7 +21,9 @@ try:
 except:
   from urlparse import urlparse, urljoin
 
-from gas import app, db
+from flask import current_app as app
+
+from gas import db
 
 """Create an AuthClient for the GAS app
 """
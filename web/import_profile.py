@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# import_profile.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Import-time profile of the GAS app
+#
+# Imports the app module (gas by default) and runs its create_app() in a
+# fresh interpreter under python -X importtime, then reports the total
+# time along with the packages and modules that account for most of it.
+# This is what each gunicorn worker pays at boot without --preload, and
+# what the master pays once with it. Use --module load_gas to profile
+# against the local fakes without AWS access.
+#
+# Example:
+#   GAS_LOAD_STATE_DIR=/tmp/gas-load python import_profile.py --module load_gas
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from collections import Counter
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+"""Import module and build its app in a fresh interpreter; returns (wall
+seconds, rows) where rows are (self us, cumulative us, depth, module name)
+in import order
+"""
+def profile_import(module):
+  code = ('import time; started = time.perf_counter(); '
+    f'import {module}; {module}.create_app(); print(time.perf_counter() - started)')
+  result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+    cwd=basedir, capture_output=True, text=True)
+  if result.returncode != 0:
+    raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+  rows = []
+  for line in result.stderr.splitlines():
+    if not line.startswith('import time:') or line.endswith('imported package'):
+      continue
+    self_us, cumulative_us, name = line[len('import time:'):].split('|')
+    if not self_us.strip().isdigit():
+      continue
+    # Nesting is shown by two spaces of indent per level
+    depth = (len(name) - len(name.lstrip()) - 1) // 2
+    rows.append((int(self_us), int(cumulative_us), depth, name.strip()))
+  return float(result.stdout.strip().splitlines()[-1]), rows
+
+def report(module, top):
+  wall, rows = profile_import(module)
+  packages = Counter()
+  for self_us, _, _, name in rows:
+    packages[name.split('.')[0]] += self_us
+  # GAS's own modules, by cumulative time (what each one pulls in)
+  local = {os.path.splitext(f)[0] for f in os.listdir(basedir) if f.endswith('.py')}
+  return {
+    'module': module,
+    'wall_seconds': wall,
+    'modules_imported': len(rows),
+    'top_packages': [{'package': name, 'self_ms': us / 1000}
+      for name, us in packages.most_common(top)],
+    'gas_modules': [{'module': name, 'cumulative_ms': cumulative / 1000}
+      for _, cumulative, _, name in sorted(rows, key=lambda row: -row[1])
+      if name in local][:top],
+  }
+
+def print_report(report):
+  print(f"import {report['module']}: {report['wall_seconds'] * 1000:.0f} ms, "
+    f"{report['modules_imported']} modules")
+  print(f"{'package':<24} {'self ms':>9}")
+  for entry in report['top_packages']:
+    print(f"{entry['package']:<24} {entry['self_ms']:>9.1f}")
+  print(f"{'GAS module':<24} {'cumul ms':>9}")
+  for entry in report['gas_modules']:
+    print(f"{entry['module']:<24} {entry['cumulative_ms']:>9.1f}")
+
+def main():
+  parser = argparse.ArgumentParser(description='Import-time profile of the GAS app')
+  parser.add_argument('--module', default='gas', help='module to import (e.g. load_gas)')
+  parser.add_argument('--top', type=int, default=15, help='entries listed per table')
+  parser.add_argument('--json', metavar='PATH', default=None,
+    help='also write the report as JSON')
+  args = parser.parse_args()
+
+  result = report(args.module, args.top)
+  print_report(result)
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(result, f, indent=2)
+
+if __name__ == '__main__':
+  main()
+
+### EOF
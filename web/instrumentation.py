@@ -0,0 +1,182 @@
+# instrumentation.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Per-request latency instrumentation for the GAS
+#
+# Records a latency histogram per route, and times every botocore API call,
+# SQLAlchemy statement and Jinja render made while handling a request.
+# Results are served in Prometheus text format at /metrics and, when
+# GAS_SERVER_TIMING is set, summarized in a Server-Timing response header.
+# Metrics are kept per process; each gunicorn worker reports its own.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import time
+import threading
+
+import boto3
+from flask import (Response, abort, before_render_template, g,
+  has_request_context, request, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+"""Latency histogram with one series per combination of label values
+"""
+class Histogram(object):
+  def __init__(self, name, help_text, label_names):
+    self.name = name
+    self.help_text = help_text
+    self.label_names = label_names
+    self.series = {}
+    self.lock = threading.Lock()
+
+  def observe(self, labels, value):
+    with self.lock:
+      buckets, total, count = self.series.get(labels,
+        ([0] * len(LATENCY_BUCKETS), 0.0, 0))
+      buckets = [n + (1 if value <= bound else 0)
+        for n, bound in zip(buckets, LATENCY_BUCKETS)]
+      self.series[labels] = (buckets, total + value, count + 1)
+
+  def render(self):
+    lines = [f'# HELP {self.name} {self.help_text}',
+      f'# TYPE {self.name} histogram']
+    with self.lock:
+      series = sorted(self.series.items())
+    for labels, (buckets, total, count) in series:
+      label_text = ','.join(f'{name}="{value}"'
+        for name, value in zip(self.label_names, labels))
+      for bound, n in zip(LATENCY_BUCKETS, buckets):
+        lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {n}')
+      lines.append(f'{self.name}_bucket{{{label_text},le="+Inf"}} {count}')
+      lines.append(f'{self.name}_sum{{{label_text}}} {total}')
+      lines.append(f'{self.name}_count{{{label_text}}} {count}')
+    return lines
+
+request_latency = Histogram('gas_request_duration_seconds',
+  'Request latency by route', ['route', 'method', 'status'])
+aws_latency = Histogram('gas_aws_call_duration_seconds',
+  'botocore API call latency during requests', ['service', 'operation'])
+db_latency = Histogram('gas_db_query_duration_seconds',
+  'SQLAlchemy statement latency during requests', ['route'])
+render_latency = Histogram('gas_template_render_duration_seconds',
+  'Jinja template render latency', ['template'])
+
+"""Add time spent in one dependency to the current request's breakdown
+"""
+def _add_timing(category, seconds):
+  if has_request_context():
+    timings = g.setdefault('gas_timings', {})
+    timings[category] = timings.get(category, 0.0) + seconds
+
+def _route():
+  return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+# botocore: before-call/after-call bracket each API call (retries included);
+# the per-call context dict carries the start time between them
+def _before_aws_call(context=None, **kwargs):
+  if context is not None:
+    context['gas_started'] = time.perf_counter()
+
+def _after_aws_call(model=None, context=None, **kwargs):
+  if not context or 'gas_started' not in context:
+    return
+  elapsed = time.perf_counter() - context.pop('gas_started')
+  if has_request_context():
+    aws_latency.observe((model.service_model.service_name, model.name), elapsed)
+    _add_timing('aws', elapsed)
+
+def _after_aws_error(context=None, **kwargs):
+  if context and 'gas_started' in context and has_request_context():
+    _add_timing('aws', time.perf_counter() - context.pop('gas_started'))
+
+
+# SQLAlchemy: cursor execute events on every engine
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  conn.info.setdefault('gas_started', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  elapsed = time.perf_counter() - conn.info['gas_started'].pop()
+  if has_request_context():
+    db_latency.observe((_route(),), elapsed)
+    _add_timing('db', elapsed)
+
+# after_cursor_execute never fires for a statement that raises; drop its
+# start time so later statements on the pooled connection pop their own
+def _handle_db_error(context):
+  conn = context.connection
+  if conn is not None and conn.info.get('gas_started'):
+    elapsed = time.perf_counter() - conn.info['gas_started'].pop()
+    if has_request_context():
+      _add_timing('db', elapsed)
+
+
+# Jinja: Flask signals fire around render_template (not nested includes)
+def _before_render(sender, template, context, **extra):
+  g.gas_render_started = time.perf_counter()
+
+def _after_render(sender, template, context, **extra):
+  started = g.pop('gas_render_started', None)
+  if started is not None:
+    elapsed = time.perf_counter() - started
+    render_latency.observe((template.name,), elapsed)
+    _add_timing('render', elapsed)
+
+
+def render_metrics():
+  lines = []
+  for histogram in (request_latency, aws_latency, db_latency, render_latency):
+    lines.extend(histogram.render())
+  return '\n'.join(lines) + '\n'
+
+"""Install request timing, dependency hooks and the /metrics endpoint
+"""
+def init_app(app):
+  if boto3.DEFAULT_SESSION is None:
+    boto3.setup_default_session()
+  events = boto3.DEFAULT_SESSION.events
+  events.register('before-call', _before_aws_call)
+  events.register('after-call', _after_aws_call)
+  events.register('after-call-error', _after_aws_error)
+
+  event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+  event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+  event.listen(Engine, 'handle_error', _handle_db_error)
+
+  before_render_template.connect(_before_render, app)
+  template_rendered.connect(_after_render, app)
+
+  @app.before_request
+  def start_request_timer():
+    g.gas_request_started = time.perf_counter()
+
+  @app.after_request
+  def record_request_timing(response):
+    started = g.pop('gas_request_started', None)
+    if started is None:
+      return response
+    elapsed = time.perf_counter() - started
+    request_latency.observe((_route(), request.method, str(response.status_code)), elapsed)
+    if app.config.get('GAS_SERVER_TIMING'):
+      timings = g.get('gas_timings', {})
+      entries = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings.items()]
+      entries.append(f'total;dur={elapsed * 1000:.1f}')
+      response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+  @app.route('/metrics', methods=['GET'])
+  def metrics():
+    # Only the monitoring agent on the instance itself may scrape
+    if request.remote_addr not in app.config['GAS_METRICS_ALLOWED_IPS']:
+      return abort(403)
+    return Response(render_metrics(),
+      mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+### EOF
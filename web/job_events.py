@@ -0,0 +1,340 @@
+# job_events.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Live job status updates for Server-Sent Events streams
+#
+# Each worker process keeps one JobStatusHub. Every open event stream
+# subscribes to the jobs it shows; status changes published inside the
+# worker reach subscribers immediately. Changes made elsewhere arrive on
+# a per-worker SQS queue (JobStatusFeed) subscribed to the job request
+# topic (new and released jobs, from any web worker or run.py) and the
+# job results topic (RUNNING and COMPLETED, from run.py), so each
+# transition is published once and read once per worker, however many
+# browsers are connected. A stream of all of a user's jobs also hears
+# about jobs the user submits while it is open.
+#
+# DynamoDB is only the fallback: one batched read of the watched jobs
+# every GAS_JOB_EVENTS_RECONCILE_INTERVAL catches anything the feed
+# missed, or every GAS_JOB_EVENTS_POLL_INTERVAL when there is no feed
+# (GAS_JOB_EVENTS_QUEUE_PREFIX empty, or the queue could not be set up).
+# Without the feed, jobs submitted through other workers are not seen.
+#
+# An open stream holds one of the worker's threads (gthread) until it
+# ends, so each worker serves at most GAS_JOB_EVENTS_MAX_STREAMS at once;
+# the rest are turned away with a 503 and try again later, leaving
+# threads free for ordinary requests.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import re
+import json
+import time
+import atexit
+import socket
+import threading
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+from flask import current_app as app
+
+# Terminal state; streams stop watching a job once it gets here
+FINAL_STATUS = 'COMPLETED'
+
+class JobStatusHub(object):
+  def __init__(self):
+    self.condition = threading.Condition()
+    self.statuses = {}
+    self.watchers = {}
+    # user_id -> {job_id: status} of every job the user is known to have,
+    # for streams of all of their jobs; and how many such streams are open
+    self.user_jobs = {}
+    self.user_watchers = {}
+    self.streams = 0
+    self.poller = None
+
+  """Take one of the worker's stream slots; False if all are in use
+  """
+  def open_stream(self):
+    with self.condition:
+      if self.streams >= app.config['GAS_JOB_EVENTS_MAX_STREAMS']:
+        return False
+      self.streams += 1
+      return True
+
+  def close_stream(self):
+    with self.condition:
+      self.streams -= 1
+
+  """Record a job's current status and wake every stream watching it, or
+  watching its user (user_id) for new jobs
+  """
+  def publish(self, job_id, status, user_id=None):
+    with self.condition:
+      changed = False
+      if job_id in self.watchers and self.statuses.get(job_id) != status:
+        self.statuses[job_id] = status
+        changed = True
+      jobs = self.user_jobs.get(user_id)
+      if jobs is not None and job_id not in jobs:
+        jobs[job_id] = status
+        changed = True
+      if changed:
+        self.condition.notify_all()
+
+  def subscribe(self, statuses):
+    with self.condition:
+      for job_id, status in statuses.items():
+        self.watchers[job_id] = self.watchers.get(job_id, 0) + 1
+        self.statuses.setdefault(job_id, status)
+      self._start_poller()
+
+  def subscribe_user(self, user_id, statuses):
+    with self.condition:
+      self.user_watchers[user_id] = self.user_watchers.get(user_id, 0) + 1
+      jobs = self.user_jobs.setdefault(user_id, {})
+      for job_id, status in statuses.items():
+        jobs.setdefault(job_id, status)
+      self._start_poller()
+
+  def unsubscribe_user(self, user_id):
+    with self.condition:
+      self.user_watchers[user_id] -= 1
+      if not self.user_watchers[user_id]:
+        del self.user_watchers[user_id]
+        del self.user_jobs[user_id]
+
+  def _start_poller(self):
+    # Started lazily so the thread belongs to the worker, not the
+    # gunicorn master; it has no app context, so it is handed the app
+    if self.poller is None or not self.poller.is_alive():
+      self.poller = threading.Thread(target=self._poll,
+        args=(app._get_current_object(),), daemon=True)
+      self.poller.start()
+
+  def unsubscribe(self, job_ids):
+    with self.condition:
+      for job_id in job_ids:
+        self.watchers[job_id] -= 1
+        if not self.watchers[job_id]:
+          del self.watchers[job_id]
+          self.statuses.pop(job_id, None)
+
+  """Block until any of the known statuses changes, user_id has a job not
+  in seen, or the timeout passes; returns the changed jobs and the new jobs
+  (both empty on timeout)
+  """
+  def wait(self, known, timeout, user_id=None, seen=()):
+    def changes():
+      changed = {job_id: self.statuses[job_id] for job_id, status in known.items()
+        if self.statuses.get(job_id, status) != status}
+      new = {job_id: status for job_id, status in self.user_jobs.get(user_id, {}).items()
+        if job_id not in seen} if user_id else {}
+      return changed, new
+    with self.condition:
+      self.condition.wait_for(lambda: any(changes()), timeout)
+      return changes()
+
+  def _poll(self, app):
+    feed = JobStatusFeed(app) if app.config['GAS_JOB_EVENTS_QUEUE_PREFIX'] else None
+    if feed and not feed.open():
+      feed = None
+    last_read = time.time()
+    while True:
+      interval = app.config['GAS_JOB_EVENTS_RECONCILE_INTERVAL' if feed
+        else 'GAS_JOB_EVENTS_POLL_INTERVAL']
+      if feed:
+        try:
+          for job_id, status, user_id in feed.receive(
+              min(20, max(int(last_read + interval - time.time()), 0))):
+            self.publish(job_id, status, user_id)
+        except (BotoCoreError, ClientError) as e:
+          app.logger.error(f"Job status feed failed, polling DynamoDB instead: {e}")
+          feed.close()
+          feed = None
+      else:
+        time.sleep(max(last_read + interval - time.time(), 0))
+      if time.time() - last_read >= interval:
+        last_read = time.time()
+        self._read_statuses(app)
+
+  """Read the current status of every watched job from DynamoDB
+  """
+  def _read_statuses(self, app):
+    dynamo = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    table_name = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
+    with self.condition:
+      job_ids = list(self.watchers)
+    # BatchGetItem takes at most 100 keys per call
+    for i in range(0, len(job_ids), 100):
+      try:
+        response = dynamo.batch_get_item(RequestItems={table_name: {
+          'Keys': [{'job_id': job_id} for job_id in job_ids[i:i + 100]],
+          'ProjectionExpression': 'job_id, job_status'}})
+      except ClientError as e:
+        app.logger.error(f"Unable to poll job statuses: {e}")
+        continue
+      for item in response['Responses'].get(table_name, []):
+        self.publish(item['job_id'], item['job_status'])
+
+job_status_hub = JobStatusHub()
+
+
+"""A worker's own SQS queue, subscribed to the job request and job results
+topics with raw message delivery
+The queue is named after the host and process ID. It is removed when the
+worker exits, and queues left on this host by workers that died are
+removed when the next one starts. Messages are kept only briefly, since
+statuses older than that are caught by the DynamoDB fallback anyway.
+"""
+class JobStatusFeed(object):
+  def __init__(self, app):
+    self.app = app
+    self.sqs = boto3.client('sqs', region_name=app.config['AWS_REGION_NAME'],
+      endpoint_url=app.config['AWS_ENDPOINT_URL'])
+    self.sns = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'],
+      endpoint_url=app.config['AWS_ENDPOINT_URL'])
+    self.topics = [app.config['AWS_SNS_JOB_REQUEST_TOPIC'],
+      app.config['AWS_SNS_JOB_COMPLETE_TOPIC']]
+    host = re.sub(r'[^A-Za-z0-9_-]', '-', socket.gethostname().split('.')[0])
+    self.prefix = f"{app.config['GAS_JOB_EVENTS_QUEUE_PREFIX']}{host}-"[:70]
+    self.queue_url = None
+    self.subscriptions = []
+
+  def open(self):
+    try:
+      self._remove_stale()
+      self.queue_url = self.sqs.create_queue(QueueName=f'{self.prefix}{os.getpid()}',
+        Attributes={'MessageRetentionPeriod': '60'})['QueueUrl']
+      queue_arn = self._queue_arn(self.queue_url)
+      self.sqs.set_queue_attributes(QueueUrl=self.queue_url, Attributes={'Policy': json.dumps({
+        'Version': '2012-10-17',
+        'Statement': [{'Effect': 'Allow', 'Principal': {'Service': 'sns.amazonaws.com'},
+          'Action': 'sqs:SendMessage', 'Resource': queue_arn,
+          'Condition': {'ArnEquals': {'aws:SourceArn': self.topics}}}]})})
+      for topic in self.topics:
+        self.subscriptions.append(self.sns.subscribe(TopicArn=topic, Protocol='sqs',
+          Endpoint=queue_arn, Attributes={'RawMessageDelivery': 'true'},
+          ReturnSubscriptionArn=True)['SubscriptionArn'])
+    except (BotoCoreError, ClientError) as e:
+      self.app.logger.error(f"Unable to set up job status feed, polling DynamoDB instead: {e}")
+      self.close()
+      return False
+    atexit.register(self.close)
+    return True
+
+  def close(self):
+    try:
+      for subscription in self.subscriptions:
+        self.sns.unsubscribe(SubscriptionArn=subscription)
+      if self.queue_url:
+        self.sqs.delete_queue(QueueUrl=self.queue_url)
+    except (BotoCoreError, ClientError) as e:
+      self.app.logger.error(f"Unable to remove job status feed queue: {e}")
+    self.subscriptions, self.queue_url = [], None
+
+  """Wait up to wait seconds for messages; yields (job_id, status, user_id)
+  """
+  def receive(self, wait):
+    messages = self.sqs.receive_message(QueueUrl=self.queue_url,
+      MaxNumberOfMessages=10, WaitTimeSeconds=wait).get('Messages', [])
+    if messages:
+      self.sqs.delete_message_batch(QueueUrl=self.queue_url,
+        Entries=[{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']}
+          for i, message in enumerate(messages)])
+    for message in messages:
+      try:
+        data = json.loads(message['Body'])
+      except ValueError:
+        continue
+      if isinstance(data, dict) and 'job_id' in data:
+        # Completion notices from before run.py sent job_status
+        yield data['job_id'], data.get('job_status', FINAL_STATUS), data.get('user_id')
+
+  def _queue_arn(self, queue_url):
+    return self.sqs.get_queue_attributes(QueueUrl=queue_url,
+      AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+
+  def _remove_stale(self):
+    stale = {}
+    for queue_url in self.sqs.list_queues(QueueNamePrefix=self.prefix).get('QueueUrls', []):
+      pid = queue_url.rsplit('-', 1)[-1]
+      if pid.isdigit() and not _process_exists(int(pid)):
+        stale[self._queue_arn(queue_url)] = queue_url
+    if not stale:
+      return
+    for topic in self.topics:
+      for page in self.sns.get_paginator('list_subscriptions_by_topic').paginate(TopicArn=topic):
+        for subscription in page['Subscriptions']:
+          if subscription['Endpoint'] in stale:
+            self.sns.unsubscribe(SubscriptionArn=subscription['SubscriptionArn'])
+    for queue_url in stale.values():
+      self.sqs.delete_queue(QueueUrl=queue_url)
+
+def _process_exists(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+def _event(name, data):
+  return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+"""Generate an event stream for the given {job_id: status} jobs
+Sends the current status of each job, then each change as it happens,
+until every job is COMPLETED or the stream reaches its maximum duration
+(the browser's EventSource then reconnects on its own). With user_id, the
+stream is of all of that user's jobs: listed holds {job_id: status} for
+every job the page shows, and any other job of theirs that turns up is
+sent as a 'job' event and followed from then on; such a stream runs to
+its maximum duration even when none of the jobs is left to watch.
+"""
+def stream_job_events(statuses, user_id=None, listed=None):
+  known = {job_id: status for job_id, status in statuses.items()
+    if status != FINAL_STATUS}
+  watched = list(known)
+  seen = set(listed or statuses)
+  job_status_hub.subscribe(known)
+  if user_id:
+    job_status_hub.subscribe_user(user_id, listed or statuses)
+  try:
+    yield f"retry: {app.config['GAS_JOB_EVENTS_RETRY']}\n\n"
+    for job_id, status in statuses.items():
+      yield _event('status', {'job_id': job_id, 'job_status': status})
+
+    deadline = time.time() + app.config['GAS_JOB_EVENTS_MAX_DURATION']
+    while (known or user_id) and time.time() < deadline:
+      changes, new = job_status_hub.wait(known, app.config['GAS_JOB_EVENTS_HEARTBEAT'],
+        user_id, seen)
+      if not changes and not new:
+        # Comment line keeps proxies from closing an idle connection
+        yield ": keepalive\n\n"
+        continue
+      for job_id, status in new.items():
+        yield _event('job', {'job_id': job_id, 'job_status': status})
+        seen.add(job_id)
+        if status != FINAL_STATUS:
+          job_status_hub.subscribe({job_id: status})
+          watched.append(job_id)
+          known[job_id] = status
+      for job_id, status in changes.items():
+        yield _event('status', {'job_id': job_id, 'job_status': status})
+        if status == FINAL_STATUS:
+          del known[job_id]
+        else:
+          known[job_id] = status
+
+    if not known and not user_id:
+      yield _event('done', {})
+  finally:
+    job_status_hub.unsubscribe(watched)
+    if user_id:
+      job_status_hub.unsubscribe_user(user_id)
+
+### EOF
@@ -0,0 +1,296 @@
+# load_fakes.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Local stand-ins for AWS (DynamoDB, S3, SNS, Secrets Manager) and
+# Globus Auth, used by the web-tier load tests
+#
+# State lives under GAS_LOAD_STATE_DIR so it is shared by every gunicorn
+# worker: DynamoDB items in a SQLite file, S3 objects as plain files.
+# install() must run before gas (and hence config) is imported.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import re
+import json
+import time
+import uuid
+import sqlite3
+from decimal import Decimal
+
+import boto3
+import globus_sdk
+from botocore.exceptions import ClientError
+
+STATE_DIR = os.environ['GAS_LOAD_STATE_DIR'] \
+  if ('GAS_LOAD_STATE_DIR' in os.environ) else '/tmp/gas_load'
+
+# Set by load_gas.py once the app config is known; publishing a job
+# request then completes the job the way the annotator would
+ANNOTATOR = {'table': None, 'results_bucket': None, 'key_prefix': None}
+
+FAKE_SECRETS = {
+  'gas/web_server': {'flask_secret_key': 'load-test-secret'},
+  'rds/accounts_database': {'username': 'gas', 'password': 'gas',
+    'host': 'localhost', 'port': 5432},
+  'globus/auth_client': {'gas_client_id': 'load-test-client',
+    'gas_client_secret': 'load-test-secret'},
+}
+
+def _json_default(value):
+  if isinstance(value, Decimal):
+    return int(value) if value == value.to_integral_value() else float(value)
+  raise TypeError(f"Cannot serialize {type(value)}")
+
+
+"""DynamoDB table backed by a SQLite file
+Supports the calls the GAS makes: put_item, get_item, delete_item,
+update_item (plain SET/REMOVE/ADD expressions, and conditions of the form
+name = :value), batch_writer, and query on user_id_index.
+"""
+class FakeTable(object):
+  def __init__(self, name):
+    self.name = name
+    self.path = os.path.join(STATE_DIR, 'dynamodb.sqlite')
+    with self._connect() as conn:
+      conn.execute('CREATE TABLE IF NOT EXISTS items '
+        '(tbl TEXT, job_id TEXT, user_id TEXT, item TEXT, PRIMARY KEY (tbl, job_id))')
+      conn.execute('CREATE INDEX IF NOT EXISTS user_id_index ON items (tbl, user_id)')
+
+  def _connect(self):
+    conn = sqlite3.connect(self.path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+  def put_item(self, Item, **kwargs):
+    with self._connect() as conn:
+      # Stats items are keyed by user_id alone
+      conn.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)',
+        (self.name, Item.get('job_id', Item.get('user_id')), Item.get('user_id'),
+          json.dumps(Item, default=_json_default)))
+    return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+  def delete_item(self, Key, **kwargs):
+    with self._connect() as conn:
+      conn.execute('DELETE FROM items WHERE tbl = ? AND job_id = ?',
+        (self.name, next(iter(Key.values()))))
+    return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+  def batch_writer(self):
+    return FakeBatchWriter(self)
+
+  def get_item(self, Key, **kwargs):
+    with self._connect() as conn:
+      row = conn.execute('SELECT item FROM items WHERE tbl = ? AND job_id = ?',
+        (self.name, next(iter(Key.values())))).fetchone()
+    return {'Item': json.loads(row[0])} if row else {}
+
+  def update_item(self, Key, UpdateExpression,
+    ExpressionAttributeValues=None, ConditionExpression=None, **kwargs):
+    item = self.get_item(Key).get('Item', dict(Key))
+    values = ExpressionAttributeValues or {}
+    if ConditionExpression:
+      name, placeholder = [token.strip() for token in ConditionExpression.split('=')]
+      if item.get(name) != values[placeholder]:
+        raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException',
+          'Message': 'The conditional request failed'}}, 'UpdateItem')
+    clauses = re.split(r'\b(SET|REMOVE|ADD)\b', UpdateExpression)
+    for action, clause in zip(clauses[1::2], clauses[2::2]):
+      for part in clause.split(','):
+        if action == 'SET':
+          name, placeholder = [token.strip() for token in part.split('=')]
+          item[name] = values[placeholder]
+        elif action == 'ADD':
+          name, placeholder = part.split()
+          item[name] = item.get(name, 0) + values[placeholder]
+        else:
+          item.pop(part.strip(), None)
+    self.put_item(Item=item)
+    return {'Attributes': item}
+
+  def query(self, IndexName=None, KeyConditionExpression=None, **kwargs):
+    _, user_id = KeyConditionExpression.get_expression()['values']
+    with self._connect() as conn:
+      rows = conn.execute('SELECT item FROM items WHERE tbl = ? AND user_id = ?',
+        (self.name, user_id)).fetchall()
+    items = [json.loads(row[0]) for row in rows]
+    return {'Items': items, 'Count': len(items)}
+
+class FakeBatchWriter(object):
+  def __init__(self, table):
+    self.table = table
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+  def put_item(self, Item):
+    self.table.put_item(Item=Item)
+
+  def delete_item(self, Key):
+    self.table.delete_item(Key=Key)
+
+class FakeDynamoResource(object):
+  def Table(self, name):
+    return FakeTable(name)
+
+  def batch_get_item(self, RequestItems):
+    responses = {}
+    for name, request in RequestItems.items():
+      table = FakeTable(name)
+      items = [table.get_item(key).get('Item') for key in request['Keys']]
+      responses[name] = [item for item in items if item]
+    return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+"""S3 client storing objects as files under STATE_DIR/s3
+"""
+class FakeS3(object):
+  def _path(self, bucket, key):
+    return os.path.join(STATE_DIR, 's3', bucket, key)
+
+  def put_object(self, Bucket, Key, Body=b'', **kwargs):
+    path = self._path(Bucket, Key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+      f.write(Body.encode('utf-8') if isinstance(Body, str) else Body)
+    return {'ETag': uuid.uuid4().hex}
+
+  def get_object(self, Bucket, Key, Range=None, **kwargs):
+    try:
+      with open(self._path(Bucket, Key), 'rb') as f:
+        body = f.read()
+    except FileNotFoundError:
+      raise ClientError({'Error': {'Code': 'NoSuchKey',
+        'Message': 'The specified key does not exist.'}}, 'GetObject')
+    if not Range:
+      return {'Body': io.BytesIO(body), 'ContentLength': len(body)}
+    first, last = Range[len('bytes='):].split('-')
+    part = body[int(first):int(last) + 1]
+    return {'Body': io.BytesIO(part), 'ContentLength': len(part),
+      'ContentRange': f'bytes {first}-{int(first) + len(part) - 1}/{len(body)}'}
+
+  def upload_file(self, Filename, Bucket, Key, **kwargs):
+    with open(Filename, 'rb') as f:
+      self.put_object(Bucket=Bucket, Key=Key, Body=f.read())
+
+  def generate_presigned_post(self, Bucket, Key, Fields=None,
+    Conditions=None, ExpiresIn=3600):
+    fields = dict(Fields or {}, key=Key, policy='fake-policy',
+      **{'x-amz-signature': 'fake-signature'})
+    return {'url': f'http://fake-s3.local/{Bucket}', 'fields': fields}
+
+  def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600):
+    return f"http://fake-s3.local/{Params['Bucket']}/{Params['Key']}" \
+      f"?X-Amz-Expires={ExpiresIn}&X-Amz-Signature=fake-signature"
+
+
+"""SNS client; job requests are completed immediately as if an annotator
+had picked them up, so detail and log pages have something to show
+"""
+class FakeSNS(object):
+  def publish(self, TopicArn=None, Message=None, Subject=None,
+    MessageAttributes=None, **kwargs):
+    if ANNOTATOR['table'] and Subject == 'New Annotation Job Request':
+      self._complete_job(json.loads(Message))
+    return {'MessageId': str(uuid.uuid4())}
+
+  def publish_batch(self, TopicArn=None, PublishBatchRequestEntries=None, **kwargs):
+    for entry in PublishBatchRequestEntries:
+      self.publish(TopicArn=TopicArn, Message=entry['Message'], Subject=entry.get('Subject'))
+    return {'Successful': [{'Id': entry['Id'], 'MessageId': str(uuid.uuid4())}
+      for entry in PublishBatchRequestEntries], 'Failed': []}
+
+  def _complete_job(self, data):
+    prefix = ANNOTATOR['key_prefix'] + data['user_id'] + '/' + data['job_id'] + '/'
+    base_name = data['input_file_name'].rsplit('.', 1)[0]
+    log_key = prefix + base_name + '.vcf.count.log'
+    result_key = prefix + base_name + '.annot.vcf'
+    s3 = FakeS3()
+    s3.put_object(Bucket=ANNOTATOR['results_bucket'], Key=log_key,
+      Body='Processed 1000 variants in 0.1 seconds\n')
+    s3.put_object(Bucket=ANNOTATOR['results_bucket'], Key=result_key,
+      Body='##fileformat=VCFv4.1\n')
+    FakeTable(ANNOTATOR['table']).update_item(Key={'job_id': data['job_id']},
+      UpdateExpression='SET job_status = :s, s3_results_bucket = :b, '
+        's3_key_result_file = :r, s3_key_log_file = :l, complete_time = :c',
+      ExpressionAttributeValues={':s': 'COMPLETED',
+        ':b': ANNOTATOR['results_bucket'], ':r': result_key, ':l': log_key,
+        ':c': int(time.time())})
+
+class FakeSecretsManager(object):
+  def get_secret_value(self, SecretId):
+    return {'SecretString': json.dumps(FAKE_SECRETS[SecretId])}
+
+
+"""Globus Auth client; the authorization code is used directly as the
+user's identity ID, so a load client logs in with
+GET /authcallback?code=<uuid>
+"""
+class FakeTokens(object):
+  def __init__(self, identity_id):
+    self.identity_id = identity_id
+    self.by_resource_server = {'auth.globus.org': {
+      'access_token': f'access-{identity_id}', 'refresh_token': None,
+      'scope': 'openid email profile', 'expires_at_seconds': int(time.time()) + 3600}}
+
+  def decode_id_token(self, client=None):
+    return {'sub': self.identity_id,
+      'name': f'Load User {self.identity_id[:8]}',
+      'email': f'{self.identity_id}@load.test',
+      'organization': 'GAS load test',
+      'preferred_username': f'{self.identity_id}@load.test'}
+
+class FakeAuthClient(object):
+  def __init__(self, client_id=None, client_secret=None, **kwargs):
+    self.client_id = client_id
+
+  def oauth2_start_flow(self, redirect_uri, refresh_tokens=False, **kwargs):
+    self.redirect_uri = redirect_uri
+
+  def oauth2_get_authorize_url(self, additional_params=None):
+    return self.redirect_uri + '?code=' + str(uuid.uuid4())
+
+  def oauth2_exchange_code_for_tokens(self, code):
+    return FakeTokens(code)
+
+  def oauth2_revoke_token(self, token, additional_params=None):
+    return None
+
+  def oauth2_client_credentials_tokens(self, requested_scopes=None):
+    return FakeTokens('client-credentials')
+
+
+FAKE_CLIENTS = {
+  's3': FakeS3,
+  'sns': FakeSNS,
+  'secretsmanager': FakeSecretsManager,
+}
+
+"""Route boto3 and Globus Auth through the fakes above
+"""
+def install():
+  os.makedirs(os.path.join(STATE_DIR, 's3'), exist_ok=True)
+  real_client, real_resource = boto3.client, boto3.resource
+
+  def client(service_name, *args, **kwargs):
+    if service_name in FAKE_CLIENTS:
+      return FAKE_CLIENTS[service_name]()
+    return real_client(service_name, *args, **kwargs)
+
+  def resource(service_name, *args, **kwargs):
+    if service_name == 'dynamodb':
+      return FakeDynamoResource()
+    return real_resource(service_name, *args, **kwargs)
+
+  boto3.client = client
+  boto3.resource = resource
+  globus_sdk.ConfidentialAppAuthClient = FakeAuthClient
+
+### EOF
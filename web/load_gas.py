@@ -0,0 +1,50 @@
+# load_gas.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# GAS app wired to local fakes for load testing; run under gunicorn as
+#   gunicorn --workers=N 'load_gas:create_app()'
+#
+# The accounts database is replaced by a SQLite file in the load state
+# directory (GAS_LOAD_STATE_DIR), and AWS/Globus Auth by load_fakes.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+
+import load_fakes
+
+os.environ.setdefault('GAS_SETTINGS', 'config.ProductionConfig')
+os.environ.setdefault('GAS_HOST_IP', '127.0.0.1')
+os.environ.setdefault('GAS_HOST_PORT', '5055')
+os.environ.setdefault('GAS_APP_HOST', '127.0.0.1')
+os.environ.setdefault('ACCOUNTS_DATABASE_TABLE', 'gas_load_accounts')
+# No SQS stand-in; job status streams poll the fake table
+os.environ.setdefault('GAS_JOB_EVENTS_QUEUE_PREFIX', '')
+os.environ.setdefault('GAS_DATABASE_URI',
+  'sqlite:///' + os.path.join(load_fakes.STATE_DIR, 'accounts.sqlite'))
+
+load_fakes.install()
+
+import gas
+from gas import db
+from models import Profile
+
+# SQLite has no native UUID type; store Globus identity IDs as text
+Profile.__table__.c.identity_id.type = db.String(36)
+
+"""Build the GAS app against the fakes, with the accounts table in place
+"""
+def create_app():
+  app = gas.create_app()
+  load_fakes.ANNOTATOR.update(
+    table=app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
+    results_bucket=app.config['AWS_S3_RESULTS_BUCKET'],
+    key_prefix=app.config['AWS_S3_KEY_PREFIX'])
+  with app.app_context():
+    db.create_all()
+  return app
+
+### EOF
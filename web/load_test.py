@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+# load_test.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Web-tier load test: starts gunicorn on load_gas (AWS, Postgres and
+# Globus Auth replaced by local fakes), with the production worker
+# settings from gunicorn.conf.py, for each requested worker count,
+# drives the annotation routes with authenticated sessions and reports
+# per-route latency percentiles and requests/sec
+#
+# Example:
+#   python load_test.py --workers 1,2,4 --users 32 --duration 30
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from http.cookiejar import CookieJar
+from urllib.parse import urlencode
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+# Relative weight of each route in the request mix
+ROUTE_MIX = [
+  ('/annotate', 2),
+  ('/annotate/job', 1),
+  ('/annotations', 4),
+  ('/annotations/<id>', 4),
+  ('/annotations/<id>/log', 2),
+]
+
+# Stands in for the file a browser would have posted to S3
+SAMPLE_VCF = '##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n' + \
+  ''.join(f'chr1\t{1000 + i}\t.\tA\tG\t50\tPASS\tDP=10\n' for i in range(100))
+
+"""Percentile by nearest rank
+"""
+def percentile(ordered, pct):
+  if not ordered:
+    return None
+  rank = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+  return ordered[min(rank, len(ordered) - 1)]
+
+"""One simulated user with its own session cookie
+"""
+class LoadUser(object):
+  def __init__(self, base_url, results, state_dir):
+    self.base_url = base_url
+    self.results = results
+    self.state_dir = state_dir
+    self.identity_id = str(uuid.uuid4())
+    self.job_ids = []
+    self.opener = urllib.request.build_opener(
+      urllib.request.HTTPCookieProcessor(CookieJar()))
+
+  def get(self, route, path):
+    started = time.perf_counter()
+    try:
+      with self.opener.open(self.base_url + path, timeout=60) as response:
+        body = response.read().decode('utf-8')
+        ok = response.status == 200
+    except (urllib.error.URLError, socket.timeout):
+      body, ok = '', False
+    self.results.record(route, time.perf_counter() - started, ok)
+    return body
+
+  """Log in through the (fake) Globus Auth callback; the first visit
+  creates the user's profile
+  """
+  def login(self):
+    self.get('login', '/authcallback?' + urlencode({'code': self.identity_id}))
+
+  def submit_job(self):
+    page = self.get('/annotate', '/annotate')
+    match = re.search(r'name="key" value="([^"]+)"', page)
+    if not match:
+      return
+    key = match.group(1).replace('${filename}', 'load.vcf')
+    # Upload straight into the fake S3 (see load_fakes.FakeS3)
+    path = os.path.join(self.state_dir, 's3', 'mpcs-cc-gas-inputs', key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+      f.write(SAMPLE_VCF)
+    self.get('/annotate/job', '/annotate/job?' +
+      urlencode({'bucket': 'mpcs-cc-gas-inputs', 'key': key}))
+    self.job_ids.append(key.split('/')[-1].split('~')[0])
+
+  def step(self, route):
+    if route in ('/annotate', '/annotate/job') or not self.job_ids:
+      self.submit_job()
+    elif route == '/annotations':
+      self.get(route, '/annotations')
+    elif route == '/annotations/<id>':
+      self.get(route, f'/annotations/{random.choice(self.job_ids)}')
+    else:
+      self.get(route, f'/annotations/{random.choice(self.job_ids)}/log')
+
+class Results(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.latencies = {}
+    self.errors = {}
+
+  def record(self, route, seconds, ok):
+    with self.lock:
+      self.latencies.setdefault(route, []).append(seconds)
+      self.errors[route] = self.errors.get(route, 0) + (0 if ok else 1)
+
+  def summary(self, elapsed):
+    report = {}
+    for route, values in self.latencies.items():
+      if route == 'login':
+        continue
+      ordered = sorted(values)
+      report[route] = {
+        'requests': len(ordered),
+        'errors': self.errors[route],
+        'rps': len(ordered) / elapsed,
+        'p50_ms': percentile(ordered, 50) * 1000,
+        'p95_ms': percentile(ordered, 95) * 1000,
+        'p99_ms': percentile(ordered, 99) * 1000,
+      }
+    return report
+
+def start_gunicorn(workers, port, state_dir):
+  env = dict(os.environ, GAS_LOAD_STATE_DIR=state_dir,
+    GAS_HOST_PORT=str(port))
+  # Same worker class, threads and preloading as run_gas.sh
+  process = subprocess.Popen([sys.executable, '-m', 'gunicorn',
+    f'--config={os.path.join(basedir, "gunicorn.conf.py")}',
+    f'--workers={workers}', f'--bind=127.0.0.1:{port}',
+    '--log-level=warning', 'load_gas:create_app()'], cwd=basedir, env=env)
+  deadline = time.time() + 60
+  while time.time() < deadline:
+    try:
+      socket.create_connection(('127.0.0.1', port), timeout=1).close()
+      return process
+    except OSError:
+      if process.poll() is not None:
+        raise RuntimeError('gunicorn exited during startup')
+      time.sleep(0.2)
+  process.terminate()
+  raise RuntimeError('gunicorn did not start listening within 60 seconds')
+
+def run_once(workers, args):
+  state_dir = tempfile.mkdtemp(prefix='gas_load_')
+  process = start_gunicorn(workers, args.port, state_dir)
+  base_url = f'http://127.0.0.1:{args.port}'
+  results = Results()
+  users = [LoadUser(base_url, results, state_dir) for _ in range(args.users)]
+  try:
+    for user in users:
+      user.login()
+      user.submit_job()
+    # Measure steady state only; setup traffic above is discarded
+    results = Results()
+    for user in users:
+      user.results = results
+
+    routes = [route for route, weight in ROUTE_MIX for _ in range(weight)]
+    deadline = time.time() + args.duration
+    def drive(user):
+      while time.time() < deadline:
+        user.step(random.choice(routes))
+    started = time.time()
+    threads = [threading.Thread(target=drive, args=(user,)) for user in users]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return results.summary(time.time() - started)
+  finally:
+    process.terminate()
+    process.wait()
+    shutil.rmtree(state_dir, ignore_errors=True)
+
+def print_report(workers, report):
+  print(f'\n== {workers} worker(s) ==')
+  print(f"{'route':<24} {'reqs':>7} {'errs':>5} {'req/s':>8} "
+    f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+  for route, _ in ROUTE_MIX:
+    if route not in report:
+      continue
+    r = report[route]
+    print(f"{route:<24} {r['requests']:>7} {r['errors']:>5} {r['rps']:>8.1f} "
+      f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f}")
+
+def main():
+  parser = argparse.ArgumentParser(description='GAS web-tier load test')
+  parser.add_argument('--workers', default='1,2,4',
+    help='comma-separated gunicorn worker counts to test')
+  parser.add_argument('--users', type=int, default=16, help='concurrent sessions')
+  parser.add_argument('--duration', type=float, default=30, help='seconds per run')
+  parser.add_argument('--port', type=int, default=5055)
+  parser.add_argument('--json', metavar='PATH', default=None,
+    help='also write the results as JSON')
+  args = parser.parse_args()
+
+  reports = {}
+  for workers in [int(w) for w in args.workers.split(',')]:
+    reports[workers] = run_once(workers, args)
+    print_report(workers, reports[workers])
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(reports, f, indent=2)
+
+if __name__ == '__main__':
+  main()
+
+### EOF
@@ -12,7 +12,9 @@ import os
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from gas import app, db
+from gas import create_app, db
+
+app = create_app()
 
 app.config.from_object(os.environ['GAS_SETTINGS'])
 
@@ -10,6 +10,8 @@ source /home/ec2-user/mpcs-cc/gas/web/.env
 if [ ! -e /home/ec2-user/mpcs-cc/gas/web/log/$GAS_LOG_FILE_NAME ]; then
     touch /home/ec2-user/mpcs-cc/gas/web/log/$GAS_LOG_FILE_NAME;
 fi
+# Fingerprint and precompress static assets
+/home/ec2-user/mpcs-cc/bin/python /home/ec2-user/mpcs-cc/gas/web/build_static.py
 if [ "$1" = "console" ]; then
     LOG_TARGET=-
 else
@@ -18,8 +20,9 @@ fi
 /home/ec2-user/mpcs-cc/bin/gunicorn \
   --log-file=$LOG_TARGET \
   --log-level=debug \
+  --config=/home/ec2-user/mpcs-cc/gas/web/gunicorn.conf.py \
   --workers=$GUNICORN_WORKERS \
   --certfile=$SSL_CERT_PATH \
   --keyfile=$SSL_KEY_PATH \
-  --bind=$GAS_APP_HOST:$GAS_HOST_PORT gas:app
+  --bind=$GAS_APP_HOST:$GAS_HOST_PORT 'gas:create_app()'
 
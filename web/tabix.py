@@ -0,0 +1,147 @@
+# tabix.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Region queries against bgzip-compressed, tabix-indexed result files
+#
+# A .tbi index maps genomic bins to "virtual offsets" into the bgzip file
+# (compressed block offset << 16 | offset within the uncompressed block).
+# Given the index, only the blocks covering a region need to be fetched,
+# which run.py's indexed results let us do with S3 range requests.
+# Format: https://samtools.github.io/hts-specs/tabix.pdf
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import gzip
+import zlib
+import struct
+
+# Largest possible BGZF block; a chunk ending in a block needs all of it
+MAX_BLOCK_SIZE = 65536
+# Positions covered by one linear index entry (16 kbp)
+LINEAR_SHIFT = 14
+# VCF preset in the index's format field
+FORMAT_VCF = 2
+
+class RegionTooLarge(Exception):
+  pass
+
+class TabixIndex(object):
+  def __init__(self, data):
+    data = gzip.decompress(data)
+    if data[:4] != b'TBI\x01':
+      raise ValueError("Not a tabix index")
+    (n_ref, self.format, self.col_seq, self.col_beg, self.col_end,
+      meta, self.skip, l_nm) = struct.unpack_from('<8i', data, 4)
+    self.meta = chr(meta)
+    pos = 36
+    names = data[pos:pos + l_nm].split(b'\x00')
+    self.names = {name.decode('utf-8'): tid for tid, name in enumerate(names[:n_ref])}
+    pos += l_nm
+
+    # Per reference sequence: {bin: [(start, end) virtual offsets]} and
+    # the linear index of smallest offsets per 16 kbp window
+    self.bins = []
+    self.linear = []
+    for tid in range(n_ref):
+      bins = {}
+      (n_bin,) = struct.unpack_from('<i', data, pos)
+      pos += 4
+      for i in range(n_bin):
+        bin_number, n_chunk = struct.unpack_from('<Ii', data, pos)
+        pos += 8
+        offsets = struct.unpack_from(f'<{2 * n_chunk}Q', data, pos)
+        pos += 16 * n_chunk
+        bins[bin_number] = list(zip(offsets[::2], offsets[1::2]))
+      (n_intv,) = struct.unpack_from('<i', data, pos)
+      pos += 4
+      self.linear.append(struct.unpack_from(f'<{n_intv}Q', data, pos))
+      pos += 8 * n_intv
+      self.bins.append(bins)
+
+  """Merged (start, end) virtual offset ranges that may hold records
+  overlapping [beg, end) on chrom (0-based, half-open)
+  """
+  def chunks(self, chrom, beg, end):
+    if chrom not in self.names:
+      return []
+    tid = self.names[chrom]
+    linear = self.linear[tid]
+    min_offset = linear[min(beg >> LINEAR_SHIFT, len(linear) - 1)] if linear else 0
+    candidates = sorted(chunk for bin_number in region_bins(beg, end)
+      for chunk in self.bins[tid].get(bin_number, []) if chunk[1] > min_offset)
+    merged = []
+    for chunk_beg, chunk_end in candidates:
+      chunk_beg = max(chunk_beg, min_offset)
+      if merged and chunk_beg <= merged[-1][1]:
+        merged[-1] = (merged[-1][0], max(merged[-1][1], chunk_end))
+      else:
+        merged.append((chunk_beg, chunk_end))
+    return merged
+
+  def overlaps(self, fields, chrom, beg, end):
+    if fields[self.col_seq - 1] != chrom:
+      return False
+    start = int(fields[self.col_beg - 1]) - 1
+    if self.format & 0xffff == FORMAT_VCF:
+      stop = start + len(fields[3])
+    elif self.col_end:
+      stop = int(fields[self.col_end - 1])
+    else:
+      stop = start + 1
+    return start < end and stop > beg
+
+"""Bins (UCSC binning scheme) that can contain features in [beg, end)
+"""
+def region_bins(beg, end):
+  end -= 1
+  bins = [0]
+  for shift, first in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+    bins.extend(range(first + (beg >> shift), first + (end >> shift) + 1))
+  return bins
+
+"""Byte ranges of the bgzip file to fetch for the given chunks
+"""
+def byte_ranges(chunks):
+  return [(chunk_beg >> 16, (chunk_end >> 16) + MAX_BLOCK_SIZE - 1)
+    for chunk_beg, chunk_end in chunks]
+
+"""Uncompressed bytes between two virtual offsets, given the compressed
+data starting at the first offset's block
+"""
+def inflate(data, chunk_beg, chunk_end):
+  text = bytearray()
+  first_block, last_block = chunk_beg >> 16, chunk_end >> 16
+  pos = 0
+  while pos + 18 <= len(data) and first_block + pos <= last_block:
+    # BSIZE (total block size - 1) is the BC extra subfield of the header
+    block_size = struct.unpack_from('<H', data, pos + 16)[0] + 1
+    block = zlib.decompress(data[pos + 18:pos + block_size - 8], -15)
+    start = chunk_beg & 0xffff if pos == 0 else 0
+    stop = chunk_end & 0xffff if first_block + pos == last_block else len(block)
+    text += block[start:stop]
+    pos += block_size
+  return bytes(text)
+
+"""Records overlapping chrom:start-end (1-based, inclusive, as with the
+tabix command line); fetch(first, last) returns that byte range of the
+bgzip file. Raises RegionTooLarge rather than fetch more than max_bytes.
+"""
+def query(index, fetch, chrom, start, end, max_bytes=None):
+  beg = max(start - 1, 0)
+  chunks = index.chunks(chrom, beg, end)
+  if max_bytes and sum(last - first for first, last in byte_ranges(chunks)) > max_bytes:
+    raise RegionTooLarge(f"{chrom}:{start}-{end}")
+  records = []
+  for chunk in chunks:
+    first, last = byte_ranges([chunk])[0]
+    for line in inflate(fetch(first, last), *chunk).decode('utf-8').splitlines():
+      if not line or line.startswith(index.meta):
+        continue
+      if index.overlaps(line.split('\t'), chrom, beg, end):
+        records.append(line)
+  return records
+
+### EOF
@@ -0,0 +1,77 @@
+# templating.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Jinja bytecode and fragment caching for the GAS templates
+#
+# Compiled templates are kept in a FileSystemBytecodeCache shared by all
+# gunicorn workers, so a fresh worker loads bytecode instead of parsing
+# every template. Page pieces that only depend on a few values (nav bar,
+# header strip, footer and scripts) are rendered through fragment(), which
+# caches the HTML per template and per set of values they depend on.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import threading
+from collections import OrderedDict
+
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+
+"""LRU cache of rendered template fragments
+A fragment's HTML is keyed by template name and the keyword values passed
+to it, so those values must be everything the fragment depends on.
+"""
+class FragmentCache(object):
+  def __init__(self, app):
+    self.app = app
+    self.enabled = app.config['GAS_TEMPLATE_FRAGMENT_CACHE']
+    self.max_entries = app.config['GAS_TEMPLATE_FRAGMENT_CACHE_SIZE']
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def render(self, template_name, **values):
+    template = self.app.jinja_env.get_template(template_name)
+    if not self.enabled:
+      return Markup(template.render(**values))
+
+    key = (template_name, tuple(sorted(values.items())))
+    with self.lock:
+      entry = self.entries.get(key)
+      # get_template returns a new Template when the file was reloaded
+      # (debug mode), which makes the cached HTML stale
+      if entry and entry[0] is template:
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    html = Markup(template.render(**values))
+    with self.lock:
+      self.entries[key] = (template, html)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+    return html
+
+  """Drop cached fragments for one template, or all of them
+  """
+  def invalidate(self, template_name=None):
+    with self.lock:
+      if template_name is None:
+        self.entries.clear()
+      else:
+        for key in [k for k in self.entries if k[0] == template_name]:
+          del self.entries[key]
+
+def init_app(app):
+  cache_dir = app.config['GAS_TEMPLATE_CACHE_DIR']
+  os.makedirs(cache_dir, exist_ok=True)
+  app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+  fragments = FragmentCache(app)
+  app.jinja_env.globals['fragment'] = fragments.render
+  app.extensions['gas_fragments'] = fragments
+  return fragments
+
+### EOF
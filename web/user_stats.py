@@ -0,0 +1,107 @@
+# user_stats.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Per-user job statistics, maintained incrementally
+#
+# One item per user in the stats table holds counters that every status
+# transition adjusts with an atomic ADD: the web app when a job is
+# submitted, deferred or released, run.py when a deferred job is released
+# or a job starts or completes, and the thaw utility when results come back
+# from Glacier. Both archive counters only ever grow: archived_jobs counts
+# jobs whose results were ever archived and restored_jobs those since
+# restored, so the jobs archived now are the difference. Reading a user's
+# stats is then a single GetItem rather than a query over all of their
+# jobs. Users whose jobs predate the counters get them rebuilt from
+# user_id_index the first time their stats are read; archive.py does not
+# record archived_jobs yet, so that rebuild is its only source.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import time
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+from flask import current_app as app
+
+COUNTERS = ['jobs_total', 'jobs_deferred', 'jobs_pending', 'jobs_running',
+  'jobs_completed', 'variants_annotated', 'result_bytes', 'archived_jobs',
+  'restored_jobs']
+
+def _table(name):
+  dynamo = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+  return dynamo.Table(app.config[name])
+
+"""Add deltas ({counter: amount}) to a user's counters
+"""
+def record(user_id, deltas):
+  deltas = {name: amount for name, amount in deltas.items() if amount}
+  if not deltas:
+    return
+  names = list(deltas)
+  _table('AWS_DYNAMODB_USER_STATS_TABLE').update_item(Key={'user_id': user_id},
+    UpdateExpression='ADD ' + ', '.join(f'{name} :d{i}' for i, name in enumerate(names)),
+    ExpressionAttributeValues={f':d{i}': deltas[name] for i, name in enumerate(names)})
+
+"""Count newly inserted jobs; statuses lists the status each was stored with
+"""
+def record_submitted(user_id, statuses):
+  record(user_id, {'jobs_total': len(statuses),
+    'jobs_pending': statuses.count('PENDING'),
+    'jobs_deferred': statuses.count('DEFERRED')})
+
+"""Recount a user's stats from all of their jobs
+Only needed once per user: jobs completed before run.py recorded
+result_record_count/result_bytes contribute nothing to those totals.
+An update that lands between the query and the put is lost, which is
+why this runs only when the item has never been rebuilt.
+"""
+def rebuild(user_id):
+  jobs = _table('AWS_DYNAMODB_ANNOTATIONS_TABLE')
+  query = {'IndexName': 'user_id_index',
+    'KeyConditionExpression': Key('user_id').eq(user_id)}
+  stats = dict.fromkeys(COUNTERS, 0)
+  while True:
+    response = jobs.query(**query)
+    for item in response['Items']:
+      stats['jobs_total'] += 1
+      status = item['job_status'].lower()
+      if f'jobs_{status}' in stats:
+        stats[f'jobs_{status}'] += 1
+      stats['variants_annotated'] += int(item.get('result_record_count', 0))
+      stats['result_bytes'] += int(item.get('result_bytes', 0))
+      # A restored job keeps counting as archived (see above)
+      if 'results_file_archive_id' in item or item.get('restore_status') == 'RESTORED':
+        stats['archived_jobs'] += 1
+      if item.get('restore_status') == 'RESTORED':
+        stats['restored_jobs'] += 1
+    if 'LastEvaluatedKey' not in response:
+      break
+    query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+  item = dict(stats, user_id=user_id, rebuilt_time=int(time.time()))
+  try:
+    _table('AWS_DYNAMODB_USER_STATS_TABLE').put_item(Item=item,
+      ConditionExpression='attribute_not_exists(rebuilt_time)')
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+      raise
+    # Rebuilt concurrently by another request; theirs is as good as ours
+    return get_user_stats(user_id)
+  return stats
+
+"""A user's counters as {counter: int}
+"""
+def get_user_stats(user_id):
+  response = _table('AWS_DYNAMODB_USER_STATS_TABLE').get_item(
+    Key={'user_id': user_id}, ConsistentRead=True)
+  item = response.get('Item')
+  if not item or 'rebuilt_time' not in item:
+    return rebuild(user_id)
+  return {name: int(item.get(name, 0)) for name in COUNTERS}
+
+### EOF
@@ -0,0 +1,53 @@
+# variant_summary.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Per-job aggregates from the Parquet sidecar that run.py writes next to
+# the annotated VCF
+#
+# Only the columns being counted are read, straight from S3 (Parquet's
+# footer tells pyarrow which byte ranges hold them), and the counting is
+# done by Arrow compute kernels rather than Python loops. pyarrow is only
+# imported on first use, keeping it out of every worker's startup.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import importlib.util
+
+SUMMARY_COLUMNS = ['chrom', 'consequence', 'gene']
+
+def available():
+  return importlib.util.find_spec('pyarrow') is not None
+
+def s3_filesystem(region, endpoint_url=None):
+  from pyarrow import fs
+  if endpoint_url:
+    return fs.S3FileSystem(region=region, endpoint_override=endpoint_url)
+  return fs.S3FileSystem(region=region)
+
+def _counts(column, limit=None):
+  import pyarrow.compute as pc
+  counts = pc.value_counts(column.drop_null()).to_pylist()
+  counts.sort(key=lambda entry: -entry['counts'])
+  return {entry['values']: entry['counts'] for entry in counts[:limit]}
+
+"""Variant counts in total, by chromosome and consequence, and for the
+top_genes most frequently hit genes
+"""
+def summarize(table, top_genes):
+  return {
+    'variants': table.num_rows,
+    'by_chromosome': _counts(table['chrom']),
+    'by_consequence': _counts(table['consequence']),
+    'top_genes': _counts(table['gene'], top_genes)
+  }
+
+def read_summary(filesystem, bucket, key, top_genes):
+  import pyarrow.parquet as pq
+  table = pq.read_table(f'{bucket}/{key}', filesystem=filesystem,
+    columns=SUMMARY_COLUMNS)
+  return summarize(table, top_genes)
+
+### EOF
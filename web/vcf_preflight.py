@@ -0,0 +1,116 @@
+# vcf_preflight.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Quick sanity check of an uploaded VCF before a job is dispatched
+#
+# Works on the first bytes of the object only (fetched with a range GET):
+# detects gzip/bgzip compression, checks the header and the first records,
+# and counts records to estimate the size of the whole file, so malformed
+# uploads are turned away before they reach the job queue.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import re
+import zlib
+
+VCF_COLUMNS = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
+BASES = re.compile(r'^[ACGTN]+$', re.IGNORECASE)
+# ALT may also be missing (.), symbolic (<DEL>) or a breakend (N[chr2:1[)
+ALT_ALLELE = re.compile(r'^([ACGTN*]+|\.|<[^>]+>|.*[\[\]].*)$', re.IGNORECASE)
+
+class InvalidVCF(ValueError):
+  pass
+
+def compression(head):
+  if head[:2] != b'\x1f\x8b':
+    return 'none'
+  # BGZF blocks are gzip members with a 'BC' extra subfield
+  if len(head) >= 14 and head[3] & 4 and head[12:14] == b'BC':
+    return 'bgzip'
+  return 'gzip'
+
+"""Decompress as much of a (possibly truncated, possibly multi-member)
+gzip stream as is available; returns (text, whole stream decompressed)
+"""
+def _inflate(head):
+  text = bytearray()
+  data = head
+  while data:
+    inflater = zlib.decompressobj(31)
+    try:
+      text += inflater.decompress(data)
+    except zlib.error as e:
+      raise InvalidVCF(f"Corrupt compressed data: {e}")
+    if not inflater.eof:
+      return bytes(text), False
+    data = inflater.unused_data
+  return bytes(text), True
+
+def _check_record(fields, number):
+  if len(fields) < len(VCF_COLUMNS):
+    raise InvalidVCF(f"Record {number} has {len(fields)} columns; expected at least {len(VCF_COLUMNS)}")
+  if not fields[1].isdigit():
+    raise InvalidVCF(f"Record {number} has a non-numeric position '{fields[1]}'")
+  if not BASES.match(fields[3]):
+    raise InvalidVCF(f"Record {number} has an invalid reference allele '{fields[3]}'")
+  for allele in fields[4].split(','):
+    if not ALT_ALLELE.match(allele):
+      raise InvalidVCF(f"Record {number} has an invalid alternate allele '{allele}'")
+
+"""Validate the first bytes of a VCF of total_size bytes, checking up to
+max_records records. Returns the compression type, a record count (exact
+if head is the whole file, otherwise extrapolated; None if the header
+alone outgrew head) and an estimate of the uncompressed size. Raises
+InvalidVCF if the file is not a usable VCF.
+"""
+def preflight(head, total_size, max_records):
+  kind = compression(head)
+  if kind == 'none':
+    text, complete = head, len(head) >= total_size
+  else:
+    text, complete = _inflate(head)
+    complete = complete and len(head) >= total_size
+  if not complete:
+    # The last line may have been cut off
+    text = text[:text.rfind(b'\n') + 1]
+  try:
+    lines = text.decode('utf-8').splitlines()
+  except UnicodeDecodeError:
+    raise InvalidVCF("File is not text")
+
+  if not lines or not lines[0].startswith('##fileformat=VCF'):
+    raise InvalidVCF("Missing ##fileformat=VCF header line")
+  header_lines = 0
+  for line in lines:
+    if not line.startswith('##'):
+      break
+    header_lines += 1
+  if header_lines == len(lines):
+    if complete:
+      raise InvalidVCF("Missing #CHROM column header line")
+    return {'compression': kind, 'records': None, 'exact': False,
+      'uncompressed_bytes': None}
+  columns = lines[header_lines].split('\t')
+  if columns[:len(VCF_COLUMNS)] != VCF_COLUMNS:
+    raise InvalidVCF("Column header line must start with " + ' '.join(VCF_COLUMNS))
+
+  records = [line for line in lines[header_lines + 1:] if line]
+  for number, line in enumerate(records[:max_records], 1):
+    _check_record(line.split('\t'), number)
+  if complete and not records:
+    raise InvalidVCF("File contains no variant records")
+
+  if complete:
+    return {'compression': kind, 'records': len(records), 'exact': True,
+      'uncompressed_bytes': len(text)}
+  # Scale what we saw by how much of the upload it came from
+  uncompressed = int(len(text) * total_size / len(head))
+  header_bytes = sum(len(line) + 1 for line in lines[:header_lines + 1])
+  record_bytes = max(len(text) - header_bytes, 1)
+  return {'compression': kind, 'exact': False, 'uncompressed_bytes': uncompressed,
+    'records': int(len(records) * max(uncompressed - header_bytes, 0) / record_bytes)}
+
+### EOF
@@ -11,47 +11,72 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import uuid
 import time
 import json
-from datetime import datetime
+import hashlib
+import functools
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 import boto3
 from boto3.dynamodb.conditions import Key
 from botocore.client import Config
 from botocore.exceptions import ClientError
 
-from flask import (abort, flash, redirect, render_template,
-  request, session, url_for)
+from flask import (Response, abort, flash, jsonify, make_response, redirect,
+  render_template, request, session, stream_with_context, url_for)
+from flask import current_app as app
 
-from gas import app, db
+from gas import bp, db
 from decorators import authenticated, is_premium
 from auth import get_profile, update_profile
+from job_events import job_status_hub, stream_job_events
+import tabix
+import user_stats
+import variant_summary
+import vcf_preflight
 
 
 # ---------------------- HELPER FUNCTIONS ---------------------------- #
 
-def insert_dynamo(item):
+def insert_dynamo(item, status='PENDING'):
     # Reference: https://docs.python.org/3/library/time.html
     try:
         dynamo = boto3.resource('dynamodb')
         # table = dynamo.Table('gaoyunl1_annotations')
         table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
         item['submit_time'] = int(time.time())
-        item['job_status'] = 'PENDING'
+        item['job_status'] = status
         response = table.put_item(Item = item)
         print(f'Dynamo resonse: {response}')
     except ClientError as e:
         app.logger.error(f"Client Error when inserting to DynamoDb: {e}") 
+        return
     except Exception as e:
         app.logger.error(f"Error when inserting to DynamoDb: {e}")
+        return
+    record_submitted(item['user_id'], [status])
 
-def publish_to_sns(data):
+def record_submitted(user_id, statuses):
+    # Stats are advisory; a failed update must never fail the submission
+    try:
+        user_stats.record_submitted(user_id, statuses)
+    except Exception as e:
+        app.logger.error(f"Unable to update job stats for user {user_id}: {e}")
+
+def publish_to_sns(data, topic_arn=None, subject='New Annotation Job Request'):
     # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
     try:
-        sns = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
+        sns = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'],
+                           endpoint_url=app.config['AWS_ENDPOINT_URL'])
         # topic_arn = 'arn:aws:sns:us-east-1:659248683008:gaoyunl1_job_requests'
-        topic_arn = app.config['AWS_SNS_JOB_REQUEST_TOPIC']
+        topic_arn = topic_arn or app.config['AWS_SNS_JOB_REQUEST_TOPIC']
         message = json.dumps(data)
-        subject = 'New Annotation Job Request'
-        response = sns.publish(TopicArn=topic_arn, Message=message, Subject=subject)
+        # user_role drives the SNS subscription filter policies that route
+        # premium jobs to their own request queue
+        attributes = {'user_role': {'DataType': 'String', 'StringValue': data['user_role']}} \
+            if data.get('user_role') else {}
+        response = sns.publish(TopicArn=topic_arn, Message=message, Subject=subject,
+                               MessageAttributes=attributes)
         print(f'SNS response: {response}')
         return response
     except ClientError as e:
@@ -61,6 +86,264 @@ def publish_to_sns(data):
         app.logger.error(f"Error when publishing to SNS: {e}")
         raise
 
+def set_job_status(job_id, status, expected):
+    # Conditional status change; False if the job has moved on from expected
+    dynamo = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    try:
+        table.update_item(Key={'job_id': job_id},
+                          UpdateExpression='SET job_status = :status',
+                          ConditionExpression='job_status = :expected',
+                          ExpressionAttributeValues={':status': status, ':expected': expected})
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
+    return True
+
+def release_deferred(item):
+    # Move a deferred job to PENDING and send its request; if the request
+    # can't be sent the job goes back to DEFERRED rather than sitting
+    # PENDING with nothing on the queue. False if someone else released it.
+    if not set_job_status(item['job_id'], 'PENDING', 'DEFERRED'):
+        return False
+    # DynamoDB numbers come back as Decimal, which JSON can't encode
+    data = {k: int(v) if isinstance(v, Decimal) else v for k, v in item.items()}
+    data['job_status'] = 'PENDING'
+    try:
+        publish_to_sns(data)
+    except Exception:
+        set_job_status(item['job_id'], 'DEFERRED', 'PENDING')
+        raise
+    item['job_status'] = 'PENDING'
+    record_released(item['user_id'])
+    return True
+
+def record_released(user_id, released=1):
+    # released is negative for jobs sent back to DEFERRED
+    try:
+        user_stats.record(user_id, {'jobs_deferred': -released, 'jobs_pending': released})
+    except Exception as e:
+        app.logger.error(f"Unable to update job stats for user {user_id}: {e}")
+
+def admission_slots(user_id, role, submitted=()):
+    # Number of new jobs the user may start now (the rest are deferred).
+    # Fair-share admission: a user may have at most GAS_MAX_INFLIGHT_JOBS[role]
+    # jobs pending or running. Deferred jobs were submitted first, so free
+    # slots go to them (oldest first) before any new job; run.py does the
+    # same each time one of the user's jobs finishes. Calling this again
+    # after deferring jobs (passed as submitted, as user_id_index may not
+    # show them yet) catches a slot freed in the meantime.
+    dynamo = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    response = table.query(IndexName='user_id_index',
+                           KeyConditionExpression=Key('user_id').eq(user_id))
+    items = response['Items']
+    listed = set(item['job_id'] for item in items)
+    items += [item for item in submitted if item['job_id'] not in listed]
+    in_flight = sum(1 for item in items if item['job_status'] in ('PENDING', 'RUNNING'))
+    limit = app.config['GAS_MAX_INFLIGHT_JOBS'].get(role, app.config['GAS_MAX_INFLIGHT_JOBS']['free_user'])
+    slots = max(limit - in_flight, 0)
+    deferred = sorted((item for item in items if item['job_status'] == 'DEFERRED'),
+                      key=lambda item: item['submit_time'])
+    for item in deferred:
+        if not slots:
+            return 0
+        # A job released concurrently by run.py takes a slot all the same
+        slots -= 1
+        try:
+            if release_deferred(item):
+                job_status_hub.publish(item['job_id'], 'PENDING', item['user_id'])
+        except Exception as e:
+            app.logger.error(f"Unable to release deferred job {item['job_id']}: {e}")
+            return 0
+    return slots
+
+def admit_job(user_id, role):
+    return admission_slots(user_id, role) > 0
+
+def insert_dynamo_batch(items, status_by_job):
+    # BatchWriteItem in groups of 25; the batch writer resends any
+    # unprocessed items
+    dynamo = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    submit_time = int(time.time())
+    with table.batch_writer() as batch:
+        for item in items:
+            item['submit_time'] = submit_time
+            item['job_status'] = status_by_job[item['job_id']]
+            batch.put_item(Item=item)
+    for user_id in set(item['user_id'] for item in items):
+        record_submitted(user_id, [item['job_status'] for item in items
+                                   if item['user_id'] == user_id])
+
+def publish_batch_to_sns(items, subject='New Annotation Job Request'):
+    # PublishBatch takes up to 10 messages per call; entries that fail are
+    # retried once. Returns the job IDs that still could not be published.
+    sns = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'],
+                       endpoint_url=app.config['AWS_ENDPOINT_URL'])
+    failed = []
+    for i in range(0, len(items), 10):
+        pending = items[i:i + 10]
+        for attempt in range(2):
+            entries = [{'Id': str(n), 'Message': json.dumps(data), 'Subject': subject,
+                        'MessageAttributes': {'user_role': {'DataType': 'String', 'StringValue': data['user_role']}}}
+                       for n, data in enumerate(pending)]
+            try:
+                response = sns.publish_batch(TopicArn=app.config['AWS_SNS_JOB_REQUEST_TOPIC'],
+                                             PublishBatchRequestEntries=entries)
+                pending = [pending[int(entry['Id'])] for entry in response.get('Failed', [])]
+            except ClientError as e:
+                app.logger.error(f"Client Error when publishing batch to SNS: {e}")
+            if not pending:
+                break
+        failed.extend(data['job_id'] for data in pending)
+    return failed
+
+def existing_job_ids(job_ids):
+    # Which of job_ids already have a job item (BatchGetItem, 100 keys a call)
+    dynamo = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    table_name = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
+    found = set()
+    for i in range(0, len(job_ids), 100):
+        request = {table_name: {'Keys': [{'job_id': job_id} for job_id in job_ids[i:i + 100]],
+                                'ProjectionExpression': 'job_id'}}
+        while request:
+            response = dynamo.batch_get_item(RequestItems=request)
+            found.update(item['job_id'] for item in response['Responses'].get(table_name, []))
+            request = response.get('UnprocessedKeys')
+    return found
+
+def delete_dynamo_batch(items):
+    # Remove job items that were written but never sent to the annotators
+    dynamo = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    with table.batch_writer() as batch:
+        for item in items:
+            batch.delete_item(Key={'job_id': item['job_id']})
+    for user_id in set(item['user_id'] for item in items):
+        statuses = [item['job_status'] for item in items if item['user_id'] == user_id]
+        try:
+            user_stats.record(user_id, {'jobs_total': -len(statuses),
+                                        'jobs_pending': -statuses.count('PENDING'),
+                                        'jobs_deferred': -statuses.count('DEFERRED')})
+        except Exception as e:
+            app.logger.error(f"Unable to update job stats for user {user_id}: {e}")
+
+def check_upload(bucket, key, file_name):
+    # Pre-flight check of an uploaded VCF; returns (input_info, error) where
+    # error is a message for the user. input_info is None if S3 could not
+    # be read (other than the upload not being there), in which case the
+    # job goes ahead unchecked.
+    try:
+        head, total_size = read_upload_head(bucket, key)
+        return vcf_preflight.preflight(head, total_size, app.config['GAS_PREFLIGHT_RECORDS']), None
+    except vcf_preflight.InvalidVCF as e:
+        return None, f"{file_name} is not a valid VCF file: {e}"
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidRange':
+            return None, f"{file_name} is empty."
+        # Without s3:ListBucket a missing key reads as AccessDenied
+        if e.response['Error']['Code'] in ('NoSuchKey', '404', 'AccessDenied', '403'):
+            return None, f"{file_name} was not uploaded."
+        app.logger.error(f"Unable to read upload {key} for validation: {e}")
+        return None, None
+
+def job_request(user, job_id, file_name, bucket, key, profile, input_info):
+    # Job item / request message for an uploaded input
+    data = {'user_id':user,
+            'job_id':job_id,
+            'input_file_name':file_name,
+            's3_inputs_bucket':bucket,
+            's3_key_input_file': key,
+            'user_name':profile.name,
+            'user_email':profile.email,
+            'user_institution':profile.institution,
+            'user_role':profile.role}
+    # Lets the annotators size the job before they download it
+    if input_info:
+        data['input_compression'] = input_info['compression']
+        data['input_records_exact'] = input_info['exact']
+        if input_info['records'] is not None:
+            data['input_record_count'] = input_info['records']
+        if input_info['uncompressed_bytes'] is not None:
+            data['input_uncompressed_bytes'] = input_info['uncompressed_bytes']
+    return data
+
+def upload_post(user_id, fields, conditions):
+    # Presigned POST for one input upload under the user's key prefix;
+    # S3 substitutes ${filename}, giving <prefix><user>/<uuid>~<filename>
+    s3 = boto3.client('s3',
+                      region_name=app.config['AWS_REGION_NAME'],
+                      config=Config(signature_version='s3v4'))
+    key_name = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + \
+        str(uuid.uuid4()) + '~${filename}'
+    encryption = app.config['AWS_S3_ENCRYPTION']
+    acl = app.config['AWS_S3_ACL']
+    fields = dict(fields, **{"x-amz-server-side-encryption": encryption, "acl": acl})
+    conditions = conditions + [{"x-amz-server-side-encryption": encryption}, {"acl": acl}]
+    return s3.generate_presigned_post(Bucket=app.config['AWS_S3_INPUTS_BUCKET'],
+                                      Key=key_name,
+                                      Fields=fields,
+                                      Conditions=conditions,
+                                      ExpiresIn=app.config['AWS_SIGNED_REQUEST_EXPIRATION'])
+
+def multipart_part_size(size):
+    # S3 allows at most 10,000 parts of at least 5 MB each
+    return max(app.config['GAS_MULTIPART_PART_SIZE'], -(-size // 10000), 5 * 1024 * 1024)
+
+def sign_upload_parts(s3, key, upload_id, part_numbers):
+    return [{'part_number': n,
+             'url': s3.generate_presigned_url('upload_part',
+                                              Params={'Bucket': app.config['AWS_S3_INPUTS_BUCKET'],
+                                                      'Key': key, 'UploadId': upload_id, 'PartNumber': n},
+                                              ExpiresIn=app.config['GAS_MULTIPART_URL_EXPIRATION'])}
+            for n in part_numbers]
+
+def own_upload_key(key):
+    # Multipart calls may only touch keys under the user's own prefix
+    prefix = app.config['AWS_S3_KEY_PREFIX'] + session['primary_identity'] + '/'
+    return isinstance(key, str) and key.startswith(prefix) and '/' not in key[len(prefix):]
+
+def request_restore(user_id):
+    # Queue a single restore request for the user; the restore utility fans
+    # it out into one Glacier retrieval per archived job, so the request
+    # thread never waits on Glacier
+    data = {'user_id': user_id, 'request_time': int(time.time())}
+    return publish_to_sns(data, topic_arn=app.config['AWS_SNS_JOB_RESTORE_TOPIC'],
+                          subject='New Restore Request')
+
+def get_restore_progress(user_id):
+    # Summarize restore state across the user's jobs
+    # archived: results still only in Glacier, no retrieval started yet
+    # restoring: Glacier retrieval in progress
+    # restored: results thawed back to S3
+    dynamo = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    response = table.query(IndexName='user_id_index',
+                           KeyConditionExpression=Key('user_id').eq(user_id))
+    progress = {'archived': 0, 'restoring': 0, 'restored': 0}
+    for item in response['Items']:
+        status = item.get('restore_status')
+        if status == 'RESTORING':
+            progress['restoring'] += 1
+        elif status == 'RESTORED':
+            progress['restored'] += 1
+        elif 'results_file_archive_id' in item:
+            progress['archived'] += 1
+    progress['done'] = (progress['archived'] == 0 and progress['restoring'] == 0)
+    return progress
+
+def read_upload_head(bucket, key):
+    # First GAS_PREFLIGHT_BYTES of an uploaded object and its total size
+    s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+    response = s3.get_object(Bucket=bucket, Key=key,
+                             Range=f"bytes=0-{app.config['GAS_PREFLIGHT_BYTES'] - 1}")
+    head = response['Body'].read()
+    if 'ContentRange' in response:
+        return head, int(response['ContentRange'].rsplit('/', 1)[1])
+    return head, len(head)
+
 def ephoch_to_readable_time(epoch):
   return datetime.fromtimestamp(epoch).strftime('%Y-%m-%d %H:%M:%S')
 
@@ -87,6 +370,53 @@ def create_presigned_download_url(object_name):
     # The response contains the presigned URL
     return response
 
+@functools.lru_cache(maxsize=256)
+def get_tabix_index(index_key):
+    # Result files never change once written, so neither do their indexes
+    s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+    response = s3.get_object(Bucket=app.config['AWS_S3_RESULTS_BUCKET'], Key=index_key)
+    return tabix.TabixIndex(response['Body'].read())
+
+@functools.lru_cache(maxsize=256)
+def get_variant_summary(parquet_key):
+    # Like the index, a sidecar never changes once written
+    filesystem = variant_summary.s3_filesystem(app.config['AWS_REGION_NAME'],
+                                               app.config['AWS_ENDPOINT_URL'])
+    return variant_summary.read_summary(filesystem, app.config['AWS_S3_RESULTS_BUCKET'],
+                                        parquet_key, app.config['GAS_SUMMARY_TOP_GENES'])
+
+def fetch_result_range(key):
+    # S3 range GET of [first, last] of a result file
+    s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+    def fetch(first, last):
+        response = s3.get_object(Bucket=app.config['AWS_S3_RESULTS_BUCKET'], Key=key,
+                                 Range=f'bytes={first}-{last}')
+        return response['Body'].read()
+    return fetch
+
+def page_etag(*parts):
+    # Pages also show the session's name and role in the navigation bar,
+    # so those are part of every validator
+    parts = parts + (session.get('name'), session.get('role'))
+    return hashlib.sha1(json.dumps(parts, default=str).encode('utf-8')).hexdigest()
+
+def conditional_page(etag, last_modified, cache_control, render):
+    # Answer 304 without rendering when the browser already has this version.
+    # Pages carrying flashed messages are one-offs and are never cached.
+    if session.get('_flashes'):
+        response = make_response(render())
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.last_modified = datetime.fromtimestamp(int(last_modified), tz=timezone.utc)
+    response.headers['Cache-Control'] = cache_control
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
 # ------------------------- API ENDPOINTS ---------------------------- #
 """Start annotation request
 Create the required AWS S3 policy document and render a form for
@@ -95,46 +425,21 @@ uploading an annotation input file using the policy document.
 Note: You are welcome to use this code instead of your own
 but you can replace the code below with your own if you prefer.
 """
-@app.route('/annotate', methods=['GET'])
+@bp.route('/annotate', methods=['GET'])
 @authenticated
 def annotate():
-  # Create a session client to the S3 service
-  s3 = boto3.client('s3',
-    region_name=app.config['AWS_REGION_NAME'],
-    config=Config(signature_version='s3v4'))
-
-  bucket_name = app.config['AWS_S3_INPUTS_BUCKET']
   user_id = session['primary_identity']
 
-  # Generate unique ID to be used as S3 key (name)
-  key_name = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + \
-    str(uuid.uuid4()) + '~${filename}'
-
   # Create the redirect URL
   redirect_url = str(request.url) + '/job'
 
   # Define policy fields/conditions
-  encryption = app.config['AWS_S3_ENCRYPTION']
-  acl = app.config['AWS_S3_ACL']
-  fields = {
-    "success_action_redirect": redirect_url,
-    "x-amz-server-side-encryption": encryption,
-    "acl": acl
-  }
-  conditions = [
-    ["starts-with", "$success_action_redirect", redirect_url],
-    {"x-amz-server-side-encryption": encryption},
-    {"acl": acl}
-  ]
+  fields = {"success_action_redirect": redirect_url}
+  conditions = [["starts-with", "$success_action_redirect", redirect_url]]
 
   # Generate the presigned POST call
   try:
-    presigned_post = s3.generate_presigned_post(
-      Bucket=bucket_name, 
-      Key=key_name,
-      Fields=fields,
-      Conditions=conditions,
-      ExpiresIn=app.config['AWS_SIGNED_REQUEST_EXPIRATION'])
+    presigned_post = upload_post(user_id, fields, conditions)
   except ClientError as e:
     app.logger.error(f"Unable to generate presigned URL for upload: {e}")
     return abort(500)
@@ -143,6 +448,102 @@ def annotate():
   return render_template('annotate.html', s3_post=presigned_post)
 
 
+"""Start a multipart upload of a large input file
+Takes {"filename": ..., "size": bytes}; returns the key (same
+<uuid>~<filename> scheme as the upload form), the upload ID, the part size
+and a presigned URL for every part, so the browser can PUT parts in
+parallel and retry just the ones that fail.
+"""
+@bp.route('/annotate/multipart', methods=['POST'])
+@authenticated
+def create_multipart_upload():
+  body = request.get_json(silent=True) or {}
+  file_name, size = body.get('filename'), body.get('size')
+  if not isinstance(file_name, str) or not file_name or '/' in file_name or '~' in file_name \
+      or not isinstance(size, int) or size <= 0:
+    return abort(400)
+  key = app.config['AWS_S3_KEY_PREFIX'] + session['primary_identity'] + '/' + \
+    str(uuid.uuid4()) + '~' + file_name
+  part_size = multipart_part_size(size)
+
+  s3 = boto3.client('s3',
+    region_name=app.config['AWS_REGION_NAME'],
+    config=Config(signature_version='s3v4'))
+  try:
+    response = s3.create_multipart_upload(Bucket=app.config['AWS_S3_INPUTS_BUCKET'], Key=key,
+      ServerSideEncryption=app.config['AWS_S3_ENCRYPTION'], ACL=app.config['AWS_S3_ACL'])
+    parts = sign_upload_parts(s3, key, response['UploadId'], range(1, -(-size // part_size) + 1))
+  except ClientError as e:
+    app.logger.error(f"Unable to start multipart upload: {e}")
+    return abort(500)
+  return jsonify({'key': key, 'upload_id': response['UploadId'], 'part_size': part_size,
+    'parts': parts}), 201
+
+
+"""Fresh presigned URLs for parts whose URLs expired
+Takes {"key", "upload_id", "part_numbers": [...]}
+"""
+@bp.route('/annotate/multipart/sign', methods=['POST'])
+@authenticated
+def sign_multipart_upload():
+  body = request.get_json(silent=True) or {}
+  part_numbers = body.get('part_numbers')
+  if not own_upload_key(body.get('key')) or not body.get('upload_id') \
+      or not isinstance(part_numbers, list) \
+      or not all(isinstance(n, int) and 1 <= n <= 10000 for n in part_numbers):
+    return abort(400)
+  s3 = boto3.client('s3',
+    region_name=app.config['AWS_REGION_NAME'],
+    config=Config(signature_version='s3v4'))
+  return jsonify({'parts': sign_upload_parts(s3, body['key'], body['upload_id'], part_numbers)})
+
+
+"""Finish a multipart upload
+Takes {"key", "upload_id", "parts": [{"part_number", "etag"}]} and returns
+the URL that submits the uploaded file as a job, as the upload form's
+redirect would.
+"""
+@bp.route('/annotate/multipart/complete', methods=['POST'])
+@authenticated
+def complete_multipart_upload():
+  body = request.get_json(silent=True) or {}
+  parts = body.get('parts')
+  if not own_upload_key(body.get('key')) or not body.get('upload_id') \
+      or not isinstance(parts, list) or not parts:
+    return abort(400)
+  s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+  try:
+    s3.complete_multipart_upload(Bucket=app.config['AWS_S3_INPUTS_BUCKET'], Key=body['key'],
+      UploadId=body['upload_id'],
+      MultipartUpload={'Parts': sorted(({'PartNumber': int(part['part_number']),
+        'ETag': str(part['etag'])} for part in parts), key=lambda part: part['PartNumber'])})
+  except (KeyError, TypeError, ValueError):
+    return abort(400)
+  except ClientError as e:
+    app.logger.error(f"Unable to complete multipart upload of {body['key']}: {e}")
+    return abort(500)
+  return jsonify({'redirect': url_for('gas.create_annotation_job_request',
+    bucket=app.config['AWS_S3_INPUTS_BUCKET'], key=body['key'])})
+
+
+"""Abandon a multipart upload and free the parts uploaded so far
+"""
+@bp.route('/annotate/multipart/abort', methods=['POST'])
+@authenticated
+def abort_multipart_upload():
+  body = request.get_json(silent=True) or {}
+  if not own_upload_key(body.get('key')) or not body.get('upload_id'):
+    return abort(400)
+  s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+  try:
+    s3.abort_multipart_upload(Bucket=app.config['AWS_S3_INPUTS_BUCKET'], Key=body['key'],
+      UploadId=body['upload_id'])
+  except ClientError as e:
+    app.logger.error(f"Unable to abort multipart upload of {body['key']}: {e}")
+    return abort(500)
+  return '', 204
+
+
 """Fires off an annotation job
 Accepts the S3 redirect GET request, parses it to extract 
 required info, saves a job item to the database, and then
@@ -151,7 +552,7 @@ publishes a notification for the annotator service.
 Note: Update/replace the code below with your own from previous
 homework assignments
 """
-@app.route('/annotate/job', methods=['GET'])
+@bp.route('/annotate/job', methods=['GET'])
 @authenticated
 def create_annotation_job_request():
 
@@ -165,38 +566,187 @@ def create_annotation_job_request():
   _, user, object_name = s3_key.split('/')
   job_id, file_name = object_name.split('~')
 
+  # Check the upload looks like a VCF before committing any work to it
+  # (if S3 can't be read, as with the quota check, the job goes ahead)
+  input_info, error = check_upload(bucket_name, s3_key, file_name)
+  if error:
+    flash(error, 'danger')
+    return redirect(url_for('gas.annotate'))
+
   # Get user profile
   profile = get_profile(user)
 
   # Persist job to database
-  data = {'user_id':user, 
-          'job_id':job_id, 
-          'input_file_name':file_name,
-          's3_inputs_bucket':bucket_name, 
-          's3_key_input_file': s3_key,
-          'user_name':profile.name,
-          'user_email':profile.email,
-          'user_institution':profile.institution,
-          'user_role':profile.role}
+  data = job_request(user, job_id, file_name, bucket_name, s3_key, profile, input_info)
+  try:
+    admitted = admit_job(user, profile.role)
+  except Exception as e:
+    # Never lose a submission because the quota check failed
+    app.logger.error(f"Unable to check job quota, admitting job: {e}")
+    admitted = True
+
   try:
-    insert_dynamo(data)
+    insert_dynamo(data, status='PENDING' if admitted else 'DEFERRED')
+    job_status_hub.publish(job_id, data['job_status'], user)
   except Exception as e:
     app.logger.error(f"Unable to persist job to database: {e}") 
   app.logger.info("Check point: insert_dynamo done")
 
-  # Send message to request queue
+  # Send message to request queue; deferred jobs are published when one of
+  # the user's slots frees up (by run.py, or by a later submission)
+  if admitted:
+    try:
+      publish_to_sns(data)
+    except Exception as e:
+      app.logger.error(f"Unable to publish job request: {e}")
+      # Deferred, it is sent again with the user's next free slot
+      try:
+        if set_job_status(job_id, 'DEFERRED', 'PENDING'):
+          data['job_status'] = 'DEFERRED'
+          record_released(user, -1)
+      except ClientError as e:
+        app.logger.error(f"Unable to defer job {job_id}: {e}")
+    app.logger.info("Check point: publish_to_sns done")
+  else:
+    app.logger.info(f"Job {job_id} deferred; user {user} is at their in-flight job limit")
+    # The user's last running job may have finished since the check above,
+    # with nothing deferred yet for it to release
+    try:
+      admission_slots(user, profile.role, [data])
+    except Exception as e:
+      app.logger.error(f"Unable to recheck job quota: {e}")
+
+  return render_template('annotate_confirm.html', job_id=job_id,
+    deferred=data.get('job_status') == 'DEFERRED')
+
+
+"""Presigned POSTs for uploading several input files at once
+Takes {"count": n} and returns {"uploads": [{"url": ..., "fields": ...}]};
+each upload answers 201 rather than redirecting, and the resulting keys
+are then submitted together to /annotate/batch.
+"""
+@bp.route('/annotate/batch/uploads', methods=['POST'])
+@authenticated
+def annotate_batch_uploads():
+  count = (request.get_json(silent=True) or {}).get('count')
+  if not isinstance(count, int) or not 0 < count <= app.config['GAS_BATCH_MAX_JOBS']:
+    return abort(400)
+  try:
+    uploads = [upload_post(session['primary_identity'], {'success_action_status': '201'},
+      [{'success_action_status': '201'}]) for _ in range(count)]
+  except ClientError as e:
+    app.logger.error(f"Unable to generate presigned URLs for upload: {e}")
+    return abort(500)
+  return jsonify({'uploads': uploads})
+
+
+"""Submit a batch of uploaded input files as annotation jobs
+Takes {"keys": [S3 keys of uploaded inputs]} and creates one job per valid
+key, grouped under a single batch ID. The profile and job quota are read
+once for the whole batch, items are written with BatchWriteItem and job
+requests sent with SNS PublishBatch.
+"""
+@bp.route('/annotate/batch', methods=['POST'])
+@authenticated
+def create_annotation_batch():
+  user = session['primary_identity']
+  keys = (request.get_json(silent=True) or {}).get('keys')
+  if not isinstance(keys, list) or not 0 < len(keys) <= app.config['GAS_BATCH_MAX_JOBS']:
+    return abort(400)
+  bucket_name = app.config['AWS_S3_INPUTS_BUCKET']
+  prefix = app.config['AWS_S3_KEY_PREFIX'] + user + '/'
+
+  uploads, rejected = [], []
+  for key in dict.fromkeys(keys):
+    object_name = key[len(prefix):] if isinstance(key, str) and key.startswith(prefix) else ''
+    if '/' in object_name or '~' not in object_name:
+      rejected.append({'key': key, 'error': 'Not one of your uploads'})
+      continue
+    job_id, file_name = object_name.split('~', 1)
+    uploads.append((key, job_id, file_name))
+
+  # Resubmitting a key must never overwrite its job (or a completed one)
   try:
-    publish_to_sns(data)
+    existing = existing_job_ids([job_id for _, job_id, _ in uploads])
+  except ClientError as e:
+    app.logger.error(f"Unable to look up existing jobs: {e}")
+    return abort(500)
+  rejected += [{'key': key, 'error': 'Already submitted'}
+    for key, job_id, _ in uploads if job_id in existing]
+  uploads = [upload for upload in uploads if upload[1] not in existing]
+
+  # Pre-flight checks are one range GET each; run them side by side, each
+  # thread in its own context of this app
+  flask_app = app._get_current_object()
+  def check(upload):
+    with flask_app.app_context():
+      return check_upload(bucket_name, upload[0], upload[2])
+  with ThreadPoolExecutor(max_workers=app.config['GAS_BATCH_CHECK_WORKERS']) as executor:
+    checks = list(executor.map(check, uploads))
+
+  profile = get_profile(user)
+  batch_id = str(uuid.uuid4())
+  items = []
+  for (key, job_id, file_name), (input_info, error) in zip(uploads, checks):
+    if error:
+      rejected.append({'key': key, 'error': error})
+      continue
+    item = job_request(user, job_id, file_name, bucket_name, key, profile, input_info)
+    item['batch_id'] = batch_id
+    items.append(item)
+  if not items:
+    return jsonify({'batch_id': None, 'jobs': [], 'rejected': rejected}), 400
+
+  try:
+    slots = admission_slots(user, profile.role)
   except Exception as e:
-    app.logger.error(f"Unable to generate presigned URL for upload: {e}")
-  app.logger.info("Check point: publish_to_sns done")
+    app.logger.error(f"Unable to check job quota, admitting batch: {e}")
+    slots = len(items)
+  # Jobs beyond the user's in-flight limit wait as DEFERRED, in upload order
+  status_by_job = {item['job_id']: 'PENDING' if n < slots else 'DEFERRED'
+    for n, item in enumerate(items)}
+
+  try:
+    insert_dynamo_batch(items, status_by_job)
+  except ClientError as e:
+    app.logger.error(f"Unable to persist batch {batch_id} to database: {e}")
+    return abort(500)
+  for item in items:
+    job_status_hub.publish(item['job_id'], item['job_status'], user)
+
+  failed = set(publish_batch_to_sns([item for item in items if item['job_status'] == 'PENDING']))
+  if failed:
+    # Jobs with no request on the queue would never run, yet would count
+    # against the user's in-flight limit; take them back out
+    app.logger.error(f"Unable to publish {len(failed)} job requests of batch {batch_id}: {sorted(failed)}")
+    unpublished = [item for item in items if item['job_id'] in failed]
+    try:
+      delete_dynamo_batch(unpublished)
+    except ClientError as e:
+      app.logger.error(f"Unable to remove unpublished jobs of batch {batch_id}: {e}")
+    rejected += [{'key': item['s3_key_input_file'], 'error': 'Unable to submit job; please try again'}
+      for item in unpublished]
+    items = [item for item in items if item['job_id'] not in failed]
+  deferred = sum(1 for item in items if item['job_status'] == 'DEFERRED')
+  app.logger.info(f"Batch {batch_id}: {len(items)} jobs, {len(rejected)} rejected, "
+    f"{deferred} deferred")
+  if deferred:
+    # As for a single job, pick up any slot freed since the quota check
+    try:
+      admission_slots(user, profile.role, items)
+    except Exception as e:
+      app.logger.error(f"Unable to recheck job quota: {e}")
 
-  return render_template('annotate_confirm.html', job_id=job_id)
+  return jsonify({'batch_id': batch_id,
+    'jobs': [{'job_id': item['job_id'], 'input_file_name': item['input_file_name'],
+      'job_status': item['job_status']} for item in items],
+    'rejected': rejected,
+    'annotations_url': url_for('gas.annotations_list', batch=batch_id)}), 201 if items else 503
 
 
 """List all annotations for the user
 """
-@app.route('/annotations', methods=['GET'])
+@bp.route('/annotations', methods=['GET'])
 @authenticated
 def annotations_list():
   user_id = session['primary_identity']
@@ -212,19 +762,30 @@ def annotations_list():
     app.logger.error(f"Unable to retrieve annotation jobs from database: {e}")
     return abort(500)
   
-  # Get list of annotations to display
+  # Get list of annotations to display, optionally only one batch's
   annotations = response['Items']
+  batch_id = request.args.get('batch')
+  if batch_id:
+    annotations = [a for a in annotations if a.get('batch_id') == batch_id]
   annotations.sort(key=lambda x: x['submit_time'], reverse=True)
-  # Convert submit_time from epoch to string for all annotations
-  for annotation in annotations:
-    annotation['submit_time'] = ephoch_to_readable_time(annotation['submit_time'])
   app.logger.info(f"Retrieved {len(annotations)} annotations from database")
-  return render_template('annotations.html', annotations=annotations)
+
+  # The list version changes whenever a job is added or changes status
+  etag = page_etag([(a['job_id'], a['job_status']) for a in annotations])
+  last_modified = max([max(a['submit_time'], a.get('complete_time', 0))
+    for a in annotations] or [0])
+
+  def render():
+    # Convert submit_time from epoch to string for all annotations
+    for annotation in annotations:
+      annotation['submit_time'] = ephoch_to_readable_time(annotation['submit_time'])
+    return render_template('annotations.html', annotations=annotations, batch_id=batch_id)
+  return conditional_page(etag, last_modified, 'private, no-cache', render)
 
 
 """Display details of a specific annotation job
 """
-@app.route('/annotations/<id>', methods=['GET'])
+@bp.route('/annotations/<id>', methods=['GET'])
 @authenticated
 def annotation_details(id):
   try:
@@ -238,20 +799,198 @@ def annotation_details(id):
     app.logger.error(f"Unable to retrieve annotation job {id} from database: {e}")
     return abort(500)
   annotation = response['Item']
-  annotation['submit_time'] = ephoch_to_readable_time(annotation['submit_time'])
-  # if the job is complete, convert the complete_time from epoch to string, generate presigned URL for result file
-  if 'complete_time' in annotation:
-    annotation['complete_time'] = ephoch_to_readable_time(annotation['complete_time'])  # convert complete_time from epoch to readable time
-    annotation['result_file_url'] = create_presigned_download_url(annotation['s3_key_result_file'])  # generate presigned URL for result file download
   app.logger.info(f"Retrieved annotation job {id} from database")
   if annotation['user_id'] != session['primary_identity']:
     return abort(403)
-  return render_template('annotation_details.html', annotation=annotation)
+
+  etag = page_etag(id, annotation['job_status'], annotation.get('complete_time'),
+    annotation.get('results_file_archive_id'), annotation.get('restore_status'))
+  last_modified = annotation.get('complete_time', annotation['submit_time'])
+  # A completed job only changes again if its results are archived or
+  # restored, so browsers may reuse it for a while without asking; anything
+  # still in progress must be revalidated on every view
+  if annotation['job_status'] == 'COMPLETED':
+    cache_control = f"private, max-age={app.config['GAS_COMPLETED_JOB_MAX_AGE']}"
+  else:
+    cache_control = 'private, no-cache'
+
+  def render():
+    annotation['submit_time'] = ephoch_to_readable_time(annotation['submit_time'])
+    # if the job is complete, convert the complete_time from epoch to string and link the result file
+    if 'complete_time' in annotation:
+      annotation['complete_time'] = ephoch_to_readable_time(annotation['complete_time'])  # convert complete_time from epoch to readable time
+      # The presigned URL is minted when the link is followed, so the page
+      # itself never goes stale
+      annotation['result_file_url'] = url_for('gas.annotation_download', id=id)
+      if 's3_key_result_tabix_file' in annotation:
+        annotation['region_url'] = url_for('gas.annotation_region', id=id)
+      if 's3_key_result_parquet_file' in annotation:
+        annotation['summary_url'] = url_for('gas.annotation_summary', id=id)
+    return render_template('annotation_details.html', annotation=annotation)
+  return conditional_page(etag, last_modified, cache_control, render)
+
+
+"""Redirect to a freshly presigned download URL for a job's result file
+"""
+@bp.route('/annotations/<id>/download', methods=['GET'])
+@authenticated
+def annotation_download(id):
+  try:
+    dynamo = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    response = table.get_item(Key={'job_id': id})
+  except ClientError as e:
+    app.logger.error(f"Unable to retrieve annotation job {id} from database: {e}")
+    return abort(500)
+  annotation = response.get('Item')
+  if not annotation or 's3_key_result_file' not in annotation:
+    return abort(404)
+  if annotation['user_id'] != session['primary_identity']:
+    return abort(403)
+  try:
+    url = create_presigned_download_url(annotation['s3_key_result_file'])  # generate presigned URL for result file download
+  except Exception as e:
+    return abort(500)
+  response = redirect(url)
+  response.headers['Cache-Control'] = 'no-store'
+  return response
+
+
+"""Annotated records in one region of a job's results, read with S3 range
+requests through the results' tabix index
+e.g. /annotations/<id>/region?chrom=chr1&start=11000&end=12500
+"""
+@bp.route('/annotations/<id>/region', methods=['GET'])
+@authenticated
+def annotation_region(id):
+  chrom = request.args.get('chrom')
+  try:
+    start, end = int(request.args['start']), int(request.args['end'])
+  except (KeyError, ValueError):
+    return abort(400)
+  if not chrom or start < 1 or end < start:
+    return abort(400)
+
+  try:
+    dynamo = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    response = table.get_item(Key={'job_id': id})
+  except ClientError as e:
+    app.logger.error(f"Unable to retrieve annotation job {id} from database: {e}")
+    return abort(500)
+  annotation = response.get('Item')
+  if not annotation or 's3_key_result_tabix_file' not in annotation:
+    return abort(404)
+  if annotation['user_id'] != session['primary_identity']:
+    return abort(403)
+
+  try:
+    index = get_tabix_index(annotation['s3_key_result_tabix_file'])
+    records = tabix.query(index, fetch_result_range(annotation['s3_key_result_bgzip_file']),
+      chrom, start, end, max_bytes=app.config['GAS_REGION_MAX_BYTES'])
+  except tabix.RegionTooLarge:
+    return abort(413)
+  except ClientError as e:
+    app.logger.error(f"Unable to read region of results for annotation job {id}: {e}")
+    return abort(500)
+
+  response = Response(''.join(record + '\n' for record in records),
+    mimetype='text/tab-separated-values')
+  response.headers['Cache-Control'] = f"private, max-age={app.config['GAS_COMPLETED_JOB_MAX_AGE']}"
+  return response
+
+
+"""Variant counts by chromosome, consequence and gene for a job, from the
+Parquet sidecar of its results
+"""
+@bp.route('/annotations/<id>/summary', methods=['GET'])
+@authenticated
+def annotation_summary(id):
+  try:
+    dynamo = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    response = table.get_item(Key={'job_id': id})
+  except ClientError as e:
+    app.logger.error(f"Unable to retrieve annotation job {id} from database: {e}")
+    return abort(500)
+  annotation = response.get('Item')
+  if not annotation or 's3_key_result_parquet_file' not in annotation:
+    return abort(404)
+  if annotation['user_id'] != session['primary_identity']:
+    return abort(403)
+  if not variant_summary.available():
+    app.logger.error("pyarrow is not installed; cannot summarize results")
+    return abort(500)
+
+  try:
+    summary = get_variant_summary(annotation['s3_key_result_parquet_file'])
+  except OSError as e:
+    app.logger.error(f"Unable to read results sidecar for annotation job {id}: {e}")
+    return abort(500)
+  response = jsonify(dict(summary, job_id=id))
+  response.headers['Cache-Control'] = f"private, max-age={app.config['GAS_COMPLETED_JOB_MAX_AGE']}"
+  return response
+
+
+def event_stream_response(statuses, user_id=None, listed=None):
+  # Each open stream holds a worker thread; past the per-worker cap the
+  # browser is told to come back later rather than queue behind it
+  if not job_status_hub.open_stream():
+    retry = app.config['GAS_JOB_EVENTS_RETRY']
+    return Response(f"retry: {retry}\n\n", status=503,
+      mimetype='text/event-stream',
+      headers={'Cache-Control': 'no-cache', 'Retry-After': str(-(-retry // 1000))})
+  # Streams are long-lived; keep them out of proxy buffers and caches
+  response = Response(stream_with_context(stream_job_events(statuses, user_id, listed)),
+    mimetype='text/event-stream',
+    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+  response.call_on_close(job_status_hub.close_stream)
+  return response
+
+"""Server-Sent Events stream of status changes for all of the user's
+jobs that have not completed yet, and of jobs they submit meanwhile
+"""
+@bp.route('/annotations/events', methods=['GET'])
+@authenticated
+def annotations_events():
+  try:
+    dynamo = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    response = table.query(IndexName='user_id_index',
+                           KeyConditionExpression=Key('user_id').eq(session['primary_identity']),
+                           ProjectionExpression='job_id, job_status')
+  except ClientError as e:
+    app.logger.error(f"Unable to retrieve annotation jobs from database: {e}")
+    return abort(500)
+  listed = {item['job_id']: item['job_status'] for item in response['Items']}
+  statuses = {job_id: status for job_id, status in listed.items()
+    if status != 'COMPLETED'}
+  return event_stream_response(statuses, session['primary_identity'], listed)
+
+
+"""Server-Sent Events stream of status changes for one job
+"""
+@bp.route('/annotations/<id>/events', methods=['GET'])
+@authenticated
+def annotation_events(id):
+  try:
+    dynamo = boto3.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    response = table.get_item(Key={'job_id': id})
+  except ClientError as e:
+    app.logger.error(f"Unable to retrieve annotation job {id} from database: {e}")
+    return abort(500)
+  annotation = response.get('Item')
+  if not annotation:
+    return abort(404)
+  if annotation['user_id'] != session['primary_identity']:
+    return abort(403)
+  return event_stream_response({id: annotation['job_status']})
 
 
 """Display the log file contents for an annotation job
 """
-@app.route('/annotations/<id>/log', methods=['GET'])
+@bp.route('/annotations/<id>/log', methods=['GET'])
 @authenticated
 def annotation_log(id):
   # Get the annotation job info from the DynamoDB table
@@ -291,9 +1030,25 @@ def annotation_log(id):
   return render_template('view_log.html', log_file_contents=log_file_contents, job_id=id)
 
 
+"""Counts of the user's jobs by status, variants annotated and result
+storage used, read from the incrementally maintained stats item
+"""
+@bp.route('/annotations/stats', methods=['GET'])
+@authenticated
+def annotation_stats():
+  try:
+    stats = user_stats.get_user_stats(session['primary_identity'])
+  except ClientError as e:
+    app.logger.error(f"Unable to retrieve job stats from database: {e}")
+    return abort(500)
+  response = jsonify(stats)
+  response.headers['Cache-Control'] = 'private, no-cache'
+  return response
+
+
 """Subscription management handler
 """
-@app.route('/subscribe', methods=['GET', 'POST'])
+@bp.route('/subscribe', methods=['GET', 'POST'])
 @authenticated
 def subscribe():
   if (request.method == 'GET'):
@@ -301,7 +1056,7 @@ def subscribe():
     if (session.get('role') == "free_user"):
       return render_template('subscribe.html')
     else:
-      return redirect(url_for('profile'))
+      return redirect(url_for('gas.profile'))
 
   elif (request.method == 'POST'):
     # Update user role to allow access to paid features
@@ -314,15 +1069,35 @@ def subscribe():
     session['role'] = "premium_user"
 
     # Request restoration of the user's data from Glacier
-    # Add code here to initiate restoration of archived user data
-    # Make sure you handle files not yet archived!
+    # Only a single message is queued here; the restore utility looks up
+    # the user's archived jobs and skips files that were never archived
+    try:
+      request_restore(session['primary_identity'])
+    except Exception as e:
+      app.logger.error(f"Unable to queue restore request: {e}")
 
     # Display confirmation page
-    return render_template('subscribe_confirm.html') 
+    return render_template('subscribe_confirm.html',
+      progress_interval=app.config['GAS_RESTORE_PROGRESS_INTERVAL'])
+
+"""Restore progress for the subscription confirmation page
+"""
+@bp.route('/subscribe/restore', methods=['GET'])
+@authenticated
+def restore_progress():
+  try:
+    progress = get_restore_progress(session['primary_identity'])
+  except ClientError as e:
+    app.logger.error(f"Unable to retrieve restore progress from database: {e}")
+    return abort(500)
+  except Exception as e:
+    app.logger.error(f"Unable to retrieve restore progress from database: {e}")
+    return abort(500)
+  return jsonify(progress)
 
 """Reset subscription
 """
-@app.route('/unsubscribe', methods=['GET'])
+@bp.route('/unsubscribe', methods=['GET'])
 @authenticated
 def unsubscribe():
   # Hacky way to reset the user's role to a free user; simplifies testing
@@ -330,7 +1105,7 @@ def unsubscribe():
     identity_id=session['primary_identity'],
     role="free_user"
   )
-  return redirect(url_for('profile'))
+  return redirect(url_for('gas.profile'))
 
 
 """DO NOT CHANGE CODE BELOW THIS LINE
@@ -339,23 +1114,23 @@ def unsubscribe():
 
 """Home page
 """
-@app.route('/', methods=['GET'])
+@bp.route('/', methods=['GET'])
 def home():
   return render_template('home.html')
 
 """Login page; send user to Globus Auth
 """
-@app.route('/login', methods=['GET'])
+@bp.route('/login', methods=['GET'])
 def login():
   app.logger.info(f"Login attempted from IP {request.remote_addr}")
   # If user requested a specific page, save it session for redirect after auth
   if (request.args.get('next')):
     session['next'] = request.args.get('next')
-  return redirect(url_for('authcallback'))
+  return redirect(url_for('gas.authcallback'))
 
 """404 error handler
 """
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def page_not_found(e):
   return render_template('error.html', 
     title='Page not found', alert_level='warning',
@@ -365,7 +1140,7 @@ def page_not_found(e):
 
 """403 error handler
 """
-@app.errorhandler(403)
+@bp.app_errorhandler(403)
 def forbidden(e):
   return render_template('error.html',
     title='Not authorized', alert_level='danger',
@@ -376,7 +1151,7 @@ def forbidden(e):
 
 """405 error handler
 """
-@app.errorhandler(405)
+@bp.app_errorhandler(405)
 def not_allowed(e):
   return render_template('error.html',
     title='Not allowed', alert_level='warning',
@@ -386,7 +1161,7 @@ def not_allowed(e):
 
 """500 error handler
 """
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def internal_error(error):
   return render_template('error.html',
     title='Server error', alert_level='danger',